@@ -0,0 +1,89 @@
+"""
+Microbenchmark: the cost of debug logging when it's disabled.
+
+    - old conlog: reads os.environ on every call
+    - conlog: compares against the level read once
+    - DynamicGroupedText: enter, 3 prints, exit
+    - eager vs lazy formatting of iterable_to_grouped_text
+
+Usage:
+    python dev/bench_conlog.py [iterations]
+"""
+
+import sys, os, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'jag_panzer'))
+
+os.environ['_jag-dev-lvl'] = '0'
+
+import jag_util
+from jag_util import conlog, conlog_lazy, DynamicGroupedText, iterable_to_grouped_text
+
+jag_util.set_log_level()
+
+
+def old_conlog(*args, loglvl=1, exact=False):
+	env_lvl = int(os.environ.get('_jag-dev-lvl', 0))
+	if exact and loglvl == env_lvl:
+		print(*args)
+		return
+
+	if env_lvl >= loglvl:
+		print(*args)
+
+
+class OldGroupedText:
+	def __init__(self, groupname='', indent=1):
+		self.indent = '\t'*indent
+		self.groupname = groupname
+
+	def __enter__(self):
+		old_conlog(f'\n{self.indent}+--------------------------')
+		old_conlog(f'{self.indent}|{self.groupname}')
+		old_conlog(f'{self.indent}+--------------------------')
+		return self
+
+	def __exit__(self, type, value, traceback):
+		old_conlog(f'{self.indent}+--------------------------\n')
+
+	def print(self, *args):
+		old_conlog(f'{self.indent}| {args}')
+
+
+HEADERS = [
+	('host', 'example.com'),
+	('user-agent', 'Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0'),
+	('accept', 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'),
+	('accept-encoding', 'gzip, deflate, br'),
+	('connection', 'keep-alive'),
+]
+
+
+def grouped(cls):
+	with cls('Route lookup') as grouplog:
+		grouplog.print('Validating route', 'Need:', '/a', 'Allow:', '/b')
+		grouplog.print('Validating methods:', 'Need:', 'get', 'Allow:', None)
+		grouplog.print('Route', '/b', 'doesnt restrict methods, allowing')
+
+
+CASES = {
+	'old conlog':         lambda: old_conlog('Initialized basic room, evaluated request'),
+	'conlog':             lambda: conlog('Initialized basic room, evaluated request'),
+	'old grouped text':   lambda: grouped(OldGroupedText),
+	'grouped text':       lambda: grouped(DynamicGroupedText),
+	'eager formatting':   lambda: conlog(iterable_to_grouped_text(HEADERS, 'Request headers:')),
+	'lazy formatting':    lambda: conlog_lazy(iterable_to_grouped_text, HEADERS, 'Request headers:'),
+	'empty call':         lambda: None,
+}
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+	for name, case in CASES.items():
+		started = time.perf_counter()
+		for _ in range(iterations):
+			case()
+		took = time.perf_counter() - started
+		print(f'{name:<18} {(took / iterations) * 1_000_000_000:>8.0f} ns/call')
@@ -0,0 +1,90 @@
+"""
+Microbenchmark: reading and parsing request heads.
+
+    - readline: the old way, HeaderFields.collect() over an unbuffered
+      socket file (roughly one recv syscall per byte) + HTTPHeaders(lines)
+    - read_head: ClientStream.read_head() (recv_into big blocks, single find)
+      + HTTPHeaders.from_block() (single pass)
+
+Usage:
+    python dev/bench_head_parser.py [iterations]
+"""
+
+import sys, socket, time, threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'jag_panzer'))
+
+from jag_http_session import ClientStream, HeaderFields
+from jag_http_ents import HTTPHeaders
+
+
+HEAD = (
+	b'GET /static/app.js?v=1234 HTTP/1.1\r\n'
+	b'Host: example.com\r\n'
+	b'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:120.0) Gecko/20100101 Firefox/120.0\r\n'
+	b'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+	b'Accept-Language: en-US,en;q=0.5\r\n'
+	b'Accept-Encoding: gzip, deflate, br\r\n'
+	b'Connection: keep-alive\r\n'
+	b'Cookie: session=0123456789abcdef; theme=dark\r\n'
+	b'Upgrade-Insecure-Requests: 1\r\n'
+	b'Sec-Fetch-Dest: document\r\n'
+	b'Sec-Fetch-Mode: navigate\r\n'
+	b'If-None-Match: "1a2b-3c4d-5e6f"\r\n'
+	b'\r\n'
+)
+
+
+def feeder(skt:socket.socket, iterations:int):
+	for _ in range(iterations):
+		skt.sendall(HEAD)
+
+
+def bench_readline(iterations:int) -> float:
+	srv, cl = socket.socketpair()
+	threading.Thread(target=feeder, args=(cl, iterations), daemon=True).start()
+
+	rfile = srv.makefile('rb', newline=b'\r\n', buffering=0)
+	started = time.perf_counter()
+	for _ in range(iterations):
+		fields = HeaderFields(srv)
+		fields.collect(rfile)
+		method, path, protocol = fields.lines[0].split(' ')
+		HTTPHeaders(fields.lines[1:])
+	took = time.perf_counter() - started
+
+	rfile.close()
+	srv.close()
+	cl.close()
+	return took
+
+
+def bench_read_head(iterations:int) -> float:
+	srv, cl = socket.socketpair()
+	threading.Thread(target=feeder, args=(cl, iterations), daemon=True).start()
+
+	stream = ClientStream(srv)
+	started = time.perf_counter()
+	for _ in range(iterations):
+		head = stream.read_head(65535)
+		start_line, _, block = head.decode().partition('\r\n')
+		method, path, protocol = start_line.split(' ')
+		HTTPHeaders.from_block(block)
+	took = time.perf_counter() - started
+
+	srv.close()
+	cl.close()
+	return took
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+	for name, bench in (('readline', bench_readline), ('read_head', bench_read_head)):
+		took = bench(iterations)
+		print(
+			f'{name:<10} {iterations} heads in {took:.3f}s',
+			f'| {(took / iterations) * 1_000_000:.2f} us/head',
+			f'| {iterations / took:,.0f} heads/s'
+		)
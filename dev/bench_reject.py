@@ -0,0 +1,77 @@
+"""
+Microbenchmark: rejecting a request (404 over a keep-alive connection),
+request evaluation included.
+
+    - regular: the reject page is filled in and goes through
+      flush_bytes -> send_preflight (HTTPHeaders, keep-alive headers...)
+    - prebuilt: ClientRequest.reject(), the head and the page
+      are prebuilt (see prebuilt_responses), a single write
+
+Usage:
+    python dev/bench_reject.py [iterations]
+"""
+
+import sys, os, socket, time, threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'jag_panzer'))
+
+os.environ['_jag-dev-lvl'] = '0'
+
+from server import JagHTTPServerResources
+from prebuilt_responses import PrebuiltResponses
+from jag_http_session import ClientRequest, ClientStream, ServerTimings
+
+
+HEAD = (
+	b'GET /wp-login.php HTTP/1.1\r\n'
+	b'Host: example.com\r\n'
+	b'User-Agent: Mozilla/5.0 (compatible; scanner/1.0)\r\n'
+	b'Accept: */*\r\n'
+	b'\r\n'
+)
+
+
+def sink(skt:socket.socket):
+	try:
+		while skt.recv(1 << 20):
+			pass
+	except OSError:
+		pass
+
+
+def regular(request:ClientRequest):
+	request.response.code = 404
+	request.response.content_type = 'text/html'
+	request.response.flush_bytes(request.srv_res.prebuilt.body(404))
+
+
+def prebuilt(request:ClientRequest):
+	request.reject(404)
+
+
+def bench(case, srv_res, iterations:int) -> float:
+	srv, cl = socket.socketpair()
+	threading.Thread(target=sink, args=(cl,), daemon=True).start()
+
+	# All the requests are already in the buffer, only the sending is measured
+	stream = ClientStream(srv, HEAD * iterations)
+	started = time.perf_counter()
+	for _ in range(iterations):
+		case(ClientRequest(srv, ('127.0.0.1', 1), srv_res, ServerTimings(), 1, stream))
+	took = time.perf_counter() - started
+
+	srv.close()
+	cl.close()
+	return took
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+	srv_res = JagHTTPServerResources({'doc_root': str(Path(__file__).parent)})
+	srv_res.prebuilt = PrebuiltResponses.from_config(srv_res)
+
+	for name, case in (('regular', regular), ('prebuilt', prebuilt)):
+		took = bench(case, srv_res, iterations)
+		print(f'{name:<10} {(took / iterations) * 1_000_000:>8.2f} us/request')
@@ -0,0 +1,71 @@
+"""
+Microbenchmark: route lookups with a few hundred routes.
+
+    - linear: the old way, startswith() over every route
+    - radix: jag_routing.RadixRouter without the LRU cache
+    - radix+lru: jag_routing.RadixRouter with the LRU cache
+
+Usage:
+    python dev/bench_router.py [iterations]
+"""
+
+import sys, time, random
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'jag_panzer'))
+
+from jag_routing import RadixRouter
+
+
+class Route:
+	def __init__(self, path, methods=None):
+		self.path = path
+		self.methods = methods
+		self.func = None
+
+
+def make_routes(count:int) -> list[Route]:
+	routes = []
+	for idx in range(count):
+		routes.append(Route(f'/api/v1/resource{idx:04d}', {'get', 'post'}))
+		routes.append(Route(f'/api/v1/resource{idx:04d}/<int:id>', {'get'}))
+	return routes
+
+
+def linear_match(routes, path, method):
+	for route in routes:
+		if path.startswith(route.path):
+			if route.methods and not method in route.methods:
+				return 'invalid_method'
+			return route
+	return None
+
+
+def bench(name:str, lookup, paths:list[str], iterations:int):
+	started = time.perf_counter()
+	for idx in range(iterations):
+		lookup(paths[idx % len(paths)], 'get')
+	took = time.perf_counter() - started
+	print(
+		f'{name:<10} {iterations} lookups in {took:.3f}s',
+		f'| {(took / iterations) * 1_000_000:.2f} us/lookup'
+	)
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+	routes = make_routes(500)
+	# Old index didn't have params, so match plain prefixes there
+	linear_routes = [r for r in routes if not '<' in r.path]
+
+	paths = [f'/api/v1/resource{random.randrange(500):04d}/{random.randrange(1000)}' for _ in range(256)]
+
+	nocache = RadixRouter(cache_size=0)
+	cached = RadixRouter(cache_size=4096)
+	for route in routes:
+		nocache.add(route)
+		cached.add(route)
+	bench('linear', lambda p, m: linear_match(linear_routes, p, m), paths, iterations)
+	bench('radix', nocache.match, paths, iterations)
+	bench('radix+lru', cached.match, paths, iterations)
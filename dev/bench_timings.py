@@ -0,0 +1,70 @@
+"""
+Microbenchmark: the cost of timing a request phase.
+
+    - old record: the time.time() based context manager,
+                  which allocates an object and appends a tuple
+    - record: ServerTimings.record() (perf_counter_ns now)
+    - lap: ServerTimings.lap() into a preallocated phase slot
+
+Usage:
+    python dev/bench_timings.py [iterations]
+"""
+
+import sys, os, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'src' / 'jag_panzer'))
+
+os.environ['_jag-dev-lvl'] = '0'
+
+from jag_http_session import ServerTimings, PHASE_ROUTE
+
+
+class OldPerfRec:
+	def __init__(self, jag_time:list, msg:str):
+		self.jag_time = jag_time
+		self.time = time
+		self.start = self.time.time()
+		self.msg = str(msg)
+		self.result = ('', 0)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, type, value, traceback):
+		mtime = (self.time.time() - self.start) * 1000
+		self.result = (self.msg, mtime)
+		self.jag_time.append(self.result)
+
+
+def old_record(jag_time:list):
+	with OldPerfRec(jag_time, 'route'):
+		pass
+
+
+def new_record(timings:ServerTimings):
+	with timings.record('route', _internal=True):
+		pass
+
+
+if __name__ == '__main__':
+	iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+
+	cases = {
+		'old record': (old_record, []),
+		'record': (new_record, ServerTimings()),
+		'lap': (lambda t: t.lap(PHASE_ROUTE), ServerTimings()),
+		'empty call': (lambda t: None, None),
+	}
+
+	for name, (case, arg) in cases.items():
+		started = time.perf_counter()
+		for _ in range(iterations):
+			case(arg)
+			# Don't let the lists grow forever
+			if isinstance(arg, list):
+				arg.clear()
+			elif arg is not None:
+				arg.jag_time.clear()
+		took = time.perf_counter() - started
+		print(f'{name:<12} {(took / iterations) * 1_000_000_000:>8.0f} ns/phase')
@@ -0,0 +1,641 @@
+"""
+Built-in load generator and benchmark suite.
+
+Starts a JagServer on a temporary doc root and drives it
+with a multi-process HTTP/1.1 load generator (keep-alive)::
+
+    python -m jag_panzer.bench
+    python -m jag_panzer.bench --scenarios small_file,json --duration 10 --json results.json
+    python -m jag_panzer.bench --json new.json --compare old.json
+
+Scenarios:
+    - small_file  -> GET of a 1 KB static file
+    - large_file  -> GET of a 4 MB static file
+    - range       -> 64 KB Range request into the large file
+    - json        -> JSON route
+    - missing_file -> GET of a file which doesn't exist (the reject path, think scanners)
+    - dir_listing -> Listing of a directory with 200 files
+    - upload      -> 256 KB multipart/form-data POST, the route reads the whole body
+    - websocket   -> WebSocket upgrade handshake, a new connection every time.
+                     Jag doesn't serve WebSockets yet, so as of now the scenario
+                     is reported as skipped (the upgrade is answered with 4xx)
+
+Every scenario reports throughput (requests and MB/s in both directions),
+p50/p99/p999 latency and RSS of every worker.
+The results are JSON, meant to be compared between releases (see --compare).
+
+The load generator runs in --clients processes with
+--connections persistent connections in total, split between them.
+Make sure the generator itself isn't the bottleneck
+(the server and the clients share the box).
+"""
+
+import sys, os, json, time, socket, argparse, tempfile, multiprocessing, threading, platform, signal, array
+from pathlib import Path
+
+# (this library simply has to be a proper package)
+if not str(Path(__file__).parent) in sys.path:
+	sys.path.append(str(Path(__file__).parent))
+
+from server import JagServer, JagRoute
+
+
+# ----------------
+# Rooms
+# ----------------
+# This very file is the room file of the benchmark server
+
+@JagRoute(path='/bench/json')
+def bench_json(request, response, services):
+	response.flush_json({'status': 'ok', 'items': list(range(50))})
+
+@JagRoute(path='/bench/upload', methods=['POST'])
+def bench_upload(request, response, services):
+	# There's no form parser yet, read the body as is
+	body = request.read_body_bytes()
+	response.flush_json({'received': len(body)})
+
+@JagRoute()
+def bench_default(request, response, services):
+	services.services.default()
+
+
+
+# ----------------
+# Scenarios
+# ----------------
+
+UPLOAD_BOUNDARY = 'jagbenchboundary'
+
+class Scenario:
+	"""\
+	A single request, repeated over and over.
+	- expect:tuple    -> status codes counted as success
+	- reconnect:bool  -> open a new connection for every request
+	"""
+	def __init__(
+		self,
+		name:str,
+		method:str,
+		path:str,
+		headers:dict|None=None,
+		body:bytes=b'',
+		expect:tuple=(200,),
+		reconnect:bool=False
+	):
+		self.name:str = name
+		self.method:str = method
+		self.path:str = path
+		self.headers:dict = headers or {}
+		self.body:bytes = body
+		self.expect:tuple = expect
+		self.reconnect:bool = reconnect
+
+	def payload(self, host:str) -> bytes:
+		lines = [
+			f'{self.method} {self.path} HTTP/1.1',
+			f'Host: {host}',
+			'User-Agent: jag-bench',
+		]
+		lines.extend(f'{k}: {v}' for k, v in self.headers.items())
+		if self.body:
+			lines.append(f'Content-Length: {len(self.body)}')
+		return ('\r\n'.join(lines) + '\r\n\r\n').encode() + self.body
+
+
+def upload_body(size:int) -> bytes:
+	return (
+		f'--{UPLOAD_BOUNDARY}\r\n'
+		'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+		'Content-Type: application/octet-stream\r\n\r\n'
+	).encode() + os.urandom(size) + f'\r\n--{UPLOAD_BOUNDARY}--\r\n'.encode()
+
+
+def make_scenarios() -> dict[str, Scenario]:
+	scenarios = (
+		Scenario('small_file', 'GET', '/small.txt'),
+		Scenario('large_file', 'GET', '/large.bin'),
+		Scenario('range', 'GET', '/large.bin', {'Range': 'bytes=1048576-1114111'}, expect=(206,)),
+		Scenario('json', 'GET', '/bench/json'),
+		# The default room answers missing files with 405
+		Scenario('missing_file', 'GET', '/wp-login.php', expect=(404, 405)),
+		Scenario('dir_listing', 'GET', '/listing/'),
+		Scenario(
+			'upload',
+			'POST',
+			'/bench/upload',
+			{'Content-Type': f'multipart/form-data; boundary={UPLOAD_BOUNDARY}'},
+			upload_body(256 * 1024)
+		),
+		Scenario(
+			'websocket',
+			'GET',
+			'/bench/ws',
+			{
+				'Connection': 'Upgrade',
+				'Upgrade': 'websocket',
+				'Sec-WebSocket-Version': '13',
+				'Sec-WebSocket-Key': 'dGhlIHNhbXBsZSBub25jZQ==',
+			},
+			expect=(101,),
+			reconnect=True
+		),
+	)
+	return {sc.name: sc for sc in scenarios}
+
+
+def make_doc_root(doc_root:Path):
+	(doc_root / 'small.txt').write_bytes(b'jag' * 341 + b'\n')
+	(doc_root / 'large.bin').write_bytes(os.urandom(4 * 1024 * 1024))
+	listing = doc_root / 'listing'
+	listing.mkdir()
+	for idx in range(200):
+		(listing / f'file_{idx:03d}.txt').write_bytes(b'x' * idx)
+
+
+
+# ----------------
+# Load generator
+# ----------------
+
+class BenchConnection:
+	"""\
+	Minimal blocking HTTP/1.1 client connection with keep-alive.
+	Response bodies are counted and thrown away.
+	"""
+	def __init__(self, addr:tuple[str, int]):
+		self.addr:tuple[str, int] = addr
+		self.skt:socket.socket|None = None
+		self.buf:bytearray = bytearray()
+
+	def connect(self):
+		self.close()
+		self.skt = socket.create_connection(self.addr, timeout=30)
+		self.skt.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+	def close(self):
+		if self.skt:
+			self.skt.close()
+		self.skt = None
+		self.buf.clear()
+
+	def _fill(self):
+		chunk = self.skt.recv(262144)
+		if not chunk:
+			raise ConnectionError('Connection closed by the server')
+		self.buf += chunk
+
+	def _read_line(self) -> bytes:
+		while (end := self.buf.find(b'\r\n')) < 0:
+			self._fill()
+		line = bytes(self.buf[:end])
+		del self.buf[:end + 2]
+		return line
+
+	def _skip(self, amount:int):
+		taken = min(amount, len(self.buf))
+		del self.buf[:taken]
+		amount -= taken
+		while amount:
+			chunk = self.skt.recv(min(amount, 262144))
+			if not chunk:
+				raise ConnectionError('Connection closed by the server')
+			amount -= len(chunk)
+
+	def request(self, payload:bytes) -> tuple[int, int, bool]:
+		"""\
+		Send a request and read the response.
+		Returns (status, response size, whether the connection is reusable).
+		"""
+		if self.skt is None:
+			self.connect()
+		self.skt.sendall(payload)
+
+		while (end := self.buf.find(b'\r\n\r\n')) < 0:
+			self._fill()
+		head = bytes(self.buf[:end]).decode('latin-1')
+		del self.buf[:end + 4]
+
+		status_line, *fields = head.split('\r\n')
+		status = int(status_line.split(' ', 2)[1])
+		headers = {}
+		for field in fields:
+			name, _, value = field.partition(':')
+			headers[name.strip().lower()] = value.strip()
+
+		size = end + 4
+		keep_alive = headers.get('connection', '').lower() != 'close'
+
+		if status == 101 or status == 304 or status < 200:
+			pass
+		elif 'content-length' in headers:
+			length = int(headers['content-length'])
+			self._skip(length)
+			size += length
+		elif headers.get('transfer-encoding', '').lower() == 'chunked':
+			while True:
+				line = self._read_line()
+				size += len(line) + 2
+				chunk_size = int(line.split(b';')[0], 16)
+				if not chunk_size:
+					# Trailer fields, till an empty line
+					while self._read_line():
+						pass
+					break
+				self._skip(chunk_size + 2)
+				size += chunk_size + 2
+		else:
+			# Body till the end of the connection
+			size += len(self.buf)
+			self.buf.clear()
+			while chunk := self.skt.recv(262144):
+				size += len(chunk)
+			keep_alive = False
+
+		return status, size, keep_alive
+
+
+def _drive_connection(addr, scenario:Scenario, payload:bytes, start_at:float, stop_at:float, result:dict):
+	"""A single connection hammering the server till stop_at"""
+	conn = BenchConnection(addr)
+	latencies = result['latencies']
+	while True:
+		now = time.time()
+		if now >= stop_at:
+			break
+		started = time.perf_counter_ns()
+		try:
+			status, size, keep_alive = conn.request(payload)
+		except OSError:
+			# Includes timeouts
+			result['errors'] += 1
+			conn.close()
+			continue
+		took = time.perf_counter_ns() - started
+
+		# Warmup requests don't count
+		if now >= start_at:
+			if status in scenario.expect:
+				latencies.append(took)
+				result['bytes'] += len(payload) + size
+			else:
+				result['errors'] += 1
+
+		if scenario.reconnect or not keep_alive:
+			conn.close()
+	conn.close()
+
+
+def _client_process(addr, scenario:Scenario, connections:int, start_at:float, stop_at:float, results):
+	"""A load generator process: a thread per connection"""
+	payload = scenario.payload(f'{addr[0]}:{addr[1]}')
+	per_thread = [{'latencies': array.array('q'), 'errors': 0, 'bytes': 0} for _ in range(connections)]
+	threads = [
+		threading.Thread(
+			target=_drive_connection,
+			args=(addr, scenario, payload, start_at, stop_at, result),
+			daemon=True
+		)
+		for result in per_thread
+	]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	latencies = array.array('q')
+	for result in per_thread:
+		latencies.extend(result['latencies'])
+	results.put((
+		latencies.tobytes(),
+		sum(r['errors'] for r in per_thread),
+		sum(r['bytes'] for r in per_thread),
+	))
+
+
+def percentile(ordered:list, q:float) -> float:
+	if not ordered:
+		return 0.0
+	return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_scenario(
+	addr:tuple[str, int],
+	scenario:Scenario,
+	duration:float,
+	warmup:float,
+	connections:int,
+	clients:int
+) -> dict:
+	"""\
+	Drive the server with a single scenario.
+	Returns the results (see the module docstring).
+	"""
+	# Make sure the scenario is served at all
+	try:
+		status, _, _ = BenchConnection(addr).request(scenario.payload(f'{addr[0]}:{addr[1]}'))
+	except OSError as err:
+		return {'skipped': f'Probe request failed: {err}'}
+	if not status in scenario.expect:
+		return {'skipped': f'Probe request was answered with {status}, expected {scenario.expect}'}
+
+	clients = max(1, min(clients, connections))
+	start_at = time.time() + 0.2 + warmup
+	stop_at = start_at + duration
+
+	results = multiprocessing.Queue()
+	procs = []
+	for idx in range(clients):
+		# Split the connections as evenly as possible
+		share = connections // clients + (idx < connections % clients)
+		proc = multiprocessing.Process(
+			target=_client_process,
+			args=(addr, scenario, share, start_at, stop_at, results),
+			daemon=True
+		)
+		proc.start()
+		procs.append(proc)
+
+	latencies = array.array('q')
+	errors = 0
+	received = 0
+	for _ in procs:
+		lat_bytes, proc_errors, proc_received = results.get()
+		latencies.frombytes(lat_bytes)
+		errors += proc_errors
+		received += proc_received
+	for proc in procs:
+		proc.join()
+
+	ordered = sorted(latencies)
+	to_ms = lambda ns: round(ns / 1_000_000, 3)
+	return {
+		'requests': len(ordered),
+		'errors': errors,
+		'seconds': duration,
+		'rps': round(len(ordered) / duration, 1),
+		'mb_per_sec': round(received / duration / (1024 * 1024), 2),
+		'latency_ms': {
+			'mean': to_ms(sum(ordered) / len(ordered)) if ordered else 0.0,
+			'p50': to_ms(percentile(ordered, 0.5)),
+			'p99': to_ms(percentile(ordered, 0.99)),
+			'p999': to_ms(percentile(ordered, 0.999)),
+			'max': to_ms(ordered[-1]) if ordered else 0.0,
+		},
+	}
+
+
+
+# ----------------
+# Server processes
+# ----------------
+
+def _process_tree(root_pid:int) -> dict[int, int]:
+	"""\
+	{pid: depth} of every descendant of a process.
+	Uses psutil if available, /proc otherwise.
+	Empty if neither works.
+	"""
+	try:
+		import psutil
+		tree = {}
+		def walk(proc, depth):
+			for child in proc.children():
+				tree[child.pid] = depth
+				walk(child, depth + 1)
+		walk(psutil.Process(root_pid), 1)
+		return tree
+	except ImportError:
+		pass
+	except Exception:
+		return {}
+
+	children = {}
+	proc_dir = Path('/proc')
+	if not proc_dir.is_dir():
+		return {}
+	for entry in proc_dir.iterdir():
+		if not entry.name.isdigit():
+			continue
+		try:
+			stat = (entry / 'stat').read_text()
+		except OSError:
+			continue
+		# The process name may contain spaces and brackets
+		ppid = int(stat.rsplit(')', 1)[1].split()[1])
+		children.setdefault(ppid, []).append(int(entry.name))
+
+	tree = {}
+	pending = [(root_pid, 0)]
+	while pending:
+		pid, depth = pending.pop()
+		for child in children.get(pid, ()):
+			tree[child] = depth + 1
+			pending.append((child, depth + 1))
+	return tree
+
+
+def _rss_kb(pid:int) -> int|None:
+	try:
+		import psutil
+		return psutil.Process(pid).memory_info().rss // 1024
+	except ImportError:
+		pass
+	except Exception:
+		return None
+
+	try:
+		for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+			if line.startswith('VmRSS:'):
+				return int(line.split()[1])
+	except OSError:
+		pass
+	return None
+
+
+def worker_rss(root_pid:int) -> list[int|None]:
+	"""\
+	RSS (KB) of the server workers.
+	root (server_process) -> socket server -> workers
+	"""
+	tree = _process_tree(root_pid)
+	return [_rss_kb(pid) for pid, depth in sorted(tree.items()) if depth == 2]
+
+
+def wait_for_server(addr:tuple[str, int], timeout:float=15.0):
+	deadline = time.monotonic() + timeout
+	while True:
+		try:
+			status, _, _ = BenchConnection(addr).request(
+				Scenario('ready', 'GET', '/small.txt').payload(f'{addr[0]}:{addr[1]}')
+			)
+			if status == 200:
+				return
+		except OSError:
+			pass
+		if time.monotonic() > deadline:
+			raise TimeoutError(f'The benchmark server did not come up on {addr} in {timeout} seconds')
+		time.sleep(0.1)
+
+
+def stop_server(server:JagServer):
+	"""Kill the server with all of its children (psutil is optional)"""
+	for pid in sorted(_process_tree(server.pid), reverse=True):
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except OSError:
+			pass
+	server.terminate()
+
+
+def free_port() -> int:
+	with socket.socket() as skt:
+		skt.bind(('127.0.0.1', 0))
+		return skt.getsockname()[1]
+
+
+
+# ----------------
+# Results
+# ----------------
+
+def jag_version() -> str|None:
+	try:
+		from importlib import metadata
+		return metadata.version('jag-panzer')
+	except Exception:
+		return None
+
+
+def compare(old:dict, new:dict, threshold:float) -> list[str]:
+	"""\
+	Compare two result files.
+	Returns the regressions: throughput drops or p99 growth
+	beyond the threshold (0.1 = 10%).
+	"""
+	regressions = []
+	for name, new_res in new['scenarios'].items():
+		old_res = old.get('scenarios', {}).get(name)
+		if not old_res or 'skipped' in old_res or 'skipped' in new_res:
+			continue
+
+		if old_res['rps'] and new_res['rps'] < old_res['rps'] * (1 - threshold):
+			regressions.append(f"""{name}: {old_res['rps']} -> {new_res['rps']} rps""")
+
+		old_p99 = old_res['latency_ms']['p99']
+		new_p99 = new_res['latency_ms']['p99']
+		if old_p99 and new_p99 > old_p99 * (1 + threshold):
+			regressions.append(f"""{name}: p99 {old_p99} -> {new_p99} ms""")
+
+	return regressions
+
+
+def print_results(results:dict):
+	print(f"""\n{'scenario':<12} {'rps':>10} {'MB/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'p999 ms':>9} {'errors':>7}  worker RSS (KB)""")
+	for name, res in results['scenarios'].items():
+		if 'skipped' in res:
+			print(f"""{name:<12} skipped: {res['skipped']}""")
+			continue
+		lat = res['latency_ms']
+		print(
+			f"""{name:<12} {res['rps']:>10} {res['mb_per_sec']:>9} {lat['p50']:>9} {lat['p99']:>9} {lat['p999']:>9} {res['errors']:>7}""",
+			' '.join(str(rss) for rss in res['rss_kb'])
+		)
+
+
+
+def main(argv:list[str]|None=None) -> int:
+	scenarios = make_scenarios()
+
+	parser = argparse.ArgumentParser(prog='python -m jag_panzer.bench', description='Jag benchmark suite')
+	parser.add_argument('--scenarios', default=','.join(scenarios), help='Comma-separated scenarios to run')
+	parser.add_argument('--duration', type=float, default=5.0, help='Seconds per scenario')
+	parser.add_argument('--warmup', type=float, default=1.0, help='Seconds of warmup before each scenario')
+	parser.add_argument('--connections', type=int, default=32, help='Concurrent connections in total')
+	parser.add_argument('--clients', type=int, default=min(4, os.cpu_count() or 1), help='Load generator processes')
+	parser.add_argument('--workers', type=int, default=2, help='Server worker processes')
+	parser.add_argument('--engine', default='threads', choices=('threads', 'pool', 'selectors'))
+	parser.add_argument('--json', help='Write the results to this file')
+	parser.add_argument('--compare', help='Results file of a previous run to compare against')
+	parser.add_argument('--threshold', type=float, default=0.1, help='Regression threshold for --compare (0.1 = 10%%)')
+	args = parser.parse_args(argv)
+
+	selected = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+	unknown = [name for name in selected if not name in scenarios]
+	if unknown:
+		parser.error(f'Unknown scenarios: {unknown}, must be any of {tuple(scenarios)}')
+
+	with tempfile.TemporaryDirectory(prefix='jag_bench_') as tmp_dir:
+		doc_root = Path(tmp_dir) / 'htdocs'
+		doc_root.mkdir()
+		make_doc_root(doc_root)
+
+		addr = ('127.0.0.1', free_port())
+		server = JagServer({
+			'port': addr[1],
+			'bind_addr': addr[0],
+			'doc_root': doc_root,
+			'room_file': Path(__file__),
+			'console_echo_level': 0,
+			'dir_listing': {'enabled': True},
+			'logging': {'enabled': False},
+			'multiprocessing': {
+				'enabled': True,
+				'worker_count': args.workers,
+				'engine': args.engine,
+			},
+		})
+		server.launch()
+
+		results = {
+			'jag_version': jag_version(),
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'cpu_count': os.cpu_count(),
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+			'config': {
+				'duration': args.duration,
+				'warmup': args.warmup,
+				'connections': args.connections,
+				'clients': args.clients,
+				'workers': args.workers,
+				'engine': args.engine,
+			},
+			'scenarios': {},
+		}
+
+		try:
+			wait_for_server(addr)
+			for name in selected:
+				print(f'Running {name}...', file=sys.stderr)
+				res = run_scenario(
+					addr,
+					scenarios[name],
+					args.duration,
+					args.warmup,
+					args.connections,
+					args.clients
+				)
+				if not 'skipped' in res:
+					res['rss_kb'] = worker_rss(server.pid)
+				results['scenarios'][name] = res
+		finally:
+			stop_server(server)
+
+	print_results(results)
+
+	if args.json:
+		Path(args.json).write_text(json.dumps(results, indent='\t'))
+
+	if args.compare:
+		regressions = compare(json.loads(Path(args.compare).read_text()), results, args.threshold)
+		if regressions:
+			print('\nRegressions:', *regressions, sep='\n    ')
+			return 1
+		print('\nNo regressions')
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,476 @@
+"""
+Response compression (Content-Encoding).
+
+Three ways of sending less bytes over the wire:
+
+- Precompressed siblings: if "app.js.br" or "app.js.gz" exists
+  next to "app.js" - it's sent as-is with sendfile.
+  Compressing stuff with max settings at build time is
+  way better than anything that could be done on the fly.
+
+- On-the-fly compression of static files.
+  Compressed variants are remembered in an LRU cache
+  keyed by the stat signature of the file,
+  so every version of a file is only compressed once.
+
+- On-the-fly compression of dynamic responses
+  (flush_bytes, flush_json, chunked streams, dir listing).
+
+gzip is always available.
+br and zstd are only available if the "brotli" and "zstandard"
+python packages are installed (zstd is also picked up from
+the standard library on python 3.14+).
+"""
+
+import os, zlib, threading, collections, functools, time
+from pathlib import Path
+
+from jag_http_ents import stat_signature, etag_from_stat
+
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+try:
+	from compression import zstd as std_zstd
+except ImportError:
+	std_zstd = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+
+
+# Codecs
+# =================
+
+class GzipCodec:
+	name = 'gzip'
+
+	def __init__(self, level:int=6):
+		self.level:int = level
+
+	def compress(self, data:bytes) -> bytes:
+		# wbits=31 means gzip container, not raw zlib
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+		return compressor.compress(data) + compressor.flush()
+
+	def stream(self) -> 'GzipStream':
+		return GzipStream(self.level)
+
+
+class GzipStream:
+	"""\
+	Streaming gzip compressor.
+	Every piece of input is flushed right away,
+	so that the client can decode whatever it received so far.
+	"""
+	def __init__(self, level:int):
+		self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+	def compress(self, data:bytes) -> bytes:
+		return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+	def finish(self) -> bytes:
+		return self.compressor.flush()
+
+
+class BrotliCodec:
+	name = 'br'
+
+	def __init__(self, quality:int=5):
+		self.quality:int = quality
+
+	def compress(self, data:bytes) -> bytes:
+		return brotli.compress(data, quality=self.quality)
+
+	def stream(self) -> 'BrotliStream':
+		return BrotliStream(self.quality)
+
+
+class BrotliStream:
+	def __init__(self, quality:int):
+		self.compressor = brotli.Compressor(quality=quality)
+
+	def compress(self, data:bytes) -> bytes:
+		return self.compressor.process(data) + self.compressor.flush()
+
+	def finish(self) -> bytes:
+		return self.compressor.finish()
+
+
+class ZstdCodec:
+	name = 'zstd'
+
+	def __init__(self, level:int=3):
+		self.level:int = level
+
+	def compress(self, data:bytes) -> bytes:
+		if std_zstd:
+			return std_zstd.compress(data, self.level)
+		return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+	def stream(self) -> 'ZstdStream':
+		return ZstdStream(self.level)
+
+
+class ZstdStream:
+	def __init__(self, level:int):
+		if std_zstd:
+			self.compressor = std_zstd.ZstdCompressor(level)
+			self.block_flush = std_zstd.ZstdCompressor.FLUSH_BLOCK
+			self.frame_flush = std_zstd.ZstdCompressor.FLUSH_FRAME
+		else:
+			self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+			self.block_flush = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+			self.frame_flush = zstandard.COMPRESSOBJ_FLUSH_FINISH
+
+	def compress(self, data:bytes) -> bytes:
+		return self.compressor.compress(data) + self.compressor.flush(self.block_flush)
+
+	def finish(self) -> bytes:
+		return self.compressor.flush(self.frame_flush)
+
+
+def available_codecs(cfg:dict) -> dict:
+	"""\
+	{encoding_name:codec} of all the codecs that can
+	actually be used on this box, according to compression config.
+	"""
+	codecs = {
+		'gzip': GzipCodec(cfg['gzip_level']),
+	}
+	if brotli:
+		codecs['br'] = BrotliCodec(cfg['br_quality'])
+	if std_zstd or zstandard:
+		codecs['zstd'] = ZstdCodec(cfg['zstd_level'])
+
+	return codecs
+
+
+
+# Negotiation
+# =================
+
+@functools.lru_cache(maxsize=256)
+def acceptable(accept_encoding:str|None, preference:tuple[str, ...]) -> tuple[str, ...]:
+	"""\
+	Encodings from preference, which are acceptable by the client
+	according to the Accept-Encoding header.
+	Sorted by client's q-value, then by preference.
+
+	There are only a handful of distinct Accept-Encoding values out there,
+	so the results are memoized.
+	"""
+	if not accept_encoding:
+		return ()
+
+	weights = {}
+	for item in accept_encoding.lower().split(','):
+		name, _, params = item.partition(';')
+		name = name.strip()
+		if name == 'x-gzip':
+			name = 'gzip'
+
+		q = 1.0
+		params = params.strip()
+		if params.startswith('q='):
+			try:
+				q = float(params[2:])
+			except ValueError:
+				q = 0.0
+
+		weights[name] = q
+
+	accepted = [
+		(weights.get(name, weights.get('*', 0.0)), -idx, name)
+		for idx, name in enumerate(preference)
+	]
+	return tuple(name for q, idx, name in sorted(accepted, reverse=True) if q > 0)
+
+
+def negotiate(accept_encoding:str|None, preference:tuple[str, ...]) -> str|None:
+	"""\
+	Pick an encoding for the response based on the Accept-Encoding header.
+	- preference:tuple - encodings the server is willing to use, best first.
+
+	Returns None if the response should not be encoded.
+	"""
+	accepted = acceptable(accept_encoding, preference)
+	return accepted[0] if accepted else None
+
+
+def variant_etag(etag:str, encoding:str) -> str:
+	"""\
+	Every representation of a resource must have its own ETag.
+	"abc" -> "abc-gzip"
+	"""
+	return f'{etag[:-1]}-{encoding}"'
+
+
+
+# The encoder
+# =================
+
+class EncodedVariant:
+	"""\
+	A compressed representation of a static file.
+	Either body (compressed on the fly) or path (precompressed sibling) is set.
+	"""
+	def __init__(self, encoding:str, etag:str, body:bytes|None=None, path:str|None=None):
+		self.encoding:str = encoding
+		self.etag:str = etag
+		self.body:bytes|None = body
+		self.path:str|None = path
+
+
+class ContentEncoder:
+	"""\
+	Content-Encoding stage of a worker.
+
+	- codecs         - {encoding_name:codec}, see available_codecs()
+	- preference     - encodings in the order of preference
+	                   (precompressed siblings don't need the codec to be installed)
+	- min_size       - don't bother compressing anything smaller than this
+	- max_file       - static files bigger than this are not compressed on the fly
+	- precompressed  - look for precompressed siblings of static files
+	- precompressed_recheck - trust a remembered sibling lookup for n seconds
+	- cache_max_bytes - size limit of the compressed variants cache
+	- compressible   - function(mime) -> bool
+
+	Counters:
+	    - hits         - compressed variants served from memory
+	    - misses       - static files compressed on the fly
+	    - precompressed - precompressed siblings served
+	    - evictions    - variants pushed out of the cache
+	"""
+
+	sibling_suffixes:dict = {
+		'br': '.br',
+		'zstd': '.zst',
+		'gzip': '.gz',
+	}
+	# Max amount of remembered sibling lookups
+	sibling_memo_len:int = 8192
+
+	def __init__(
+		self,
+		codecs:dict,
+		preference:tuple[str, ...],
+		min_size:int,
+		max_file:int,
+		precompressed:bool,
+		cache_max_bytes:int,
+		compressible,
+		precompressed_recheck:float=5
+	):
+		self.codecs:dict = codecs
+		# Only keep what's actually available
+		self.preference:tuple[str, ...] = tuple(e for e in preference if e in codecs)
+		self.sibling_preference:tuple[str, ...] = tuple(e for e in preference if e in self.sibling_suffixes)
+		self.min_size:int = min_size
+		self.max_file:int = max_file
+		self.precompressed:bool = precompressed
+		self.precompressed_recheck:float = precompressed_recheck
+		self.cache_max_bytes:int = cache_max_bytes
+		self.compressible = compressible
+
+		# (path, encoding): (signature, body)
+		self.variants:collections.OrderedDict[tuple, tuple] = collections.OrderedDict()
+		self.total_bytes:int = 0
+		self._lock = threading.Lock()
+
+		# Sibling lookups, misses included, so that hot files
+		# don't cost a failed stat() per acceptable encoding per request.
+		# (path, encoding): (signature of the file, monotonic() of the lookup, sibling path|None)
+		self.siblings:collections.OrderedDict[tuple, tuple] = collections.OrderedDict()
+
+		self.hits:int = 0
+		self.misses:int = 0
+		self.precompressed_hits:int = 0
+		self.evictions:int = 0
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'ContentEncoder|None':
+		"""Create the encoder according to server config, None if disabled"""
+		from mimes.mime_types_base import is_compressible
+
+		cfg = srv_res.cfg['compression']
+		if not cfg['enabled']:
+			return None
+
+		return cls(
+			available_codecs(cfg),
+			tuple(cfg['encodings']),
+			cfg['min_size'],
+			cfg['max_file'],
+			cfg['precompressed'],
+			cfg['cache_max_bytes'],
+			is_compressible,
+			cfg['precompressed_recheck'],
+		)
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		return {
+			'encodings': self.preference,
+			'variants': len(self.variants),
+			'bytes': self.total_bytes,
+			'hits': self.hits,
+			'misses': self.misses,
+			'precompressed': self.precompressed_hits,
+			'evictions': self.evictions,
+		}
+
+	def pick(self, accept_encoding:str|None) -> str|None:
+		"""Encoding to use for a response, if any"""
+		return negotiate(accept_encoding, self.preference)
+
+
+	# Static files
+	# =================
+	def static_variant(
+		self,
+		path:str|Path,
+		st:os.stat_result,
+		mime:str,
+		accept_encoding:str|None,
+		etag:str|None=None,
+		body:bytes|None=None
+	) -> EncodedVariant|None:
+		"""\
+		Get the best compressed representation of a static file
+		acceptable by the client.
+		None means the file should be sent as-is.
+
+		- st   - result of stat() of the file
+		- etag - ETag of the original file (derived from st if not specified)
+		- body - contents of the file, if already at hand (file cache)
+		"""
+		path = str(path)
+		etag = etag or etag_from_stat(st)
+
+		# Precompressed files go first, whatever they are
+		if self.precompressed:
+			for encoding in acceptable(accept_encoding, self.sibling_preference):
+				sibling = self.precompressed_sibling(path, st, encoding)
+				if sibling:
+					with self._lock:
+						self.precompressed_hits += 1
+					return EncodedVariant(encoding, variant_etag(etag, encoding), path=sibling)
+
+		if not (self.min_size <= st.st_size <= self.max_file) or not self.compressible(mime):
+			return None
+
+		encoding = self.pick(accept_encoding)
+		if not encoding:
+			return None
+
+		key = (path, encoding)
+		signature = stat_signature(st)
+		with self._lock:
+			cached = self.variants.get(key)
+			if cached and cached[0] == signature:
+				self.variants.move_to_end(key)
+				self.hits += 1
+				return EncodedVariant(encoding, variant_etag(etag, encoding), body=cached[1])
+
+		if body is None:
+			with open(path, 'rb') as f:
+				body = f.read()
+
+		compressed = self.codecs[encoding].compress(body)
+		self.store(key, signature, compressed)
+
+		return EncodedVariant(encoding, variant_etag(etag, encoding), body=compressed)
+
+	def precompressed_sibling(self, path:str, st:os.stat_result, encoding:str) -> str|None:
+		"""\
+		Path to the precompressed version of a file, if any.
+		Siblings older than the file itself are ignored (forgot to rebuild).
+		The answer is remembered till the file changes
+		or precompressed_recheck runs out.
+		"""
+		key = (path, encoding)
+		signature = stat_signature(st)
+		now = time.monotonic()
+		memo = self.siblings.get(key)
+		if memo and memo[0] == signature and (now - memo[1]) < self.precompressed_recheck:
+			return memo[2]
+
+		sibling = path + self.sibling_suffixes[encoding]
+		try:
+			if os.stat(sibling).st_mtime_ns < st.st_mtime_ns:
+				sibling = None
+		except OSError:
+			sibling = None
+
+		with self._lock:
+			self.siblings.pop(key, None)
+			self.siblings[key] = (signature, now, sibling)
+			while len(self.siblings) > self.sibling_memo_len:
+				self.siblings.popitem(last=False)
+
+		return sibling
+
+	def store(self, key:tuple, signature:tuple, body:bytes):
+		with self._lock:
+			self.misses += 1
+
+			# Too big to be remembered at all
+			if len(body) > self.cache_max_bytes:
+				return
+
+			old = self.variants.pop(key, None)
+			if old:
+				self.total_bytes -= len(old[1])
+
+			self.variants[key] = (signature, body)
+			self.total_bytes += len(body)
+
+			while self.variants and self.total_bytes > self.cache_max_bytes:
+				evicted_key, (evicted_sig, evicted_body) = self.variants.popitem(last=False)
+				self.total_bytes -= len(evicted_body)
+				self.evictions += 1
+
+	def clear(self):
+		with self._lock:
+			self.variants.clear()
+			self.siblings.clear()
+			self.total_bytes = 0
+
+
+	# Dynamic responses
+	# =================
+	def encode_body(self, data:bytes, mime:str|None, accept_encoding:str|None) -> tuple[str|None, bytes]:
+		"""\
+		Compress a response body, if it makes sense.
+		Returns (encoding, data), encoding is None if nothing was done.
+		"""
+		if len(data) < self.min_size or not self.compressible(mime):
+			return None, data
+
+		encoding = self.pick(accept_encoding)
+		if not encoding:
+			return None, data
+
+		return encoding, self.codecs[encoding].compress(data)
+
+	def stream(self, mime:str|None, accept_encoding:str|None) -> tuple[str|None, object]:
+		"""\
+		Streaming compressor for chunked responses.
+		Returns (encoding, compressor), both are None if the stream
+		should not be encoded.
+		The size of a stream is unknown, so min_size doesn't apply.
+		"""
+		if not self.compressible(mime):
+			return None, None
+
+		encoding = self.pick(accept_encoding)
+		if not encoding:
+			return None, None
+
+		return encoding, self.codecs[encoding].stream()
@@ -1,3 +1,10 @@
+from pathlib import Path
+import sys, time
+
+if not str(Path(__file__).parent.parent) in sys.path:
+	sys.path.append(str(Path(__file__).parent.parent))
+
+import jag_util
 
 
 class perftest:
@@ -6,44 +13,27 @@ class perftest:
 		msg = text message to print/return
 		ms = return time in milliseconds instead of seconds
 		log_lvl = log level required for the message to print
-		cpu_t = use time.process_time() instead of time.time()
+		cpu_t = use time.process_time_ns() instead of time.perf_counter_ns()
 		"""
-		import time, os
-		self.time = time
-		self.start = time.process_time() if cpu_t else time.time()
-		self.as_ms = True
+		self.clock = time.process_time_ns if cpu_t else time.perf_counter_ns
+		self.as_ms = ms
 		self.msg = msg
 		self.as_return = as_return
 		self.final = ''
 
 		self.need_log_level = log_lvl
-		self.env_log_level = int(os.environ['_jag-dev-lvl'])
+
+		self.start = self.clock()
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, type, value, traceback):
-		mtime = (self.time.time() - self.start) * (1000 if self.as_ms else 1)
+		mtime = (self.clock() - self.start) / (1_000_000 if self.as_ms else 1_000_000_000)
 		if self.as_return:
 			self.final = f'{self.msg} @@ {mtime}'
 		else:
-			if self.need_log_level == self.env_log_level and self.env_log_level != 0:
+			# The level is read from the environment once, see jag_util.set_log_level
+			env_log_level = jag_util.log_level()
+			if self.need_log_level == env_log_level and env_log_level != 0:
 				print(self.msg, mtime)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
@@ -0,0 +1,327 @@
+"""
+In-memory cache of hot static files.
+
+Serving the same 2kb svg a thousand times a second from disk
+means a thousand is_file(), stat() and read() calls per second.
+The cache keeps small files in memory together with
+a precomputed set of headers.
+
+Every worker has its own cache (nothing is shared between processes).
+
+Entries are revalidated with a single stat() call:
+inode, size and modification time form the signature of the file.
+If the signature changes - the file is read again.
+"""
+
+import os, stat, time, threading, collections, hashlib
+from pathlib import Path
+
+import jag_util
+from jag_http_ents import HTTPDateTime, stat_signature, etag_from_stat
+
+
+class ETagStore:
+	"""\
+	Memoized ETags of static files.
+
+	Modes:
+	    - stat - derived from inode, size and modification time (free)
+	    - hash - sha1 of the file contents. Doesn't change when the
+	      files are copied around (eg. multiple boxes behind a balancer)
+
+	Every version of a file is only hashed once.
+	Hashes are memoized by stat signature in memory and,
+	if store_path is specified, in an sqlite database on disk,
+	which is shared between the workers and survives restarts.
+	"""
+	def __init__(self, mode:str='stat', store_path:str|Path|None=None, max_entries:int=65536):
+		if not mode in ('stat', 'hash'):
+			raise ValueError(f'Unknown ETag mode: {mode}')
+
+		self.mode:str = mode
+		self.store_path:str|None = str(store_path) if store_path else None
+		self.max_entries:int = max_entries
+
+		# path: (signature, etag)
+		self.memo:collections.OrderedDict[str, tuple] = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._db = None
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'ETagStore':
+		buf_cfg = srv_res.cfg['buffers']
+		return cls(
+			buf_cfg['etag_mode'],
+			buf_cfg['etag_store'],
+			buf_cfg['file_cache_max_entries'] * 4,
+		)
+
+	def etag(self, path:str|Path, st:os.stat_result|None=None) -> str:
+		"""\
+		ETag of a file.
+		Pass the result of stat() if it's already at hand.
+		"""
+		if st is None:
+			st = os.stat(path)
+
+		if self.mode == 'stat':
+			return etag_from_stat(st)
+
+		key = str(path)
+		signature = stat_signature(st)
+
+		with self._lock:
+			memoized = self.memo.get(key)
+			if memoized and memoized[0] == signature:
+				self.memo.move_to_end(key)
+				return memoized[1]
+
+			etag = self._db_get(key, signature)
+
+		if etag is None:
+			with open(key, 'rb') as fbuf:
+				etag = '"' + jag_util.progrssive_hash(fbuf, hashlib.sha1, 8, insecure=True) + '"'
+
+			# The file has been modified while hashing. Don't remember this
+			if stat_signature(os.stat(key)) != signature:
+				return etag
+
+			with self._lock:
+				self._db_put(key, signature, etag)
+
+		with self._lock:
+			self.memo[key] = (signature, etag)
+			self.memo.move_to_end(key)
+			while len(self.memo) > self.max_entries:
+				self.memo.popitem(last=False)
+
+		return etag
+
+
+	# sqlite
+	# =================
+	def _connect(self):
+		"""\
+		Open the database lazily, so that the connection
+		is never inherited by forked worker processes.
+		"""
+		if self._db is None:
+			import sqlite3
+			self._db = sqlite3.connect(self.store_path, timeout=5, check_same_thread=False)
+			self._db.execute(
+				'CREATE TABLE IF NOT EXISTS etags (path TEXT PRIMARY KEY, signature TEXT, etag TEXT)'
+			)
+			self._db.commit()
+		return self._db
+
+	def _db_get(self, key:str, signature:tuple) -> str|None:
+		if not self.store_path:
+			return None
+		try:
+			row = self._connect().execute(
+				'SELECT etag FROM etags WHERE path = ? AND signature = ?',
+				(key, repr(signature))
+			).fetchone()
+		except Exception as err:
+			jag_util.conlog('ETag store is unavailable:', err)
+			return None
+
+		return row[0] if row else None
+
+	def _db_put(self, key:str, signature:tuple, etag:str):
+		if not self.store_path:
+			return
+		try:
+			db = self._connect()
+			db.execute(
+				'INSERT OR REPLACE INTO etags (path, signature, etag) VALUES (?, ?, ?)',
+				(key, repr(signature), etag)
+			)
+			db.commit()
+		except Exception as err:
+			jag_util.conlog('ETag store is unavailable:', err)
+
+
+class CachedFile:
+	"""\
+	A file stored in the cache:
+	    - body:bytes - contents of the file
+	    - content_type:str - mime type of the file
+	    - signature:tuple - see stat_signature()
+	    - stat:os.stat_result - stat() of the file when it was read
+	    - mtime:int - UNIX timestamp of the last modification
+	    - etag:str - ETag of the file, quotes included
+	    - last_modified:str - precomputed Last-Modified value
+	"""
+	def __init__(self, path:str, body:bytes, st:os.stat_result, content_type:str, etag:str|None=None):
+		self.path:str = path
+		self.body:bytes = body
+		self.signature:tuple = stat_signature(st)
+		self.stat:os.stat_result = st
+		self.content_type:str = content_type
+
+		self.etag:str = etag or etag_from_stat(st)
+		self.mtime:int = int(st.st_mtime)
+		self.last_modified:str = str(HTTPDateTime(self.mtime))
+
+		# Last time the signature was verified
+		self.checked:float = time.monotonic()
+
+
+class StaticFileCache:
+	"""\
+	LRU cache of static files bounded by total size and entry count.
+
+	- max_bytes       - total size of all the cached bodies
+	- max_entries     - max amount of cached files
+	- max_file        - files bigger than this are never cached
+	- revalidate      - trust an entry for n seconds without stat()
+	- mimes           - {.file_ext:mime}
+
+	Counters:
+	    - hits      - served from memory
+	    - misses    - read from disk (and cached)
+	    - bypass    - not cacheable (too big, not a regular file, missing)
+	    - evictions - entries pushed out by LRU
+	"""
+	def __init__(
+		self,
+		max_bytes:int,
+		max_entries:int,
+		max_file:int,
+		revalidate:float,
+		mimes:dict,
+		etags:ETagStore|None=None
+	):
+		self.max_bytes:int = max_bytes
+		self.max_entries:int = max_entries
+		self.max_file:int = max_file
+		self.revalidate:float = revalidate
+		self.mimes:dict = mimes
+		self.etags:ETagStore|None = etags
+
+		self.entries:collections.OrderedDict[str, CachedFile] = collections.OrderedDict()
+		self.total_bytes:int = 0
+		self._lock = threading.Lock()
+
+		self.hits:int = 0
+		self.misses:int = 0
+		self.bypass:int = 0
+		self.evictions:int = 0
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'StaticFileCache|None':
+		"""Create the cache according to server config, None if disabled"""
+		buf_cfg = srv_res.cfg['buffers']
+		if not buf_cfg['file_cache_enabled']:
+			return None
+		return cls(
+			buf_cfg['file_cache_max_bytes'],
+			buf_cfg['file_cache_max_entries'],
+			buf_cfg['file_cache_max_file'],
+			buf_cfg['file_cache_revalidate'],
+			srv_res.mimes['signed'],
+			srv_res.etag_store,
+		)
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		return {
+			'entries': len(self.entries),
+			'bytes': self.total_bytes,
+			'hits': self.hits,
+			'misses': self.misses,
+			'bypass': self.bypass,
+			'evictions': self.evictions,
+		}
+
+	def get(self, path:str|Path) -> CachedFile|None:
+		"""\
+		Get a file from the cache, (re)loading it from disk if needed.
+		None is returned if the file cannot be cached.
+		"""
+		key = str(path)
+		now = time.monotonic()
+
+		with self._lock:
+			entry = self.entries.get(key)
+			if entry and (now - entry.checked) < self.revalidate:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+
+		try:
+			st = os.stat(key)
+		except OSError:
+			return self._bypass(key)
+
+		if not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file:
+			return self._bypass(key)
+
+		with self._lock:
+			entry = self.entries.get(key)
+			if entry and entry.signature == stat_signature(st):
+				entry.checked = now
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+
+		try:
+			with open(key, 'rb') as f:
+				body = f.read(self.max_file + 1)
+		except OSError:
+			return self._bypass(key)
+
+		# The file is being written to right now, don't trust it
+		if len(body) != st.st_size:
+			return self._bypass(key)
+
+		entry = CachedFile(
+			key,
+			body,
+			st,
+			self.mimes.get(Path(key).suffix) or 'application/octet-stream',
+			self.etags.etag(key, st) if self.etags else None
+		)
+		self.store(entry, miss=True)
+		return entry
+
+	def _bypass(self, key:str) -> None:
+		"""The file cannot be cached, forget whatever was stored under its name"""
+		with self._lock:
+			self.bypass += 1
+		self.drop(key)
+		return None
+
+	def store(self, entry:CachedFile, miss:bool=False):
+		with self._lock:
+			if miss:
+				self.misses += 1
+
+			old = self.entries.pop(entry.path, None)
+			if old:
+				self.total_bytes -= len(old.body)
+
+			self.entries[entry.path] = entry
+			self.total_bytes += len(entry.body)
+
+			while self.entries and (
+				self.total_bytes > self.max_bytes
+				or
+				len(self.entries) > self.max_entries
+			):
+				path, evicted = self.entries.popitem(last=False)
+				self.total_bytes -= len(evicted.body)
+				self.evictions += 1
+
+	def drop(self, path:str|Path):
+		"""Remove a file from the cache"""
+		with self._lock:
+			entry = self.entries.pop(str(path), None)
+			if entry:
+				self.total_bytes -= len(entry.body)
+
+	def clear(self):
+		with self._lock:
+			self.entries.clear()
+			self.total_bytes = 0
@@ -0,0 +1,345 @@
+"""
+Alternative connection engines.
+
+The default engine spawns a thread for every accepted connection.
+This is simple and works fine, till a few thousand slow clients
+show up and every single one of them occupies a thread (and its stack).
+
+The pool engine pre-spawns a fixed amount of reusable threads
+and queues accepted connections. When the queue is full -
+the connection is rejected right away, instead of the box falling over.
+
+The selectors engine keeps all the connections in a single
+non-blocking event loop. The loop only receives request heads.
+Once a request head is fully received - the connection is handed
+to a bounded pool of threads, which runs the regular request evaluation
+(routes don't notice any difference).
+When the response is sent, the connection goes back to the loop
+and waits there for the next keep-alive request.
+"""
+
+import selectors, socket, time, collections, threading, queue
+
+from jag_util import conlog, print_exception
+from jag_http_session import ClientStream, serve_request, reuse_connection, apply_tcp_policy
+
+
+class JagThreadPool:
+	"""\
+	Fixed-size pool of reusable threads with a bounded queue.
+
+	Counters:
+	    - queue_depth - tasks waiting for a free thread right now
+	    - busy        - threads executing a task right now
+	    - served      - tasks completed so far
+	    - rejected    - tasks rejected, because the queue was full
+	"""
+	def __init__(self, size:int, queue_len:int):
+		self.size:int = max(1, size)
+		self.tasks:queue.Queue = queue.Queue(maxsize=max(1, queue_len))
+
+		self.busy:int = 0
+		self.served:int = 0
+		self.rejected:int = 0
+		self._counter_lock = threading.Lock()
+
+		for idx in range(self.size):
+			threading.Thread(
+				target=self._work,
+				name=f'jag_pool_{idx}',
+				daemon=True
+			).start()
+
+	@property
+	def queue_depth(self) -> int:
+		return self.tasks.qsize()
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		return {
+			'size': self.size,
+			'queue_depth': self.queue_depth,
+			'busy': self.busy,
+			'served': self.served,
+			'rejected': self.rejected,
+		}
+
+	def submit(self, func, *args) -> bool:
+		"""\
+		Queue a task.
+		Returns False if the queue is full and the task was rejected.
+		Never blocks.
+		"""
+		try:
+			self.tasks.put_nowait((func, args))
+			return True
+		except queue.Full:
+			with self._counter_lock:
+				self.rejected += 1
+			return False
+
+	def _work(self):
+		while True:
+			func, args = self.tasks.get()
+			with self._counter_lock:
+				self.busy += 1
+			try:
+				func(*args)
+			except BaseException as err:
+				# SystemExit included, the thread must survive
+				print_exception(err)
+			finally:
+				with self._counter_lock:
+					self.busy -= 1
+					self.served += 1
+
+
+def reject_overflow(cl_con:socket.socket, srv_res):
+	"""\
+	Get rid of a connection the pool has no room for,
+	according to the overflow policy.
+	"""
+	mp_cfg = srv_res.cfg['multiprocessing']
+	conlog('Worker pool is full, rejecting connection')
+	try:
+		if mp_cfg['pool_overflow'] == '503':
+			cl_con.send(srv_res.prebuilt.pool_overflow)
+	except OSError:
+		pass
+	cl_con.close()
+
+
+class EngineConnection:
+	"""\
+	A client connection tracked by the event loop.
+	"""
+	def __init__(self, cl_con:socket.socket, cl_addr:tuple[str, int]):
+		self.cl_con:socket.socket = cl_con
+		self.cl_addr:tuple[str, int] = cl_addr
+
+		# Everything received from the client ends up here.
+		# The stream is passed to the request evaluator as-is
+		self.stream:ClientStream = ClientStream(cl_con)
+
+		# Sequential number of the request being served
+		self.rq_num:int = 0
+
+		# Where to continue looking for the end of the header.
+		# There's no point in scanning the same bytes over and over
+		self.scan_from:int = 0
+
+		self.last_active:float = time.monotonic()
+
+	def head_received(self) -> bool:
+		"""\
+		Incrementally check whether the buffer contains
+		a complete request head.
+		"""
+		buf = self.stream.buf
+		if buf.find(b'\r\n\r\n', self.scan_from) >= 0:
+			self.scan_from = 0
+			return True
+
+		# The terminator may be split between 2 recv calls
+		self.scan_from = max(0, len(buf) - 3)
+		return False
+
+
+class SelectorsEngine:
+	"""\
+	Non-blocking event loop engine.
+	Runs inside a worker process, one loop per worker.
+	"""
+	def __init__(self, skt:socket.socket, srv_res, route_index):
+		self.skt:socket.socket = skt
+		self.srv_res = srv_res
+		self.route_index = route_index
+
+		self.idle_timeout:float = srv_res.cfg['keep_alive']['idle_timeout']
+		self.read_timeout:float|None = srv_res.cfg['multiprocessing']['read_timeout'] or None
+		self.max_header_len:int = srv_res.cfg['buffers']['max_header_len']
+
+		self.selector = selectors.DefaultSelector()
+
+		# Fully received requests are executed by this pool
+		self.pool = JagThreadPool(
+			srv_res.cfg['multiprocessing']['pool_size'],
+			srv_res.cfg['multiprocessing']['pool_queue_len']
+		)
+		srv_res.worker_pool = self.pool
+
+		# Connections waiting in the loop (for idle timeout checks)
+		self.watched:set[EngineConnection] = set()
+
+		# Connections handed back by the pool threads.
+		# The selector is not thread-safe, so the loop itself
+		# re-registers them after being woken up
+		self.resumed:collections.deque = collections.deque()
+		self._wake_r, self._wake_w = socket.socketpair()
+		self._wake_r.setblocking(False)
+		self._wake_w.setblocking(False)
+
+		self._last_expiry_check:float = time.monotonic()
+
+	def run(self):
+		"""Run the loop forever"""
+		self.skt.setblocking(False)
+		self.selector.register(self.skt, selectors.EVENT_READ, self.accept)
+		self.selector.register(self._wake_r, selectors.EVENT_READ, self.resume)
+
+		while True:
+			for key, mask in self.selector.select(timeout=1):
+				try:
+					if isinstance(key.data, EngineConnection):
+						self.receive(key.data)
+					else:
+						key.data()
+				except Exception as err:
+					print_exception(err)
+
+			self.expire_idle()
+
+
+	# Loop callbacks
+	# =================
+
+	def accept(self):
+		"""Accept a new connection"""
+		try:
+			conn, address = self.skt.accept()
+		except (BlockingIOError, InterruptedError):
+			# Another worker was faster
+			return
+
+		conn.setblocking(False)
+		apply_tcp_policy(conn, self.srv_res)
+		if self.srv_res.metrics:
+			self.srv_res.metrics.conn_opened()
+		self.watch(EngineConnection(conn, address))
+
+	def receive(self, ecn:EngineConnection):
+		"""Receive another piece of the request head"""
+		try:
+			alive = ecn.stream.fill()
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			alive = False
+
+		if not alive:
+			self.drop(ecn)
+			return
+
+		ecn.last_active = time.monotonic()
+
+		if ecn.head_received():
+			self.dispatch(ecn)
+			return
+
+		if len(ecn.stream.buf) > self.max_header_len:
+			conlog('Request head exceeds', self.max_header_len, 'bytes, dropping', ecn.cl_addr)
+			try:
+				ecn.cl_con.send(self.srv_res.prebuilt.header_overflow)
+			except OSError:
+				pass
+			self.drop(ecn)
+
+	def resume(self):
+		"""Take back connections served by the pool"""
+		try:
+			while self._wake_r.recv(4096):
+				pass
+		except (BlockingIOError, InterruptedError):
+			pass
+
+		while self.resumed:
+			ecn = self.resumed.popleft()
+			ecn.cl_con.setblocking(False)
+			ecn.last_active = time.monotonic()
+			ecn.scan_from = 0
+
+			# Pipelined requests may already be in the buffer
+			if ecn.head_received():
+				self.dispatch(ecn)
+			else:
+				self.watch(ecn)
+
+	def expire_idle(self):
+		"""Drop connections which didn't send anything for too long"""
+		now = time.monotonic()
+		if now - self._last_expiry_check < 1:
+			return
+		self._last_expiry_check = now
+
+		for ecn in [c for c in self.watched if (now - c.last_active) > self.idle_timeout]:
+			conlog('Connection idled out', ecn.cl_addr)
+			self.drop(ecn)
+
+
+	# Connection management
+	# =================
+
+	def watch(self, ecn:EngineConnection):
+		self.selector.register(ecn.cl_con, selectors.EVENT_READ, ecn)
+		self.watched.add(ecn)
+
+	def unwatch(self, ecn:EngineConnection):
+		self.selector.unregister(ecn.cl_con)
+		self.watched.discard(ecn)
+
+	def drop(self, ecn:EngineConnection):
+		if ecn in self.watched:
+			self.unwatch(ecn)
+		self.close(ecn)
+
+	def close(self, ecn:EngineConnection):
+		ecn.cl_con.close()
+		if self.srv_res.metrics:
+			self.srv_res.metrics.conn_closed()
+
+	def dispatch(self, ecn:EngineConnection):
+		"""Hand a fully received request to the pool"""
+		if ecn in self.watched:
+			self.unwatch(ecn)
+
+		# Request evaluation expects a regular blocking socket,
+		# but a client stalling mid-body must not pin a pool thread forever
+		ecn.cl_con.settimeout(self.read_timeout)
+		ecn.rq_num += 1
+		if not self.pool.submit(self.serve, ecn):
+			reject_overflow(ecn.cl_con, self.srv_res)
+			if self.srv_res.metrics:
+				self.srv_res.metrics.conn_closed()
+
+
+	# Pool side
+	# =================
+
+	def serve(self, ecn:EngineConnection):
+		"""\
+		Executed by the pool threads.
+		Serve the request and either give the connection back
+		to the loop or close it.
+		"""
+		try:
+			evaluated_request = serve_request(
+				ecn.cl_con,
+				ecn.cl_addr,
+				self.srv_res,
+				self.route_index,
+				ecn.rq_num,
+				ecn.stream
+			)
+
+			if reuse_connection(evaluated_request):
+				self.resumed.append(ecn)
+				try:
+					self._wake_w.send(b'\0')
+				except (BlockingIOError, InterruptedError):
+					# The loop is going to wake up anyway
+					pass
+				return
+		except Exception as err:
+			print_exception(err)
+
+		self.close(ecn)
@@ -75,6 +75,14 @@ class StopExecution(Exception):
 	pass
 
 
+class HeaderFieldsTooLarge(Exception):
+	"""\
+	Raised when the request head (start line + header fields)
+	exceeds the max_header_len limit (431).
+	"""
+	pass
+
+
 
 
 
@@ -8,7 +8,7 @@ Cookies
 Accept
 """
 
-import datetime, string, io, hashlib
+import datetime, string, io, hashlib, os
 from pathlib import Path
 import jag_util
 
@@ -22,6 +22,10 @@ class HTTPHeaderKV:
 	kv_dict:dict = {}
 
 	def __init__(self, input_data=None, delimeter:str='; ', smart:bool=False):
+		# Every instance gets its own storage,
+		# otherwise cookies leak between requests
+		self.kv_dict = {}
+
 		self.accepted_types = (str, bytes, HTTPHeaderKV, dict, type(None))
 		if not type(input_data) in self.accepted_types:
 			raise TypeError(f'Input header kv type must be one of {self.accepted_types}, not {type(input_data)}')
@@ -96,6 +100,29 @@ class HTTPHeaderKV:
 
 
 
+# Properly cased header names: 'content-type' -> 'Content-Type'.
+# Computed once per name instead of on every response.
+# A few names don't follow the capwords rule
+_cased_hnames:dict[str, str] = {
+	'etag': 'ETag',
+	'www-authenticate': 'WWW-Authenticate',
+	'content-md5': 'Content-MD5',
+	'dnt': 'DNT',
+	'te': 'TE',
+	'x-xss-protection': 'X-XSS-Protection',
+}
+
+def cased_hname(hname:str) -> str:
+	"""Lowercase header name to its canonical form"""
+	cased = _cased_hnames.get(hname)
+	if cased is None:
+		cased = string.capwords(hname, '-')
+		# Don't let random client header names grow the cache forever
+		if len(_cased_hnames) < 4096:
+			_cased_hnames[hname] = cased
+	return cased
+
+
 class HTTPHeaders:
 	"""\
 	A set of HTTP headers, excluding startline.
@@ -103,6 +130,7 @@ class HTTPHeaders:
 	input_data is treated according to type:
 	    - list|tuple|set: a list of raw encoded/decoded header fields, eg b'Cache-Control: no-store\r\n'
 	    - dict: Header Name: Header Content
+	    - HTTPHeaders: a copy of another header set
 
 	Internally all keys are stored in lowercase:
 	    Cache-Control -> cache-control
@@ -116,14 +144,20 @@ class HTTPHeaders:
 	      None is returned if no header with this name was found.
 	    - __iter__ would iterate over every single header.
 	    - __setitem__ would ADD a new header, if no header with the same name and value exists.
+	    - __delitem__ would delete all the headers with the specified name.
 	    - get_all(name) would return a list of all the attributes matching the name.
-	"""
-
+	    - set(name, value) would replace all the headers with the specified name.
 
-
-	fields:set = set()
+	Storage is a multi-dict:
+	    - fields - ordered list of (name, value) pairs, as they were added.
+	      This is the order headers are dumped in.
+	    - index - {name: [values]}, for O(1) lookups
+	"""
 
 	def __init__(self, input_data=None):
+		self.fields:list[tuple[str, object]] = []
+		self.index:dict[str, list] = {}
+
 		self.accepted_types = (list, tuple, set, HTTPHeaders, dict, type(None))
 		if not type(input_data) in self.accepted_types:
 			raise TypeError(f'Input fields type must be one of {self.accepted_types}, not {type(input_data)}')
@@ -135,7 +169,8 @@ class HTTPHeaders:
 			self.fields_from_dict(input_data)
 
 		if isinstance(input_data, HTTPHeaders):
-			self.fields = input_data.fields
+			self.fields = input_data.fields.copy()
+			self.index = {hname: hvals.copy() for hname, hvals in input_data.index.items()}
 
 
 	# Shared util
@@ -155,6 +190,26 @@ class HTTPHeaders:
 
 		return field_split[0].lower(), ': '.join(field_split[1:])
 
+	@staticmethod
+	def _same_val(val_a, val_b) -> bool:
+		"""\
+		Compare header values without invoking fancy comparisons
+		between different types (HTTPDateTime == 'whatever' would try parsing the string)
+		"""
+		return val_a is val_b or (type(val_a) is type(val_b) and val_a == val_b)
+
+	def _add(self, hname:str, hval):
+		"""Append a (lowercase name, value) pair, unless an identical one exists"""
+		hvals = self.index.get(hname)
+		if hvals is None:
+			self.index[hname] = [hval]
+		elif any(self._same_val(existing, hval) for existing in hvals):
+			return
+		else:
+			hvals.append(hval)
+
+		self.fields.append((hname, hval))
+
 
 	# Consuming input data
 	# =======================
@@ -165,9 +220,7 @@ class HTTPHeaders:
 		[('cache-control', 'no-store'), ...]
 		"""
 		for field in flist:
-			self.fields.add(
-				self.field_to_kv(field)
-			)
+			self._add(*self.field_to_kv(field))
 
 	def fields_from_dict(self, fdict:dict):
 		"""
@@ -181,51 +234,75 @@ class HTTPHeaders:
 			if isinstance(v, bytes):
 				v = v.decode()
 
-			self.fields.add(
-				(k.lower(), str(v))
-			)
+			self._add(k.lower(), str(v))
+
+
+	@classmethod
+	def from_block(cls, block:str) -> 'HTTPHeaders':
+		"""\
+		Parse a block of header fields in one pass:
+		'Host: example.com\r\nAccept: */*'
+		Raises ValueError on malformed fields.
+		"""
+		headers = cls()
+		if not block:
+			return headers
+
+		add = headers._add
+		for field in block.split('\r\n'):
+			hname, sep, hval = field.partition(':')
+			# No whitespace is allowed between the name and the colon (RFC 9112 5.1)
+			if not sep or not hname or hname[-1] in ' \t':
+				raise ValueError(f'Malformed header field: {field!r}')
+			add(hname.lower(), hval.strip(' \t'))
+
+		return headers
 
 
 	# Getting headers
 	# =======================
 	def __getitem__(self, tgt_hname:str):
 		"""Get first occurance of the header with the specified name"""
-		tgt_hname = str(tgt_hname).lower()
-		for hname, hval in self.fields:
-			if tgt_hname == hname:
-				return hval
+		hvals = self.index.get(tgt_hname)
+		if hvals is None:
+			hvals = self.index.get(str(tgt_hname).lower())
+		return hvals[0] if hvals else None
 
-		return None
+	def get(self, tgt_hname:str, default=None):
+		"""Same as __getitem__, but with a custom default"""
+		hval = self[tgt_hname]
+		return default if hval is None else hval
 
 	def __iter__(self):
 		"""Iterate over all headers"""
-		for header in self.fields:
-			yield header
+		return iter(self.fields)
+
+	def __len__(self):
+		return len(self.fields)
 
 	def __setitem__(self, key:str, value):
 		"""ADD a header to the list IF no identical k:v pair exist"""
-		self.fields.add(
-			(str(key).lower(), value,)
-		)
+		self._add(str(key).lower(), value)
+
+	def set(self, key:str, value):
+		"""Replace all the headers with the specified name with a single one"""
+		del self[key]
+		self._add(str(key).lower(), value)
 
 	def __delitem__(self, key):
-		"""Delete first occurance of the header with the specified name"""
+		"""Delete all the headers with the specified name"""
 		key = str(key).lower()
-		for hname, hval in self.fields:
-			if key == hname:
-				self.fields.remove((hname, hval,))
+		if self.index.pop(key, None) is None:
+			return
+		self.fields = [field for field in self.fields if field[0] != key]
 
 	def __contains__(self, key):
-		key = str(key).lower()
-		for hname, hval in self.fields:
-			if key == hname:
-				return True
-		return False
+		return str(key).lower() in self.index
 
 	def get_all(self, hname:str):
 		"""Return a list of all the headers matching the requested name"""
 		hname = str(hname).lower()
-		return [(hn, hv) for hn, hv in self.fields if hn == hname]
+		return [(hname, hv) for hv in self.index.get(hname, ())]
 
 
 	# Dumping headers
@@ -238,20 +315,17 @@ class HTTPHeaders:
 		# Trying to save a few microseconds...
 		if add_rn:
 			for hname, hval in self.fields:
-				yield f"""{string.capwords(hname, '-')}: {str(hval)}\r\n""".encode()
+				yield f"""{cased_hname(hname)}: {hval}\r\n""".encode()
 		else:
 			for hname, hval in self.fields:
-				yield f"""{string.capwords(hname, '-')}: {str(hval)}""".encode()
+				yield f"""{cased_hname(hname)}: {hval}""".encode()
 
 	def __bytes__(self):
 		"""
 		Return a bytes object representing all headers.
 		WITHOUT double \r\n in the end.
 		"""
-		buf = io.BytesIO()
-		for header in self.progrssive_construct():
-			buf.write(header)
-		return buf.getvalue()
+		return b''.join(self.progrssive_construct())
 
 
 
@@ -313,16 +387,17 @@ class HTTPDateTime:
 	@classmethod
 	def dtime_from_http_date(cls, dtime_string:str):
 		"""HTTP Date string to datetime.datetime in UTC"""
-		return cls.as_utc(
-			datetime.datetime.strptime(dtime_string, '%a, %d %b %Y %H:%M:%S %Z')
-		)
+		# HTTP Dates are always GMT.
+		# strptime returns a naive datetime and astimezone()
+		# would treat it as local time, so set the zone explicitly
+		return datetime.datetime.strptime(
+			dtime_string.strip(), '%a, %d %b %Y %H:%M:%S GMT'
+		).replace(tzinfo=datetime.timezone.utc)
 
 	@classmethod
 	def dtime_from_unix_stamp(cls, unix_stamp:int):
 		"""UNIX integer timestamp to datetime.datetime in UTC"""
-		return cls.as_utc(
-			datetime.datetime.fromtimestamp(unix_stamp)
-		)
+		return datetime.datetime.fromtimestamp(unix_stamp, datetime.timezone.utc)
 
 
 	# Util
@@ -399,17 +474,25 @@ class HTTPDateTime:
 			raise TypeError(f'The comparison target should be one of {self.accepted_types}, not {type(other)}')
 
 	def __lt__(self, other):
-		self._comparator(other, '<')
+		return self._comparator(other, '<')
 	def __gt__(self, other):
-		self._comparator(other, '>')
+		return self._comparator(other, '>')
 	def __le__(self, other):
-		self._comparator(other, '<=')
+		return self._comparator(other, '<=')
 	def __ge__(self, other):
-		self._comparator(other, '>=')
+		return self._comparator(other, '>=')
 	def __eq__(self, other):
-		self._comparator(other, '==')
+		return self._comparator(other, '==')
 	def __ne__(self, other):
-		self._comparator(other, '!=')
+		return self._comparator(other, '!=')
+
+	def __hash__(self):
+		return hash(self.dtime)
+
+	@property
+	def unix(self) -> int:
+		"""UNIX timestamp of the Date (HTTP Dates have 1 second precision)"""
+		return int(self.dtime.timestamp())
 
 
 
@@ -438,6 +521,20 @@ Server: * compares dates *
 """
 
 
+def stat_signature(st:os.stat_result) -> tuple[int, int, int, int]:
+	"""\
+	A tuple which changes whenever the file changes
+	(or gets replaced with another file).
+	"""
+	return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def etag_from_stat(st:os.stat_result) -> str:
+	"""\
+	Cheap strong ETag derived from inode, size and modification time.
+	No need to hash the contents of the file.
+	"""
+	return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
 
 
 class HTTPClientCacheControl:
@@ -545,12 +642,12 @@ class HTTPCachedResource:
 
 		info = file.stat()
 
-		self.response_headers['last-modified'] = HTTPDateTime(info.st_mtime)
+		self.response_headers['last-modified'] = HTTPDateTime(int(info.st_mtime))
 
 		if (self.etag_enabled and etag != False) or etag == True:
-			with open(str(file), 'rb') as fbuf:
-				# todo: is there a better, built-in, platform independent alternative for sha1 ?
-				self.response_headers['etag'] = jag_util.progrssive_hash(fbuf, hashlib.sha1, 50, insecure=True)
+			# Hashing the whole file on every request is way too expensive.
+			# Use ETagStore for content-based tags
+			self.response_headers['etag'] = etag_from_stat(info)
 
 	def max_age(self, days=0, hours=0, minutes=0, seconds=0, weeks=0):
 		"""Set max age of a response resource"""
@@ -817,9 +914,201 @@ class Cookies:
 class ByteRange:
 	"""\
 	Utilities for managing byterange requests and responses.
+
+	Takes the value of the "Range" request header, eg::
+
+	    bytes=0-499, 1000-, -500
+
+	Each range is stored as (start, end), both inclusive (HTTP style).
+	Open ends are None:
+	    - "1000-" -> (1000, None), everything starting from the byte 1000
+	    - "-500"  -> (None, 500), the last 500 bytes (suffix range)
+
+	Syntactically invalid headers are marked as not valid
+	and should simply be ignored (the spec allows that).
+	Actual byte offsets can only be resolved against
+	the size of the resource, see resolve().
 	"""
-	def __init__(self, data):
-		pass
+
+	# Stop abuse, like "bytes=0-0,1-1,2-2,3-3,..."
+	max_ranges:int = 64
+
+	def __init__(self, data:str|bytes):
+		if isinstance(data, bytes):
+			data = data.decode()
+
+		self.ranges:list[tuple[int|None, int|None]] = []
+		self.valid:bool = False
+
+		unit, sep, specs = str(data).strip().partition('=')
+		if unit.strip().lower() != 'bytes' or not sep:
+			return
+
+		for spec in specs.split(','):
+			spec = spec.strip()
+			# "bytes=0-1,,2-3" is fine
+			if not spec:
+				continue
+
+			start, dash, end = spec.partition('-')
+			start, end = start.strip(), end.strip()
+			if not dash or not (start or end):
+				return
+			if not all(n == '' or (n.isascii() and n.isdigit()) for n in (start, end)):
+				return
+
+			start = int(start) if start else None
+			end = int(end) if end else None
+			if start is not None and end is not None and end < start:
+				return
+
+			self.ranges.append((start, end))
+
+		self.valid = 0 < len(self.ranges) <= self.max_ranges
+
+	def resolve(self, size:int) -> list[tuple[int, int]]:
+		"""\
+		Resolve ranges into actual inclusive (start, end) offsets
+		for a resource of the given size.
+		Unsatisfiable ranges are dropped,
+		overlapping and adjacent ranges are merged.
+		An empty list means the whole thing is unsatisfiable (416).
+		"""
+		resolved = []
+		for start, end in self.ranges:
+			if start is None:
+				# suffix range
+				if not end:
+					continue
+				start = max(0, size - end)
+				end = size - 1
+			else:
+				if start >= size:
+					continue
+				end = size - 1 if end is None else min(end, size - 1)
+
+			resolved.append((start, end))
+
+		if len(resolved) < 2:
+			return resolved
+
+		resolved.sort()
+		merged = [resolved[0]]
+		for start, end in resolved[1:]:
+			prev_start, prev_end = merged[-1]
+			if start <= prev_end + 1:
+				merged[-1] = (prev_start, max(prev_end, end))
+			else:
+				merged.append((start, end))
+
+		return merged
+
+	@staticmethod
+	def content_range(start:int, end:int, size:int) -> str:
+		"""Value of the Content-Range header for a resolved range"""
+		return f'bytes {start}-{end}/{size}'
+
+	@staticmethod
+	def unsatisfied_range(size:int) -> str:
+		"""Value of the Content-Range header for 416 responses"""
+		return f'bytes */{size}'
+
+	def __bool__(self):
+		return self.valid
+
+
+
+class HTTPConditions:
+	"""\
+	Evaluates conditional request headers against
+	the validators of the requested resource:
+	    - etag:str - current ETag of the resource, quotes included
+	    - last_modified:int - UNIX timestamp of the last modification
+
+	Supported headers:
+	    - If-None-Match / If-Modified-Since -> not_modified()
+	    - If-Range -> range_allowed()
+
+	Unparsable dates are treated as if the header wasn't sent at all.
+	"""
+	def __init__(self, request_headers:HTTPHeaders, etag:str|None=None, last_modified:int|None=None):
+		self.request_headers = request_headers
+		self.etag:str|None = etag
+		self.last_modified:int|None = last_modified
+
+	@staticmethod
+	def parse_date(data:str|None) -> int|None:
+		"""HTTP Date -> UNIX timestamp or None"""
+		if not data:
+			return None
+		try:
+			return HTTPDateTime(data).unix
+		except ValueError:
+			return None
+
+	@staticmethod
+	def opaque_tag(etag:str) -> str:
+		"""Strip the weakness indicator, W/"abc" -> "abc" """
+		etag = etag.strip()
+		return etag[2:] if etag.startswith('W/') else etag
+
+	def etag_listed(self, header_val:str) -> bool:
+		"""\
+		Whether the current ETag is present in a list of ETags,
+		such as the value of If-None-Match.
+		Uses weak comparison, as required for If-None-Match.
+		"""
+		if not self.etag:
+			return False
+		if header_val.strip() == '*':
+			return True
+
+		own_tag = self.opaque_tag(self.etag)
+		return any(
+			self.opaque_tag(tag) == own_tag
+			for tag in header_val.split(',')
+		)
+
+	def not_modified(self) -> bool:
+		"""\
+		Whether the client already has the current version
+		of the resource and a 304 can be sent instead.
+		If-None-Match takes precedence over If-Modified-Since.
+		"""
+		if_none_match = self.request_headers['if-none-match']
+		if if_none_match:
+			return self.etag_listed(if_none_match)
+
+		since = self.parse_date(self.request_headers['if-modified-since'])
+		if since is None or self.last_modified is None:
+			return False
+
+		return self.last_modified <= since
+
+	def range_allowed(self) -> bool:
+		"""\
+		Whether the Range header should be respected.
+		If-Range only allows the Range if the resource didn't change,
+		otherwise the whole resource has to be sent.
+		"""
+		if_range = (self.request_headers['if-range'] or '').strip()
+		if not if_range:
+			return True
+
+		# Entity tag. Strong comparison, weak tags never match
+		if if_range.startswith(('"', 'W/')):
+			return (
+				bool(self.etag)
+				and not if_range.startswith('W/')
+				and not self.etag.startswith('W/')
+				and if_range == self.etag
+			)
+
+		# Date. Has to be an exact match
+		return (
+			self.last_modified is not None
+			and self.parse_date(if_range) == self.last_modified
+		)
 
 
 
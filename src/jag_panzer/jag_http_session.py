@@ -1,5 +1,5 @@
 from pathlib import Path
-import sys, socket, io, json
+import sys, socket, io, json, os, functools, time
 
 
 if not str(Path(__file__).parent) in sys.path:
@@ -8,16 +8,44 @@ if not str(Path(__file__).parent) in sys.path:
 from jag_util import *
 
 from jag_logging import LogRecord
+from jag_routing import RouteMatch
+from jag_metrics import PHASES
+from jag_profiler import route_key
 from jag_exceptions import *
+from prebuilt_responses import SERVER_FIELD, CLOSE_TAIL
 import jag_http_ents
 
 _room_echo = '[Request Evaluator]'
 
+# TCP_CORK is Linux only
+CORK_AVAILABLE = hasattr(socket, 'TCP_CORK')
+
 _rebind = print
 
 
-def echo_exception_to_client(err, con):
-	import traceback
+_echo_exception_head = (
+	b'HTTP/1.1 500 Internal Server Error\r\n'
+	+ SERVER_FIELD
+	+ b'Content-Type: text/html; charset=utf-8\r\n'
+)
+_echo_exception_page = (
+	b'<!DOCTYPE HTML>\n'
+	b'<html>\n'
+	b'\t<head>\n'
+	b'\t\t<meta http-equiv="Content-Type" content="text/html;charset=utf-8">\n'
+	b'\t\t<title>Rejected</title>\n'
+	b'\t</head>\n'
+	b'\t<body>\n'
+	b'\t\t<h1 style="border-left: 2px #9F2E25;">500 Internal Server Error</h1>\n'
+	b'\t\t<h3>Server: Jag</h3>\n'
+	b'\t\t<p style="white-space: pre;">$$trback</p>\n'
+	b'\t</body>\n'
+	b'</html>\n'
+)
+
+def echo_exception_to_client(err, con) -> int:
+	"""Send the traceback to the client as a 500 page. Returns the amount of bytes sent"""
+	import traceback, html
 
 	trback = ''.join(
 		traceback.format_exception(
@@ -27,22 +55,16 @@ def echo_exception_to_client(err, con):
 		)
 	)
 
-	con.sendall('HTTP/1.1 500 Internal Server Error\r\n'.encode())
-	response_content = f"""<!DOCTYPE HTML>
-		<html>
-			<head>
-				<meta http-equiv="Content-Type" content="text/html;charset=utf-8">
-				<title>Rejected</title>
-			</head>
-			<body>
-				<h1 style="border-left: 2px #9F2E25;">500 Internal Server Error</h1>
-				<h3>Server: Jag</h3>
-				<p style="white-space: pre;">{trback}</p>
-			</body>
-		</html>
-	"""
-	con.sendall(f'Content-Length: {len(response_content)}\r\n\r\n'.encode())
-	con.sendall(response_content.encode())
+	body = _echo_exception_page.replace(b'$$trback', html.escape(trback).encode())
+	# The whole thing in one go
+	data = b''.join((
+		_echo_exception_head,
+		f"""Content-Length: {len(body)}\r\n""".encode(),
+		CLOSE_TAIL,
+		body,
+	))
+	con.sendall(data)
+	return len(data)
 
 
 
@@ -57,9 +79,13 @@ def _default_room(request, response, services):
 			request.reject()
 			return
 
+		# Hot files are served straight from memory
+		if services.serve_cached():
+			return
+
 		# first check if path explicitly points to a file
 		if request.abspath.is_file():
-			services.serve_file()
+			services.serve_file(_no_cache=True)
 			return
 
 		# if it's not a file - check whether the target dir has an index.html file
@@ -97,7 +123,6 @@ class PerfRec:
 	):
 		"""
 		- msg:str='perftest'   -> The name of the timing record
-		- ms:bool=True         -> Use milliseconds instead of seconds to record timing
 		- _internal:bool=False -> Wether the record is coming from jag itself or user
 		- noreport:bool=False  -> Don't write down the record
 		"""
@@ -105,21 +130,18 @@ class PerfRec:
 		self.noreport:bool = noreport
 		self.sv_timings = sv_timings
 
-		# time module
-		self.time = sv_timings.time
-		# timestamp of the beginning of the record
-		self.start = self.time.time()
 		# The name of the timing record
 		self.msg:str = str(msg)
-		# Resulting timings
+		# Resulting timings (milliseconds)
 		self.result:tuple = ('', 0)
+		# perf_counter_ns() of the beginning of the record
+		self.start:int = time.perf_counter_ns()
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, type, value, traceback):
-		mtime = (self.time.time() - self.start) * 1000
-		self.result = (self.msg, mtime)
+		self.result = (self.msg, (time.perf_counter_ns() - self.start) / 1_000_000)
 
 		if not self.noreport:
 			if self._internal:
@@ -129,6 +151,8 @@ class PerfRec:
 
 
 
+# Slots of the fixed internal phases, see jag_metrics.PHASES
+PHASE_ACCEPT, PHASE_HEAD, PHASE_ROUTE, PHASE_HANDLER, PHASE_SEND, PHASE_LOG = range(len(PHASES))
 
 class ServerTimings:
 	"""\
@@ -138,15 +162,24 @@ class ServerTimings:
 	Timings are recorded at all times, but Server-Timing API
 	has to be explicitly enabled.
 
+	The internal phases of a request (see jag_metrics.PHASES)
+	have preallocated slots and are measured with laps:
+	every lap attributes the time since the previous one to a phase.
+	That's a single perf_counter_ns() call per phase.
+
 	Please don't measure every single function on execution.
 	Group the stuff.
 	"""
 	def __init__(self):
-		# time module
-		import time
-		self.time = time
-
-		# internal timings
+		# Nanoseconds spent in every internal phase
+		self.phase_ns:list[int] = [0] * len(PHASES)
+		# perf_counter_ns() of the previous lap
+		self.lap_ns:int = time.perf_counter_ns()
+		# Time of the nested phases (send) since the previous lap,
+		# which the next lap must not count again
+		self._nested_ns:int = 0
+
+		# other internal timings
 		self.jag_time:list = []
 		# custom timings
 		self.timings:list = []
@@ -167,6 +200,37 @@ class ServerTimings:
 		self.enable_header:bool = True
 		self.header_incl_jag:bool = include_jag_timings
 
+	def restart(self, now_ns:int):
+		"""Start the next lap from the given perf_counter_ns() moment"""
+		self.lap_ns = now_ns
+
+	def lap(self, phase:int) -> int:
+		"""\
+		Attribute the time since the previous lap to a phase.
+		Returns the perf_counter_ns() of this lap.
+		"""
+		now = time.perf_counter_ns()
+		self.phase_ns[phase] += now - self.lap_ns - self._nested_ns
+		self._nested_ns = 0
+		self.lap_ns = now
+		return now
+
+	def nested(self, phase:int, started_ns:int):
+		"""\
+		Attribute the time since started_ns to a phase,
+		which happened inside of the current lap (like socket writes in a room).
+		"""
+		took = time.perf_counter_ns() - started_ns
+		self.phase_ns[phase] += took
+		self._nested_ns += took
+
+	def phases(self) -> tuple[tuple[str, float], ...]:
+		"""((phase, milliseconds), ...) of the phases which took any time"""
+		return tuple(
+			(name, round(took / 1_000_000, 3))
+			for name, took in zip(PHASES, self.phase_ns) if took
+		)
+
 	def record(
 		self,
 		msg:str='perftest',
@@ -191,15 +255,18 @@ class ServerTimings:
 
 	def as_header(self, only_value:bool=True) -> str:
 		records = []
-		for rec in self.jag_time:
-			records.append(f'''{rec[0]};dur={rec[1]}''')
+		if self.header_incl_jag:
+			for rec in self.phases():
+				records.append(f'''{rec[0]};dur={rec[1]}''')
+			for rec in self.jag_time:
+				records.append(f'''{rec[0]};dur={rec[1]}''')
 		for rec in self.timings:
 			records.append(f'''{rec[0]};dur={rec[1]}''')
 
 		if only_value:
 			return ', '.join(records)
 		else:
-			return f"""Server-Timings: {', '.join(records)}"""
+			return f"""Server-Timing: {', '.join(records)}"""
 
 
 
@@ -217,7 +284,14 @@ class ServerServices:
 
 	# Serve a file to the client in a CDN manner
 	# If no file is provided - serve path from the request
-	def serve_file(self, tgt_file=None, respect_range=True, chunked=False, _force_oneflush=False):
+	def serve_file(
+		self,
+		tgt_file=None,
+		respect_range=True,
+		chunked=False,
+		_force_oneflush=False,
+		_no_cache=False
+	):
 		"""
 		Serve a file to the client.
 		It's possible to specify a target file.
@@ -231,6 +305,9 @@ class ServerServices:
 
 		Path = self.srv_res.pylib.Path
 
+		if not (_no_cache or _force_oneflush or chunked) and self.serve_cached(tgt_file, respect_range):
+			return
+
 		if not tgt_file and not request.abspath.is_file():
 			self.request.reject()
 			return
@@ -243,34 +320,153 @@ class ServerServices:
 			'application/octet-stream'
 		)
 
+		# Validators. The ETag is cheap (see file_cache.ETagStore),
+		# so a revalidation never reads the file
+		st = tgt_file.stat()
+		etag = (
+			self.srv_res.etag_store.etag(tgt_file, st)
+			if self.srv_res.etag_store else
+			jag_http_ents.etag_from_stat(st)
+		)
+
+		# Ranges always apply to the original file
+		if not (request.byterange and respect_range) and self.serve_encoded(tgt_file, st, etag):
+			return
+
+		conditions = self.validate(etag, int(st.st_mtime))
+		if conditions.not_modified():
+			response.send_not_modified()
+			return
+
 		# Basically, debugging
 		if _force_oneflush:
 			response.flush_bytes(tgt_file.read_bytes())
 			self.request.terminate()
 			return
 
-		# if the size is too big for a single flush - stream in chunks
-		# This is very important, because serving a 2kb svg in chunks slows the response time
-		# and serving an 18gb .mkv Blu-Ray remux in a single flush is impossible
-		if tgt_file.stat().st_size > request.srv_res.cfg['buffers']['max_file_len']:
-			with open(str(tgt_file), 'r+b') as f:
-				# if request comes with a Range header - try serving the requested byterange
-				# '0-' VERY funny, fuck right off
-				if request.byterange and (request.headers.get('range', 'bytes=0-').strip() != 'bytes=0-') and respect_range:
-					conlog('The client has fucked us over:', request.headers.get('range', '0-').strip())
-					response.serve_range(f)
-				else:
-					# response.stream_buffer(f, (1024*1024)*5)
-					response.stream_buffer(
-						f,
-						chunked=chunked,
-						buf_size=self.srv_res.cfg['buffers']['bufstream_chunk_len'],
-					)
-		else:
-			response.flush_bytes(tgt_file.read_bytes())
+		# The file is never read into python.
+		# The kernel copies it straight into the socket with sendfile,
+		# regardless of whether it's a 2kb svg or an 18gb .mkv Blu-Ray remux
+		with open(str(tgt_file), 'rb') as f:
+			# Let the client know it could ask for parts of the file
+			# (video seeking, resumable downloads)
+			if respect_range:
+				response.headers['Accept-Ranges'] = 'bytes'
+
+			# if request comes with a Range header - try serving the requested byterange.
+			# If-Range may cancel the Range when the file has changed
+			if request.byterange and respect_range and conditions.range_allowed():
+				response.serve_range(f)
+			else:
+				response.stream_buffer(
+					f,
+					chunked=chunked,
+					buf_size=self.srv_res.cfg['buffers']['bufstream_chunk_len'],
+				)
 
 		self.request.terminate()
 
+	def validate(self, etag:str, last_modified:int, last_modified_str:str|None=None) -> jag_http_ents.HTTPConditions:
+		"""\
+		Set the validators of the resource being served
+		and evaluate conditional request headers against them.
+		Conditions only apply to GET and HEAD requests.
+		- etag:str               -> ETag of the resource, quotes included
+		- last_modified:int      -> UNIX timestamp of the last modification
+		- last_modified_str:str  -> The above as an HTTP date, if already formatted
+		"""
+		self.response.headers['ETag'] = etag
+		self.response.headers['Last-Modified'] = (
+			last_modified_str or str(jag_http_ents.HTTPDateTime(last_modified))
+		)
+
+		if not self.request.method in ('get', 'head'):
+			return jag_http_ents.HTTPConditions(jag_http_ents.HTTPHeaders())
+
+		return jag_http_ents.HTTPConditions(self.request.headers, etag, last_modified)
+
+	def serve_encoded(self, tgt_file, st:os.stat_result, etag:str, body:bytes|None=None) -> bool:
+		"""\
+		Try serving a compressed representation of a static file:
+		a precompressed sibling (sendfile) or a variant compressed on the fly.
+		Returns False if the file should be sent as-is.
+		Expects response content type to be set already.
+		- st:os.stat_result -> stat() of the file
+		- etag:str          -> ETag of the original file
+		- body:bytes=None   -> contents of the file, if already in memory
+		"""
+		response = self.response
+		encoder = self.srv_res.content_encoding
+
+		# Static files are never compressed by flush_bytes:
+		# either the variant below is sent, or the original as-is
+		response.compress = False
+		if not encoder:
+			return False
+
+		if encoder.compressible(response.content_type):
+			response.headers['Vary'] = 'Accept-Encoding'
+
+		variant = encoder.static_variant(
+			tgt_file,
+			st,
+			response.content_type,
+			self.request.headers['accept-encoding'],
+			etag,
+			body
+		)
+		if not variant:
+			return False
+
+		response.headers['Vary'] = 'Accept-Encoding'
+		if self.validate(variant.etag, int(st.st_mtime)).not_modified():
+			response.send_not_modified()
+			return True
+
+		response.headers['Content-Encoding'] = variant.encoding
+		if variant.body is not None:
+			response.flush_bytes(variant.body)
+		else:
+			with open(variant.path, 'rb') as f:
+				response.send_file(f)
+
+		return True
+
+	def serve_cached(self, tgt_file=None, respect_range=True) -> bool:
+		"""\
+		Try serving a file from the static file cache of the worker.
+		Returns False if the file cannot be served from the cache
+		(caching disabled, file is too big, doesn't exist, partial content requested...)
+		- tgt_file:str|pathlike=None -> Path to the file to serve, defaults to request path.
+		"""
+		file_cache = self.srv_res.file_cache
+		if not file_cache:
+			return False
+
+		# Partial content goes the regular way
+		if respect_range and self.request.byterange:
+			return False
+
+		cached = file_cache.get(tgt_file or self.request.abspath)
+		if not cached:
+			return False
+
+		response = self.response
+		response.content_type = cached.content_type
+
+		if self.serve_encoded(cached.path, cached.stat, cached.etag, cached.body):
+			return True
+
+		if self.validate(cached.etag, cached.mtime, cached.last_modified).not_modified():
+			response.send_not_modified()
+			return True
+
+		if respect_range:
+			response.headers['Accept-Ranges'] = 'bytes'
+
+		response.flush_bytes(cached.body)
+		return True
+
 	# List directory as an html page
 	def list_dir(self):
 		"""
@@ -297,11 +493,11 @@ class ServerServices:
 		"""
 		if not (self.request.abspath / 'index.html').is_file():
 			self.request.reject()
+			return
 
 		self.response.content_type = 'text/html'
-		self.response.flush_bytes(
-			(self.request.abspath / 'index.html').read_bytes()
-		)
+		with open(str(self.request.abspath / 'index.html'), 'rb') as f:
+			self.response.send_file(f)
 
 	# Because why not
 	def default(self):
@@ -322,29 +518,122 @@ class ServerServices:
 
 # Stream bytes to the client
 class ChunkStreamToClient:
-	def __init__(self, request:'ClientRequest', cl_con:socket.socket, self_terminate:bool):
+	def __init__(self, request:'ClientRequest', cl_con:socket.socket, self_terminate:bool, compressor=None):
 		self.cl_con = cl_con
 		self.request = request
 		self.auto_term = self_terminate
+		# Streaming compressor from content_encoding (if any)
+		self.compressor = compressor
 
 	def __enter__(self):
 		return self
 
 	def __exit__(self, type, value, traceback):
-		# todo: does this also has to be hex ?
-		self.cl_con.sendall(b'0\r\n\r\n')
+		# Whatever is left in the compressor goes out
+		# together with the last (zero-length) chunk
+		tail = self.compressor.finish() if self.compressor else b''
+		self.request.response.write(*self.frame(tail), b'0\r\n\r\n')
 		# No auto termination, because it's speculated,
 		# that it's possible to send some sort of trailing headers or whatever
 		if self.auto_term:
 			self.request.terminate()
 
 	def send(self, data):
-		# send the chunk size
-		self.cl_con.sendall(f"""{hex(len(data)).lstrip('0x')}\r\n""".encode())
-		# send the chunk itself
-		self.cl_con.sendall(data)
-		# send separator
-		self.cl_con.sendall(b'\r\n')
+		if self.compressor:
+			data = self.compressor.compress(data)
+		self._send_chunk(data)
+
+	def _send_chunk(self, data):
+		# A zero-length chunk would end the stream
+		if not data:
+			return
+		# size, chunk and separator in a single write
+		self.request.response.write(*self.frame(data))
+
+	@staticmethod
+	def frame(data:bytes) -> tuple:
+		"""Chunk size, the chunk itself and the separator"""
+		if not data:
+			return ()
+		return (f"""{len(data):x}\r\n""".encode(), data, b'\r\n')
+
+	def send_file(self, fbuf, offset:int, count:int):
+		"""\
+		Send a piece of a file as a single chunk with sendfile.
+		Compressed streams have to read the file instead.
+		"""
+		if count <= 0:
+			return
+		if self.compressor:
+			fbuf.seek(offset, 0)
+			self.send(fbuf.read(count))
+			return
+		response = self.request.response
+		response.write(f"""{count:x}\r\n""".encode())
+		response.write_file(fbuf, offset, count)
+		response.write(b'\r\n')
+
+
+def send_buffers(cl_con:socket.socket, buffers:tuple[bytes, ...]|list[bytes]) -> int:
+	"""\
+	Write multiple buffers to the client with as few syscalls as possible.
+	sendmsg is a vectored write: the buffers are never glued together.
+	Platforms without sendmsg (Windows) get a single sendall of the joined buffers.
+	Returns the amount of bytes sent.
+	"""
+	if not hasattr(cl_con, 'sendmsg'):
+		data = b''.join(buffers)
+		cl_con.sendall(data)
+		return len(data)
+
+	pending = [memoryview(buf) for buf in buffers if buf]
+	total = sum(len(buf) for buf in pending)
+	while pending:
+		sent = cl_con.sendmsg(pending)
+		# Partial write, skip whatever has been sent already
+		while sent:
+			if sent >= len(pending[0]):
+				sent -= len(pending.pop(0))
+			else:
+				pending[0] = pending[0][sent:]
+				sent = 0
+
+	return total
+
+
+def apply_tcp_policy(cl_con:socket.socket, srv_res):
+	"""\
+	Set up a freshly accepted connection according to
+	the 'tcp_policy' setting, see server config.
+	"""
+	policy = srv_res.cfg['buffers']['tcp_policy']
+	if policy == 'default':
+		return
+
+	try:
+		# With cork the data is still held back while corked,
+		# but goes out right away once uncorked
+		cl_con.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+	except OSError:
+		pass
+
+
+def transmit_file(cl_con:socket.socket, fbuf, offset:int, count:int) -> int:
+	"""\
+	Zero-copy transfer of count bytes starting at offset
+	from a file to the client.
+
+	Regular files go through os.sendfile.
+	socket.sendfile falls back to plain read()/send()
+	for objects without a file descriptor (BytesIO and friends)
+	and platforms without os.sendfile.
+	"""
+	sent = cl_con.sendfile(fbuf, offset, count)
+	if sent < count:
+		raise ConnectionAbortedError(
+			f'File transfer ended prematurely: {sent}/{count}'
+		)
+	return sent
 
 
 class ByteStreamToClient:
@@ -361,7 +650,10 @@ class ByteStreamToClient:
 			self.request.terminate()
 
 	def send(self, data:bytes):
-		self.cl_con.sendall(data)
+		self.request.response.write(data)
+
+	def send_file(self, fbuf, offset:int, count:int):
+		self.request.response.write_file(fbuf, offset, count)
 
 
 # Read part of a buffer in chunks (start:end)
@@ -394,9 +686,9 @@ class AlignedBufReader:
 	def read(self, amt):
 		# max(smallest, min(n, largest))
 		# Todo: is this slow ?
-		allowed_amount = max(0, min(amt, self.end - self.progress))
+		allowed_amount = max(0, min(amt, self.target_amount - self.progress))
 		chunk = self.buf.read(allowed_amount)
-		self.progress += allowed_amount
+		self.progress += len(chunk)
 		return chunk
 
 
@@ -449,17 +741,71 @@ class ServerResponse:
 		# after the first call
 		self.caching:CacheControl|None = None
 
-	# Dump headers and response code to the client
-	def send_preflight(self):
+		# Whether the connection stays open after this response.
+		# Decided when the headers are sent
+		self.keep_conn:bool = False
+
+		# Whether flush_bytes/stream_chunks are allowed to compress
+		# the body according to Accept-Encoding
+		self.compress:bool = True
+
+		# Everything written to the socket for this response (head included)
+		self.bytes_sent:int = 0
+
+	def write(self, *buffers:bytes):
+		"""\
+		Raw write to the client (no framing, no headers).
+		Everything that goes to the socket should go through here or write_file
 		"""
-		Dump headers and response code to the client
+		started = time.perf_counter_ns()
+		self.bytes_sent += send_buffers(self.cl_con, buffers)
+		self.timings.nested(PHASE_SEND, started)
+
+	def write_file(self, fbuf, offset:int, count:int):
+		"""Raw write of a piece of a file to the client, see transmit_file"""
+		started = time.perf_counter_ns()
+		self.bytes_sent += transmit_file(self.cl_con, fbuf, offset, count)
+		self.timings.nested(PHASE_SEND, started)
+
+	def eval_keep_conn(self, framed:bool|None=None) -> bool:
+		"""\
+		Decide whether the connection could be reused after this response.
+		A persistent connection requires the client to know where
+		the response body ends, which means the response must either have
+		Content-Length, be chunked or have no body at all.
+		- framed:bool=None -> Whether the caller already knows the body is framed.
+		                      None = look at the headers
 		"""
+		if not self.request.keep_alive:
+			return False
+
+		# Too much unread body left in the socket
+		if self.request.body_unread > self.srv_res.cfg['keep_alive']['max_drain']:
+			return False
 
-		# send response code
-		self.cl_con.sendall(
-			f"""HTTP/1.1 {self.srv_res.response_codes.get(self.code, self.code)}\r\n""".encode()
+		# No body, whatever the headers say
+		if self.code < 200 or self.code in (204, 304) or self.request.method == 'head':
+			return True
+
+		if framed is not None:
+			return framed
+
+		return (
+			'content-length' in self.headers
+			or
+			str(self.headers['transfer-encoding']).lower() == 'chunked'
 		)
 
+	# Dump headers and response code to the client
+	def send_preflight(self, payload:bytes|None=None):
+		"""
+		Dump headers and response code to the client.
+		The status line and all the headers are assembled
+		into a single buffer and written together with the payload
+		(if any) in one go: one syscall, as few packets as possible.
+		- payload:bytes=None -> Response body (or the beginning of it)
+		"""
+
 		# important todo: better way of achieving this
 		if self.content_type:
 			self.headers['Content-Type'] = self.content_type
@@ -467,17 +813,104 @@ class ServerResponse:
 		if self.timings.enable_header:
 			self.headers['Server-Timing'] = self.timings.as_header()
 
-		# send headers
-		for hbytes in self.headers.progrssive_construct():
-			self.cl_con.sendall(hbytes)
-
-		# Send an extra \r\n to indicate the end of headers
-		self.cl_con.sendall('\r\n'.encode())
+		# Tell the client whether the connection persists
+		self.keep_conn = self.eval_keep_conn()
+		if self.keep_conn:
+			ka_cfg = self.srv_res.cfg['keep_alive']
+			self.headers['Connection'] = 'keep-alive'
+			self.headers['Keep-Alive'] = (
+				f"""timeout={ka_cfg['idle_timeout']}, max={ka_cfg['max_requests'] - self.request.rq_num}"""
+			)
+		else:
+			self.headers['Connection'] = 'close'
+
+		head = b''.join((
+			# response code
+			f"""HTTP/1.1 {self.srv_res.response_codes.get(self.code, self.code)}\r\n""".encode(),
+			# headers
+			*self.headers.progrssive_construct(),
+			# an extra \r\n to indicate the end of headers
+			b'\r\n',
+		))
+
+		if self.request.method == 'head':
+			self.write(head)
+			self.drop_body()
+		elif payload:
+			self.write(head, payload)
+		else:
+			# The body follows separately (sendfile, chunks).
+			# Hold the head back till there's a full packet to send
+			self.request.cork()
+			self.write(head)
 
 		# important todo: There's a built-in way to make functions only fire once
 		# Yes, BUT, it costs A LOT of time and effort for the machine
 		# Such a simple buttplug is WAY more efficient
-		self.send_preflight = lambda: None
+		self.send_preflight = self._send_payload
+
+	def _send_payload(self, payload:bytes|None=None):
+		"""send_preflight() after the headers are already sent"""
+		if payload:
+			self.write(payload)
+
+	def drop_body(self):
+		"""\
+		Responses to HEAD requests have no body, but the headers
+		stay exactly the same as for GET (Content-Length included).
+		Everything written after the head is discarded,
+		otherwise the client would take the body for the next response
+		on a persistent connection.
+		"""
+		self.write = self.write_file = self._discard
+
+	def _discard(self, *args):
+		pass
+
+	def flush_prebuilt(self, code:int, head:bytes, body:bytes=b'') -> bool:
+		"""\
+		Send a prebuilt response (see prebuilt_responses) in one write
+		and terminate.
+		- head -> Status line, Server and the headers describing the body
+		- body -> The body (if any)
+
+		The headers set so far are appended to the prebuilt ones.
+		Returns False if that's not possible (the headers are already sent,
+		Server-Timing is enabled or the headers clash with the prebuilt ones),
+		the caller should take the regular route then.
+		"""
+		if 'send_preflight' in self.__dict__ or self.timings.enable_header:
+			return False
+
+		fields = self.headers.fields
+		if not fields or fields[0] != ('server', 'Jag'):
+			return False
+
+		extra = b''
+		if len(fields) > 1:
+			headers = self.headers
+			if (
+				len(headers.index['server']) > 1
+				or 'content-length' in headers
+				or 'content-type' in headers
+				or 'transfer-encoding' in headers
+			):
+				return False
+			extra = b''.join(
+				f"""{jag_http_ents.cased_hname(hname)}: {hval}\r\n""".encode() for hname, hval in fields[1:]
+			)
+
+		self.code = code
+		self.keep_conn = self.eval_keep_conn(framed=True)
+		self.write(
+			head,
+			extra,
+			self.srv_res.prebuilt.connection_tail(self.keep_conn, self.request.rq_num),
+			body if self.request.method != 'head' else b''
+		)
+		self.send_preflight = self._send_payload
+		self.request.terminate()
+		return True
 
 	def send_headers_only(self):
 		"""\
@@ -491,6 +924,17 @@ class ServerResponse:
 		self.send_preflight()
 		self.request.terminate()
 
+	def send_not_modified(self):
+		"""\
+		Tell the client its cached copy is still good (304).
+		Only headers are sent, the validators (ETag, Last-Modified)
+		should already be among them.
+		"""
+		self.code = 304
+		self.content_type = None
+		self.send_preflight()
+		self.request.terminate()
+
 	def mark_as_xfiles(self, filename):
 		"""
 		This is needed if you want the response body to be treated
@@ -525,18 +969,36 @@ class ServerResponse:
 		if not isinstance(data, bytes):
 			raise TypeError(f'data must be of type bytes, not {type(data)}')
 
+		data = self.encode_body(data)
+
 		# important todo: the response should either be chunked or have Content-Length header
 		self.headers['Content-Length'] = len(data)
 
-		# send headers
-		self.send_preflight()
-
-		# send the body
-		self.cl_con.sendall(data)
+		# send headers and the body in one go
+		self.send_preflight(data)
 
 		# terminate
 		self.request.terminate()
 
+	def encode_body(self, data:bytes) -> bytes:
+		"""\
+		Compress the body according to Accept-Encoding,
+		if it's big enough and of a compressible type.
+		Sets Content-Encoding and Vary headers.
+		"""
+		encoder = self.srv_res.content_encoding
+		if not (encoder and self.compress) or 'content-encoding' in self.headers:
+			return data
+
+		if encoder.compressible(self.content_type):
+			self.headers['Vary'] = 'Accept-Encoding'
+
+		encoding, data = encoder.encode_body(data, self.content_type, self.request.headers['accept-encoding'])
+		if encoding:
+			self.headers['Content-Encoding'] = encoding
+
+		return data
+
 	def flush_json(
 		self,
 		jdata:tuple|list|dict|set,
@@ -603,10 +1065,20 @@ class ServerResponse:
 
 		self.headers['Transfer-Encoding'] = 'chunked'
 
+		# Chunks are compressed on the fly, if possible
+		compressor = None
+		encoder = self.srv_res.content_encoding
+		if encoder and self.compress and not 'content-encoding' in self.headers:
+			encoding, compressor = encoder.stream(self.content_type, self.request.headers['accept-encoding'])
+			if encoder.compressible(self.content_type):
+				self.headers['Vary'] = 'Accept-Encoding'
+			if encoding:
+				self.headers['Content-Encoding'] = encoding
+
 		# It's impossible to stream multiple groups of chunks
 		self.send_preflight()
 
-		return ChunkStreamToClient(self.request, self.cl_con, self_terminate)
+		return ChunkStreamToClient(self.request, self.cl_con, self_terminate, compressor)
 
 
 	def stream_bytes(self, length:int, self_terminate:bool=True):
@@ -632,32 +1104,43 @@ class ServerResponse:
 		return ByteStreamToClient(self.request, self.cl_con, self_terminate)
 
 
+	def send_file(self, fbuf, offset:int=0, count:int|None=None, self_terminate:bool=True):
+		"""\
+		Send a (part of a) file with known length in one go.
+		Regular files are sent with zero-copy sendfile,
+		the data never passes through python.
+		Other buffers fall back to regular reads.
+
+		- Set Content-Length header.
+		- Dump headers.
+		- Send count bytes starting at offset
+		  (till the end of the buffer if count is None).
+		"""
+		if count is None:
+			count = fbuf.seek(0, 2) - offset
+
+		with self.stream_bytes(count, self_terminate) as stream:
+			stream.send_file(fbuf, offset, count)
+
 	def stream_buffer(self, tgt_buf, chunked:bool=False, buf_size:int=None):
 		"""\
 		Automatically stream a buffer to the client in small chunks.
 
 		    chunked=False: Seek to the end of the buffer to
 		determine its length, set Content-Length header
-		and gradually stream the buffer.
+		and send the buffer (with sendfile, if it's a file).
 
 		    chunked=True: Don't seek the buffer, set Transfer-Encoding
 		to 'chunked' and stream the buffer while there's data to be read.
 		"""
-		clen = None
-
-		# The response is EITHER chunked OR has Content-Length
-		if chunked:
-			self.headers['Transfer-Encoding'] = 'chunked'
-		else:
-			clen = tgt_buf.seek(0, 2)
-
-		# first - dump headers
-		# self.send_preflight()
+		if not chunked:
+			self.send_file(tgt_buf, 0, tgt_buf.seek(0, 2))
+			return
 
 		# Move the carret to the very beginning of the buffer
 		tgt_buf.seek(0, 0)
 		# stream chunks
-		with self.stream_chunks(content_length=clen) as stream:
+		with self.stream_chunks() as stream:
 			while True:
 				# read chunk
 				chunk = tgt_buf.read(
@@ -670,47 +1153,201 @@ class ServerResponse:
 
 
 	# Serve specified buffer according to the Range header
-	# important todo: This is 100% raw/bare, basically experimental
-	# nothing is checked or validated
-	def serve_range(self, buf):
+	def serve_range(self, buf, byterange:jag_http_ents.ByteRange=None):
+		"""\
+		Serve parts of a seekable buffer according to the Range header.
+		- Unsatisfiable ranges result into 416 with Content-Range: bytes */size
+		- A single range is sent as-is with Content-Range and Content-Length
+		- Multiple ranges are sent as multipart/byteranges
+		  (still with known Content-Length)
+		Regular files are sent with sendfile.
+		"""
+		byterange = byterange or self.request.byterange
+		buf_size = buf.seek(0, 2)
+		ranges = byterange.resolve(buf_size)
+
+		conlog('Serving partial content', byterange.ranges, '->', ranges)
+
+		if not ranges:
+			self.headers['Content-Range'] = jag_http_ents.ByteRange.unsatisfied_range(buf_size)
+			self.request.reject(416)
+			return
+
 		# Set code to partial-content
 		self.code = 206
-		# It'd be stupid not to do it this way...
-		self.headers['Transfer-Encoding'] = 'chunked'
-		self.send_preflight()
 
-		buf_size = buf.seek(0, 2)
+		if len(ranges) == 1:
+			start, end = ranges[0]
+			self.headers['Content-Range'] = jag_http_ents.ByteRange.content_range(start, end, buf_size)
+			self.send_file(buf, start, (end - start) + 1)
+			return
 
-		# begin streaming
-		with self.stream_chunks() as stream:
-			# stream all chunk groups
-			# (order is preserved)
-			for chunk_start, chunk_end in self.request.byterange:
-				# Python is amazing: array[37:None] is a valid syntax
-				_start = chunk_start
-				_end = chunk_end or buf_size
+		# Multiple ranges.
+		# Every part has its own small header,
+		# precalculate all of them to know the total length
+		boundary = self.srv_res.pylib.base64.b32encode(os.urandom(15)).decode()
+		part_type = self.content_type or 'application/octet-stream'
+		parts = []
+		for idx, (start, end) in enumerate(ranges):
+			part_head = (
+				('' if idx == 0 else '\r\n')
+				+
+				f'--{boundary}\r\n'
+				f'Content-Type: {part_type}\r\n'
+				f'Content-Range: {jag_http_ents.ByteRange.content_range(start, end, buf_size)}\r\n'
+				'\r\n'
+			).encode()
+			parts.append((part_head, start, (end - start) + 1))
+		closing = f'\r\n--{boundary}--\r\n'.encode()
+
+		self.content_type = f'multipart/byteranges; boundary={boundary}'
+		total_length = sum(len(head) + count for head, start, count in parts) + len(closing)
+
+		with self.stream_bytes(total_length) as stream:
+			for part_head, start, count in parts:
+				stream.send(part_head)
+				stream.send_file(buf, start, count)
+			stream.send(closing)
+
+
+
+class ClientStream:
+	"""\
+	Buffered reader over the client connection.
 
-				conlog('Serving partial content', self.request.byterange, _start, _end)
+	Bytes received ahead of time are kept in the buffer
+	and served before touching the socket again:
+	    - The request head already read by the event loop engine
+	    - Body bytes which arrived together with the header
+	    - Pipelined requests
 
-				# If only end is specified - stream suffix
-				# Todo: current implementation requires calculating
-				# start offset, which means that buffer should be of known size
-				if chunk_end and not chunk_start:
-					_end = buf_size
-					_start = _end - chunk_end
+	This means that the stream must live as long as the connection
+	and everything that reads from the client should go through it.
+	"""
+	def __init__(self, cl_con:socket.socket, prefix_data:bytes=b'', recv_size:int=65536):
+		self.cl_con:socket.socket = cl_con
+		self.buf:bytearray = bytearray(prefix_data or b'')
+		self.recv_size:int = recv_size
+
+		# perf_counter_ns() of the moment the connection was accepted
+		self.accepted_ns:int = time.perf_counter_ns()
+		# perf_counter_ns() of the moment the last request head was complete
+		self.head_received_ns:int = self.accepted_ns
+		# Same moment, wall clock (time.time()). Goes into the access log
+		self.head_received_at:float = time.time()
+
+		# Sockets are read into this block with recv_into,
+		# no new bytes object is allocated per recv call
+		self._recv_block:bytearray = bytearray(recv_size)
+		self._recv_view:memoryview = memoryview(self._recv_block)
+
+	def fill(self) -> bool:
+		"""\
+		Receive more data from the socket into the buffer.
+		Returns False if the client has closed the connection.
+		"""
+		received = self.cl_con.recv_into(self._recv_view)
+		if not received:
+			return False
+		self.buf += self._recv_view[:received]
+		return True
 
-				aligned_reader = AlignedBufReader(buf, _start, _end)
-				while True:
-					data = aligned_reader.read(self.srv_res.cfg['buffers']['bufstream_chunk_len'])
-					if not data:
-						break
-					stream.send(data)
+	def read_head(self, maxsize:int) -> bytes:
+		"""\
+		Receive a complete request head: start line and header fields,
+		without the terminating empty line.
+		Whatever follows the head (body, pipelined requests)
+		stays in the buffer.
+
+		The socket is read in big blocks and the buffer is only scanned
+		for the terminator, nothing is parsed here.
+		    - Raises HeaderFieldsTooLarge if the head exceeds maxsize.
+		    - Raises StopExecution if the connection was closed.
+		"""
+		buf = self.buf
+		search_from = 0
+		while True:
+			# Empty lines in front of a request must be ignored (RFC 9112 2.2)
+			while buf.startswith(b'\r\n'):
+				del buf[:2]
+				search_from = 0
+
+			head_end = buf.find(b'\r\n\r\n', search_from)
+			if head_end >= 0:
+				if head_end > maxsize:
+					self._head_overflow(maxsize)
+				head = bytes(buf[:head_end])
+				del buf[:head_end + 4]
+				# Request latency is counted from here
+				self.head_received_ns = time.perf_counter_ns()
+				self.head_received_at = time.time()
+				return head
+
+			if len(buf) > maxsize:
+				self._head_overflow(maxsize)
+
+			# The terminator may be split between 2 recv calls
+			search_from = max(0, len(buf) - 3)
+			if not self.fill():
+				raise StopExecution(
+					'Connection closed while reading the request head'
+				)
+
+	def _head_overflow(self, maxsize:int):
+		# The head is as complete as it's going to get,
+		# the rejection is counted from here
+		self.head_received_ns = time.perf_counter_ns()
+		self.head_received_at = time.time()
+		raise HeaderFieldsTooLarge(f'Request head exceeds {maxsize} bytes')
+
+	def take(self, amount:int) -> bytes:
+		"""Pop n bytes from the beginning of the buffer"""
+		data = bytes(self.buf[:amount])
+		del self.buf[:amount]
+		return data
+
+	def readline(self, maxsize:int=-1) -> bytes:
+		"""\
+		Read till (and including) b'\\n' or till maxsize is reached.
+		Empty bytes mean the connection was closed.
+		"""
+		search_from = 0
+		while True:
+			line_end = self.buf.find(b'\n', search_from)
+			if line_end >= 0:
+				if maxsize > 0:
+					return self.take(min(line_end + 1, maxsize))
+				return self.take(line_end + 1)
+
+			if maxsize > 0 and len(self.buf) >= maxsize:
+				return self.take(maxsize)
+
+			search_from = len(self.buf)
+			if not self.fill():
+				return self.take(len(self.buf))
+
+	def read(self, amount:int=4096) -> bytes:
+		"""\
+		Read at most n bytes.
+		The buffer is exhausted first, then the socket is read directly.
+		"""
+		if self.buf:
+			return self.take(amount)
+		return self.cl_con.recv(amount)
 
+	def close(self):
+		"""\
+		The stream belongs to the connection,
+		readers must not close it.
+		"""
+		pass
 
 
 class HeaderFields:
 	"""\
 	Collect header fields from a client connection.
+	Only used for the headers of multipart form parts,
+	request heads are read with ClientStream.read_head().
 	First initialize the class and then call collect() function
 	    - cl_con - client connection.
 	    - maxsize - max size of the header fields in bytes
@@ -791,7 +1428,7 @@ class BodyByteStreamReader:
 		self.response:ServerResponse = response
 		self.total_length:int = total_length
 		self.progress:int = 0
-		self.socket_file = self.request.cl_con.makefile('rb', buffering=0)
+		self.socket_file:ClientStream = self.request.cl_stream
 
 	def __enter__(self):
 		return self
@@ -804,12 +1441,17 @@ class BodyByteStreamReader:
 
 		allowance:int = amount
 		if self.total_length:
-			if self.total_length >= self.progress:
+			if self.progress >= self.total_length:
 				return b''
 			allowance = clamp(amount, 0, self.total_length - self.progress)
+		elif self.request.keep_alive:
+			# Requests without Content-Length have no body.
+			# Reading till EOF would hang a persistent connection forever
+			return b''
 
 		chunk = self.socket_file.read(allowance)
-		self.progress += allowance
+		self.progress += len(chunk)
+		self.request.body_consumed += len(chunk)
 		return chunk
 
 
@@ -828,7 +1470,7 @@ class ProgressiveBodyReader:
 		Content-Length...
 		"""
 
-		content_length = self.request.headers.get('content-length') or 0
+		content_length = int(self.request.headers['content-length'] or 0)
 
 		if not content_length and not no_length_ok:
 			if autoreject:
@@ -888,24 +1530,59 @@ class ClientRequestBodyInfo:
 
 # important todo: easy OPTIONS negotiation controls
 class ClientRequest:
-	def __init__(self, cl_con:socket.socket, cl_addr:tuple[str, int], srv_res, timing_api):
+	def __init__(
+		self,
+		cl_con:socket.socket,
+		cl_addr:tuple[str, int],
+		srv_res,
+		timing_api,
+		rq_num:int=1,
+		cl_stream:ClientStream=None
+	):
 		self.cl_con =  cl_con
 		self.cl_addr = cl_addr
 		self.srv_res = srv_res
 		self.timings = timing_api
 
+		# Everything that reads from the client goes through the stream,
+		# it may already contain data
+		self.cl_stream:ClientStream = cl_stream or ClientStream(cl_con)
+
+		# Sequential number of this request within the connection
+		self.rq_num:int = rq_num
+
 		# Keep track of request termination
 		# For instance, request may be terminated while collecting header fields
 		self.terminated:bool = False
 
+		# Evaluated from the start line.
+		# Empty if the request got rejected before that
+		self.method:str = ''
+		self.path:str = ''
+		self.protocol:str = ''
+
+		# Whether the client wants (and is allowed) to reuse the connection.
+		# Stays False unless the request was evaluated successfully
+		self.keep_alive:bool = False
+
+		# The amount of body bytes read from the socket so far
+		self.body_consumed:int = 0
+		# Size of the request head, terminator included
+		self.head_size:int = 0
+
+		# Whether TCP_CORK is currently set on the socket
+		self.corked:bool = False
+
+		# Typed parameters from the route path, like <int:id>
+		self.path_params:dict = {}
+
 		# create empty storage for header fields
 		self.headers:jag_http_ents.HTTPHeaders = jag_http_ents.HTTPHeaders()
 
 		# Initialize the response class
 		# Early init of this class is needed
 		# for rejecting certain requests
-		with self.timings.record('rsp_class_init', _internal=True):
-			self.response = ServerResponse(self, cl_con, srv_res)
+		self.response = ServerResponse(self, cl_con, srv_res)
 
 		self._byterange = None
 
@@ -914,9 +1591,19 @@ class ClientRequest:
 		# It's client's responsibility to perform good requests
 		try:
 			self.eval_request()
+		except (StopExecution, ConnectionError, TimeoutError) as e:
+			# The client either went away or never sent anything.
+			# There's nobody to reject
+			raise e
+		except HeaderFieldsTooLarge as e:
+			# Whatever is left of the head is still in the socket,
+			# the connection can't be reused
+			conlog(e)
+			self.timings.restart(self.cl_stream.head_received_ns)
+			self.reject(431)
 		except Exception as e:
 			self.reject(400)
-			conlog(traceback_to_text(e))
+			conlog_lazy(traceback_to_text, e)
 			# raise e
 
 		# now that the request is evaluated - create a body reader class
@@ -928,55 +1615,39 @@ class ClientRequest:
 
 	# Request evaluation is a dedicated function for easier error handling
 	def eval_request(self):
-		# io = self.srv_res.pylib.io
-		# sys = self.srv_res.pylib.sys
-		urllib = self.srv_res.pylib.urllib
-		Path = self.srv_res.pylib.Path
-
 		# Fully custom method of receiving the Request Header
-		# gives a lot of benefits (as well as causing mental retardation)
-		with self.timings.record('collect_hbuf', _internal=True):
-			header_buffer = HeaderFields(self.cl_con, self.srv_res.cfg['buffers']['max_header_len'])
-			header_buffer.collect()
-
-
-		with self.timings.record('eval_hbuf', _internal=True):
-			header_fields = header_buffer.lines
-			conlog(iterable_to_grouped_text(header_fields, 'Decoded Header Fields'))
-
-			# First line of the header is always [>request method< >path< >http version<]
-			# It's up to the client to send valid data
-			self.method, self.path, self.protocol = header_fields[0].split(' ')
-			conlog(iterable_to_grouped_text((self.method, self.path, self.protocol), 'Top Field'))
-			self.method = self.method.lower()
-
-			# deconstruct the url into components
-			parsed_url = urllib.parse.urlparse(self.path)
+		# gives a lot of benefits (as well as causing mental retardation).
+		# The whole head is received in big blocks first, then parsed in one go
+		head = self.cl_stream.read_head(self.srv_res.cfg['buffers']['max_header_len'])
+		self.head_size = len(head) + 4
+		# The head phase starts once the head is complete.
+		# Waiting for the client (keep-alive idling) doesn't count
+		self.timings.restart(self.cl_stream.head_received_ns)
 
-			# important todo: lazy processing
-			# first - evaluate query params
-			self.query_params = {k:(''.join(v)) for (k,v) in urllib.parse.parse_qs(parsed_url.query, True).items()}
-			conlog(iterable_to_grouped_text(self.query_params, 'Url params:'))
+		start_line, _, header_block = head.decode().partition('\r\n')
 
-			# then, evaluate path
-			decoded_url_path = urllib.parse.unquote(parsed_url.path)
-			self.abspath = self.srv_res.doc_root / Path(decoded_url_path.lstrip('/'))
-			self.relpath = Path(decoded_url_path.lstrip('/'))
-			self.trimpath = decoded_url_path
+		# First line of the header is always [>request method< >path< >http version<]
+		# It's up to the client to send valid data
+		self.method, self.path, self.protocol = start_line.split(' ')
+		self.method = self.method.lower()
 
-			# Delete the first line as it's no longer needed
-			del header_fields[0]
+		# get remaining headers
+		self.headers = jag_http_ents.HTTPHeaders.from_block(header_block)
 
-			# get remaining headers
-			self.headers = jag_http_ents.HTTPHeaders(header_fields)
+		# Everything else (query params, paths, cookies)
+		# is only evaluated if somebody asks for it.
+		# See the properties below
 
-			# init cookies
-			self.cookies = jag_http_ents.Cookies(self.headers, self.response.headers)
-
-			conlog(iterable_to_grouped_text(self.headers.fields, 'Request headers:'))
-			conlog(iterable_to_grouped_text(self.cookies.request_cookies.kv_dict, 'Cookies:'))
+		# Don't even format the debug output if nobody's going to see it
+		if conlog_enabled():
+			conlog_lazy(iterable_to_grouped_text, head.decode().split('\r\n'), 'Decoded Header Fields')
+			conlog_lazy(iterable_to_grouped_text, (self.method, self.path, self.protocol), 'Top Field')
+			conlog_lazy(iterable_to_grouped_text, self.query_params, 'Url params:')
+			conlog_lazy(iterable_to_grouped_text, self.headers.fields, 'Request headers:')
+			conlog_lazy(iterable_to_grouped_text, self.cookies.request_cookies.kv_dict, 'Cookies:')
 
 
+		self.keep_alive = self.eval_keep_alive()
 
 		# WSS
 		# todo: does this really belong here ?
@@ -999,28 +1670,108 @@ class ClientRequest:
 
 
 
+	def eval_keep_alive(self) -> bool:
+		"""\
+		Whether the connection could be reused after this request:
+		    - HTTP/1.1 connections persist, unless the client sent "Connection: close"
+		    - HTTP/1.0 connections only persist with "Connection: keep-alive"
+		"""
+		ka_cfg = self.srv_res.cfg['keep_alive']
+		if not ka_cfg['enabled'] or self.rq_num >= ka_cfg['max_requests']:
+			return False
+
+		# Chunked request bodies are not supported,
+		# there's no way of telling where the next request starts
+		if self.headers['transfer-encoding']:
+			return False
+
+		connection = (self.headers['connection'] or '').lower()
+		if self.protocol.upper() == 'HTTP/1.1':
+			return not 'close' in connection
+		else:
+			return 'keep-alive' in connection
+
+	@property
+	def body_unread(self) -> int:
+		"""The amount of declared body bytes still sitting in the socket"""
+		try:
+			content_length = int(self.headers['content-length'] or 0)
+		except ValueError:
+			return 0
+		return max(0, content_length - self.body_consumed)
+
+
 	# Actions
 	# =================
 
 	# Properly collapse the tunnel between server and client
+	# (unless the connection persists)
+	def cork(self):
+		"""\
+		Hold back partial packets till uncork()
+		(only if tcp_policy is set to 'cork' and the platform supports it).
+		"""
+		if self.corked or not CORK_AVAILABLE:
+			return
+		if self.srv_res.cfg['buffers']['tcp_policy'] != 'cork':
+			return
+		try:
+			self.cl_con.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+			self.corked = True
+		except OSError:
+			pass
+
+	def uncork(self):
+		"""Flush whatever has been held back by cork()"""
+		if not self.corked:
+			return
+		try:
+			self.cl_con.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+		except OSError:
+			pass
+		self.corked = False
+
 	def terminate(self):
+		# The response is complete, flush the last partial packet
+		self.uncork()
 		# socket = self.srv_res.pylib.socket
-		self.cl_con.shutdown(socket.SHUT_RDWR)
-		self.cl_con.close()
+		if not self.response.keep_conn:
+			self.cl_con.shutdown(socket.SHUT_RDWR)
+			self.cl_con.close()
 		self.terminated = True
 		# Termination is only possible once
 		self.terminate = lambda: None
 
+	def drain_body(self) -> bool:
+		"""\
+		Discard whatever body the room didn't read,
+		so that the next request on this connection starts
+		at the right place.
+		Returns False if the connection can no longer be reused.
+		"""
+		remaining = self.body_unread
+		if remaining > self.srv_res.cfg['keep_alive']['max_drain']:
+			return False
+
+		while remaining > 0:
+			chunk = self.cl_stream.read(min(remaining, 65536))
+			if not chunk:
+				return False
+			remaining -= len(chunk)
+			self.body_consumed += len(chunk)
+
+		return True
+
 	# Send a very simple html document
 	# with a short description of the provided Status Code
 	def reject(self, code:int=401, hint:str=''):
-		self.response.code = code
+		prebuilt = self.srv_res.prebuilt
 		self.response.content_type = 'text/html'
-		self.response.flush_bytes(
-			self.srv_res.reject_precache
-			.replace(b'$$reason', self.srv_res.response_codes.get(code, f'{code} ERROR').encode())
-			.replace(b'$$hint', str(hint).encode())
-		)
+		if not hint and self.response.flush_prebuilt(code, *prebuilt.reject(code)):
+			return
+
+		self.response.code = code
+		self.response.flush_bytes(prebuilt.body(code, hint))
 
 	# Send a redirection response (codes 300)
 	def redirect(self, target, reason:int=7, softlink:bool=False):
@@ -1031,10 +1782,16 @@ class ClientRequest:
 		- reason: 0-8 (300, 301, 302...), default to 7 (307)
 		- softlink: False = Location. True = Content-Location
 		"""
-		# self.srv_res.response_codes.get
-		reason_picker = {code:(300+code) for code in range(7)}
-		self.response.code = reason_picker.get(reason, 307)
-		self.response.headers['Location' if softlink else 'Content-Location'] = str(target)
+		reason_picker = {code:(300+code) for code in range(9)}
+		code = reason_picker.get(reason, 307)
+		self.response.headers['Content-Location' if softlink else 'Location'] = str(target)
+		self.response.content_type = None
+		if self.response.flush_prebuilt(code, self.srv_res.prebuilt.redirect(code)):
+			return
+
+		self.response.code = code
+		# No body
+		self.response.headers['Content-Length'] = 0
 
 		self.response.send_preflight()
 		self.terminate()
@@ -1107,36 +1864,75 @@ class ClientRequest:
 	# Processed headers
 	# =================
 
+	# Lazy request attributes
+	# Evaluated on first access and cached.
+	# Static files never need query params or cookies,
+	# so there's no point in parsing them for every request
+	# =================
+
+	@functools.cached_property
+	def url_parts(self) -> tuple[str, str]:
+		"""\
+		(raw path, raw query string) of the request target.
+		Regular "/path?query" targets are simply split,
+		absolute-form targets ("http://host/path") go through urllib.
+		"""
+		if self.path.startswith('/'):
+			path, _, query = self.path.partition('?')
+			return path, query.partition('#')[0]
+
+		parsed_url = self.srv_res.pylib.urllib.parse.urlsplit(self.path)
+		return parsed_url.path, parsed_url.query
+
+	@functools.cached_property
+	def query_params(self) -> dict[str, str]:
+		"""Url params as {name:value}"""
+		query = self.url_parts[1]
+		if not query:
+			return {}
+		return {
+			k:(''.join(v)) for (k,v)
+			in self.srv_res.pylib.urllib.parse.parse_qs(query, True).items()
+		}
+
+	@functools.cached_property
+	def trimpath(self) -> str:
+		"""Decoded url path, eg "/some folder/file.txt" """
+		return self.srv_res.pylib.urllib.parse.unquote(self.url_parts[0])
+
+	@functools.cached_property
+	def relpath(self):
+		"""Url path as a relative Path object"""
+		return self.srv_res.pylib.Path(self.trimpath.lstrip('/'))
+
+	@functools.cached_property
+	def abspath(self):
+		"""Url path resolved against the doc root"""
+		return self.srv_res.doc_root / self.relpath
+
+	@functools.cached_property
+	def cookies(self) -> jag_http_ents.Cookies:
+		"""Request cookies + the ability to set response cookies"""
+		return jag_http_ents.Cookies(self.headers, self.response.headers)
+
 	# A client may ask for an access to a specific chunk of the target file.
 	# In this case a "Range" header is present.
-	# It has a format of start-end (both inclusive)
-	# This function returns an evaluated tuple from the following header.
-	# If "Range" header is not present - None is returned.
-	# Tuple format is as follows: (int|None, int|None)
-	# Negative numbers are clamped to 0
-	# important todo: byterange should be a class
+	# It has a format of bytes=start-end (both inclusive)
+	# See jag_http_ents.ByteRange
 	@property
-	def byterange(self):
-		if self._byterange:
-			return self._byterange
-
-		range_data = self.headers['range']
-		if not range_data:
-			return None
-
-		# todo: it's always assumed that range is in bytes
-		ranges = range_data.split('=')[1].split(',')
-
-		self._byterange = []
-		for chunk in ranges:
-			chunk_split = chunk.strip().split('-')
-			rstart = max(int(chunk_split[0]) - 1, 0) if chunk_split[0] else None
-			rend =   max(int(chunk_split[1]) - 1, 0) if chunk_split[1] else None
-			self._byterange.append(
-				(rstart, rend)
-			)
+	def byterange(self) -> jag_http_ents.ByteRange|None:
+		"""\
+		Evaluated "Range" header.
+		None if the header is not present or is malformed
+		(malformed ranges are ignored and the whole thing is served).
+		"""
+		if self._byterange is None:
+			range_data = self.headers['range']
+			if not range_data:
+				return None
+			self._byterange = jag_http_ents.ByteRange(range_data)
 
-		return self._byterange
+		return self._byterange if self._byterange.valid else None
 
 
 
@@ -1163,9 +1959,188 @@ class JagServerIndex:
 # Some of its default services
 
 # Yes, this is a function, not a class. Cry
-def htsession(cl_con, cl_addr, srv_res, route_index=None):
-	import time
-	from easy_timings.mstime import perftest
+def htsession(cl_con, cl_addr, srv_res, route_index=None, accepted_ns:int|None=None):
+	"""\
+	Serve a client connection.
+	With keep-alive the same connection serves requests
+	one after another, till either side decides to close it.
+	Pipelined requests are read from the socket sequentially,
+	which means they're answered in the same order.
+
+	- accepted_ns:int -> perf_counter_ns() of accept(),
+	                     so that the accept phase includes queueing
+	"""
+	ka_cfg = srv_res.cfg['keep_alive']
+	apply_tcp_policy(cl_con, srv_res)
+	cl_stream = ClientStream(cl_con)
+	if accepted_ns:
+		cl_stream.accepted_ns = accepted_ns
+	rq_num = 0
+	if srv_res.metrics:
+		srv_res.metrics.conn_opened()
+
+	try:
+		while True:
+			rq_num += 1
+			if rq_num > 1:
+				# Don't let idle clients occupy the thread forever
+				cl_con.settimeout(ka_cfg['idle_timeout'])
+
+			evaluated_request = serve_request(cl_con, cl_addr, srv_res, route_index, rq_num, cl_stream)
+			if not reuse_connection(evaluated_request):
+				break
+	except Exception as err:
+		conlog('Error while reusing the connection:', err)
+
+	# conlog('        Exiting...', evaluated_request.cl_addr[1])
+	# _rebind('Exiting...')
+	# cl_con.shutdown(2)
+	cl_con.close()
+	if srv_res.metrics:
+		srv_res.metrics.conn_closed()
+
+	# No sys.exit() here: pooled threads must survive the session
+
+
+def reuse_connection(evaluated_request:ClientRequest|None) -> bool:
+	"""\
+	Whether the connection could serve another request after this one.
+	Only reuse the connection if the response was complete
+	and the request body (if any) is fully consumed.
+	"""
+	if not evaluated_request:
+		return False
+	if not evaluated_request.terminated or not evaluated_request.response.keep_conn:
+		return False
+	return evaluated_request.drain_body()
+
+
+def serve_metrics(evaluated_request:ClientRequest):
+	"""\
+	Answer with the metrics of the whole server
+	(Prometheus text format).
+	"""
+	response = evaluated_request.response
+	if not evaluated_request.method in ('get', 'head'):
+		response.headers['Allow'] = 'GET, HEAD'
+		evaluated_request.reject(405)
+		return
+
+	response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+	response.headers['Cache-Control'] = 'no-store'
+	if evaluated_request.method == 'head':
+		# Not worth aggregating all the workers for nothing
+		response.send_preflight()
+		evaluated_request.terminate()
+		return
+
+	response.flush_bytes(evaluated_request.srv_res.metrics.render().encode())
+
+
+def record_metrics(ev_rq:ClientRequest, route_info, metrics_rq:bool, duration:float):
+	"""\
+	Count a served request in the metrics of this worker.
+	    - duration:float -> milliseconds
+	"""
+	srv_res = ev_rq.srv_res
+	metrics = srv_res.metrics
+	if metrics_rq:
+		route_slot = metrics.route_slot(srv_res.cfg['metrics']['path'])
+	else:
+		route_slot = metrics.route_slot(route_info.path if route_info else None, bool(route_info))
+
+	metrics.observe_request(
+		route_slot,
+		ev_rq.response.code,
+		duration / 1000,
+		ev_rq.response.bytes_sent,
+		ev_rq.head_size + ev_rq.body_consumed
+	)
+	metrics.observe_phases(ev_rq.timings.phase_ns, skip_accept=ev_rq.rq_num > 1)
+
+	# Queue depth is only known to this worker,
+	# so it's published along with every request
+	if srv_res.worker_pool:
+		metrics.pool_state(srv_res.worker_pool.queue_depth, srv_res.worker_pool.busy)
+
+
+def log_request(ev_rq:ClientRequest, route_info, duration:float, failed:bool=False):
+	"""\
+	Send the access log record of a request, if the sampler picks it.
+	    - duration:float -> milliseconds
+	"""
+	srv_res = ev_rq.srv_res
+	if not srv_res.log_sampler:
+		return
+
+	sample_rate = srv_res.log_sampler.sample(
+		route_info.path if route_info else None,
+		ev_rq.response.code,
+		duration,
+		failed
+	)
+	# Most of the requests may not need to be logged at all
+	if sample_rate is None:
+		return
+
+	LogRecord(1, {
+		# When the request arrived (not when the connection
+		# got free after the previous one)
+		'time': ev_rq.cl_stream.head_received_at,
+		'addr_info': ev_rq.cl_addr[:2],
+		'method': ev_rq.method,
+		'httpver': ev_rq.protocol,
+		'path': ev_rq.trimpath,
+		'usragent': ev_rq.headers['user-agent'],
+		'ref': ev_rq.headers['referer'],
+		'rsp_code': ev_rq.response.code,
+		'bytes_sent': ev_rq.response.bytes_sent,
+		# Milliseconds
+		'duration': round(duration, 3),
+		'phases': ev_rq.timings.phases(),
+		'worker': srv_res.worker_idx,
+		'rq_num': ev_rq.rq_num,
+		'sample_rate': sample_rate,
+	}).push()
+
+
+def finish_request(ev_rq:ClientRequest, route_info, metrics_rq:bool, failed:bool=False):
+	"""\
+	Write down a request, whichever way it ended:
+	access log and metrics.
+	"""
+	timings = ev_rq.timings
+	if failed:
+		# Whatever happened till the failure
+		timings.lap(PHASE_HANDLER)
+
+	# Milliseconds, till the response was complete
+	duration = (timings.lap_ns - ev_rq.cl_stream.head_received_ns) / 1_000_000
+
+	log_request(ev_rq, route_info, duration, failed)
+	timings.lap(PHASE_LOG)
+
+	if ev_rq.srv_res.metrics:
+		record_metrics(ev_rq, route_info, metrics_rq, duration)
+
+
+def serve_request(
+	cl_con,
+	cl_addr,
+	srv_res,
+	route_index,
+	rq_num:int=1,
+	cl_stream:ClientStream=None
+):
+	"""\
+	Read, evaluate and execute a single request from the connection.
+	Returns the evaluated request or None if the connection is unusable.
+	"""
+	evaluated_request = None
+	route_info = None
+	metrics_rq = False
+	# Whether the request ended with an exception
+	failed = False
 
 	try:
 		# ----------------
@@ -1175,49 +2150,70 @@ def htsession(cl_con, cl_addr, srv_res, route_index=None):
 		# Init timings
 		timing_api = ServerTimings()
 
-		# the amount of time it took to initialize this worker
-		# todo: this is probably obsolete
-		timing_api.push_record(
-			('devtime', (time.time() - srv_res.devtime)*1000),
-			_internal=True
-		)
-
 		# todo: Shouldn't the timing class take this as an argument?
 		if srv_res.cfg['enable_web_timing_api']:
 			timing_api.enable_in_response(True)
 
-		request_log = {
-			'time': srv_res.pylib.datetime.datetime.now(),
-		}
-
-
 		# ----------------
 		# Eval request
 		# ----------------
-		with timing_api.record('rq_eval', _internal=True):
-			evaluated_request = ClientRequest(cl_con, cl_addr, srv_res, timing_api)
-			response = evaluated_request.response
+		evaluated_request = ClientRequest(cl_con, cl_addr, srv_res, timing_api, rq_num, cl_stream)
+		response = evaluated_request.response
+		timing_api.lap(PHASE_HEAD)
+
+		# How long it took to get to the first request of the connection
+		if rq_num == 1:
+			timing_api.phase_ns[PHASE_ACCEPT] = (
+				evaluated_request.cl_stream.head_received_ns - evaluated_request.cl_stream.accepted_ns
+			)
 
-		conlog('Initialized basic room, evaluated request')
+		# Idle timeout only applies to waiting for the request,
+		# the rest must not block forever either.
+		# (rejected requests may have closed the connection already)
+		if cl_con.fileno() >= 0:
+			cl_con.settimeout(srv_res.cfg['multiprocessing']['read_timeout'] or None)
 
-		# sometimes the connection may be aborted earlier by the client
-		if evaluated_request.terminated:
-			raise ConnectionAbortedError('Connection was aborted early by the client')
+		conlog('Initialized basic room, evaluated request')
 
 
 		# ----------------
 		# Automatic actions
 		# ----------------
-		route_info = route_index.match_route('/' + evaluated_request.relpath.as_posix(), evaluated_request.method)
+		metrics_rq = (
+			not evaluated_request.terminated
+			and bool(srv_res.metrics)
+			and evaluated_request.trimpath == srv_res.cfg['metrics']['path']
+		)
+		if evaluated_request.terminated:
+			# Answered while being evaluated (malformed head, websockets).
+			# Still has to be counted
+			route_match = RouteMatch()
+		elif metrics_rq:
+			# Server metrics go before any of the routes
+			route_match = RouteMatch()
+			serve_metrics(evaluated_request)
+		else:
+			# Pick up the changes in the room modules, if asked to
+			route_index.reload_if_changed()
+			route_match = route_index.match_route(evaluated_request.trimpath, evaluated_request.method)
+
+		route_info = route_match.route
+		evaluated_request.path_params = route_match.params
 
 		# todo: this is very weird
 		# There's further resource initialization even after
 		# .reject() and .send_headers_only()
 
-		# todo: this string comparison is the most retarded thing ever
-		if route_info == 'invalid_method':
+		if evaluated_request.terminated:
+			# Already answered
+			pass
+		elif route_match.method_not_allowed:
 			conlog('Room: invalid method:', evaluated_request.method)
+			response.headers['Allow'] = route_match.allow_header
 			evaluated_request.reject(405)
+		elif not route_info:
+			# No route and no fallback route
+			evaluated_request.reject(404)
 		else:
 			# todo: this else shouldn't be here.
 			# caching (and other entities) should be initialized in a more civilized manner
@@ -1232,12 +2228,14 @@ def htsession(cl_con, cl_addr, srv_res, route_index=None):
 
 		# Treat options
 		# todo: this is incomplete
-		if evaluated_request.method == 'options':
+		if evaluated_request.method == 'options' and not evaluated_request.terminated:
 			access_ctrl = route_info.access_ctrl(evaluated_request.headers, response.headers)
 			access_ctrl.apply_headers()
 			response.headers['Access-Control-Allow-Methods'] = (', '.join(route_info.methods)).upper()
 			response.send_headers_only()
 
+		timing_api.lap(PHASE_ROUTE)
+
 
 		# ----------------
 		# Execute action
@@ -1256,46 +2254,51 @@ def htsession(cl_con, cl_addr, srv_res, route_index=None):
 		# There's a StopExecution exception now
 		# Another exception can also be added
 		# to differentiate better
+		profiled = False
 		if not evaluated_request.terminated:
-			route_info.func(
-				evaluated_request,
-				evaluated_request.response,
-				server_index
-			)
+			profiler = srv_res.profiler
+			if profiler and profiler.active and profiler.should_profile(route_key(route_info)):
+				profiled = True
+				profiler.profile(
+					route_key(route_info),
+					route_info.func,
+					evaluated_request,
+					evaluated_request.response,
+					server_index
+				)
+			else:
+				route_info.func(
+					evaluated_request,
+					evaluated_request.response,
+					server_index
+				)
 
-
-		# ----------------
-		# Write Log
-		# ----------------
-		with perftest('Room logging took'):
-			ev_rq = evaluated_request
-
-			# connection log
-			upd_rec_data = {
-				'addr_info': ev_rq.cl_addr,
-				'method': ev_rq.method,
-				'httpver': ev_rq.protocol,
-				'path': ev_rq.trimpath,
-				'usragent': ev_rq.headers['user-agent'],
-				'ref': ev_rq.headers['referer'],
-				'rsp_code': ev_rq.response.code,
-			}
-
-			# create log record class
-			lrec = LogRecord(1, request_log | upd_rec_data)
-			# send record to the logging server
-			lrec.push()
+		# The room may leave without terminating the request
+		evaluated_request.uncork()
+		timing_api.lap(PHASE_HANDLER)
+		if profiled:
+			srv_res.profiler.account(route_key(route_info), timing_api.phase_ns[PHASE_HANDLER])
 
 
 	# todo: there was a mention of some kind of exception groups
 	# in the latest python versions...
 	except ConnectionAbortedError as err:
 		conlog('Connection was aborted by the client')
+		failed = True
+		return None
 	except ConnectionResetError as err:
 		conlog('Connection was reset by the client')
+		failed = True
+		return None
+	except TimeoutError as err:
+		conlog('Timed out waiting for the client')
+		failed = True
+		return None
 	except StopExecution as err:
 		# Similar trick to StopIteration
-		conlog(f'Stopping execution, because {err}')
+		conlog('Stopping execution, because', err)
+		failed = True
+		return None
 	except Exception as err:
 		# Pro gamer move:
 		# putting "except Exception" after a stack of more specific
@@ -1313,34 +2316,39 @@ def htsession(cl_con, cl_addr, srv_res, route_index=None):
 		# Separate this procedure into a function or something
 		# (originally it was made like that to minimize risk)
 		import traceback, sys
+		failed = True
 		if not type(err) in (StopExecution,):
-			conlog(
-				''.join(
-					traceback.format_exception(
-						type(err),
-						err,
-						err.__traceback__
-					)
-				)
-			)
+			conlog_lazy(traceback_to_text, err)
 
+			response = evaluated_request.response if evaluated_request else None
 			try:
 				if srv_res.cfg['errors']['echo_to_client']:
-					echo_exception_to_client(err, cl_con)
+					sent = echo_exception_to_client(err, cl_con)
+					if response:
+						response.bytes_sent += sent
+				elif response and not 'send_preflight' in response.__dict__:
+					# Don't leave the client hanging
+					response.write(srv_res.prebuilt.closing(500))
 				err_rec = LogRecord(2, traceback_to_text(err))
 				err_rec.push()
 			except Exception as e:
 				pass
 
-		sys.exit()
+			# Unless the headers are out already - it's a server error
+			if response and not 'send_preflight' in response.__dict__:
+				response.code = 500
+				response.keep_conn = False
 
+		return None
 
-	import sys
-	# conlog('        Exiting...', evaluated_request.cl_addr[1])
-	# _rebind('Exiting...')
-	# cl_con.shutdown(2)
-	cl_con.close()
+	finally:
+		# Failed requests still count, if anything was sent
+		if evaluated_request is not None and (not failed or evaluated_request.response.bytes_sent):
+			try:
+				finish_request(evaluated_request, route_info, metrics_rq, failed)
+			except Exception as err:
+				conlog_lazy(traceback_to_text, err)
+				LogRecord(2, traceback_to_text(err)).push()
 
-	# todo: isn't this sys.exit() a bit too hash?
-	sys.exit()
+	return evaluated_request
 
@@ -1,4 +1,4 @@
-import threading, io, time, multiprocessing, socket
+import threading, io, time, socket, os, collections, pickle, marshal, atexit, json, datetime, random
 from jag_util import print_exception
 from pathlib import Path
 
@@ -13,9 +13,37 @@ def print(*args):
 # 	- Log records are sent to the log server through sockets.
 # 	- The port of the log server is stored in os.environ['jag_logging_port']
 # 	- Records can be sent to the log server by various modules of the server.
-# 	- The payload sent to the log server consists of:
+# 	- Every process has a single LogClient, which keeps a persistent
+# 	  connection to the log server and ships the records in batches.
+# 	- The connection is a stream of frames:
 # 		- 4-byte long int indicating the size of the payload
-# 		- Actual payload data: Pickled LogRecord
+# 		- 1 byte: payload encoding (see WIRE_MARSHAL, WIRE_PICKLE)
+# 		- Actual payload data: a list of LogRecords, packed with LogRecord.pack()
+# 		  and marshaled. Pickle is only used if a record contains
+# 		  something marshal can't handle (custom objects).
+
+# Payload encodings of the frames
+WIRE_MARSHAL = b'M'
+WIRE_PICKLE = b'P'
+
+# Access (connection) log records are sent as plain tuples
+# with the values in this order
+ACCESS_FIELDS = (
+	'time',
+	'addr_info',
+	'method',
+	'httpver',
+	'path',
+	'usragent',
+	'ref',
+	'rsp_code',
+	'bytes_sent',
+	'duration',
+	'phases',
+	'worker',
+	'rq_num',
+	'sample_rate',
+)
 
 # There are different log types, see description of LogRecord
 class LogRecord:
@@ -47,30 +75,342 @@ class LogRecord:
 		if isinstance(dtime, str):
 			self.timestamp = dtime
 
+	def pack(self) -> tuple:
+		"""\
+		Compact representation of the record made of builtin types only.
+		See ACCESS_FIELDS
+		"""
+		timestamp = self.timestamp
+		if isinstance(timestamp, datetime.datetime):
+			timestamp = timestamp.timestamp()
+
+		log_data = self.log_data
+		if self.record_type == 1 and isinstance(log_data, dict):
+			log_data = tuple(log_data.get(field) for field in ACCESS_FIELDS)
+
+		return (self.record_type, timestamp, log_data)
+
+	@classmethod
+	def unpack(cls, packed:tuple) -> 'LogRecord':
+		record_type, timestamp, log_data = packed
+
+		record = cls.__new__(cls)
+		record.record_type = record_type
+		record.timestamp = (
+			datetime.datetime.fromtimestamp(timestamp)
+			if isinstance(timestamp, (int, float)) else
+			timestamp
+		)
+		if record_type == 1 and isinstance(log_data, tuple):
+			log_data = dict(zip(ACCESS_FIELDS, log_data))
+		record.log_data = log_data
+
+		return record
+
+	@staticmethod
+	def encode_batch(batch:list['LogRecord']) -> bytes:
+		"""\
+		Records -> frame payload
+		"""
+		try:
+			return WIRE_MARSHAL + marshal.dumps([record.pack() for record in batch])
+		except ValueError:
+			# Something marshal doesn't know about
+			return WIRE_PICKLE + pickle.dumps(batch)
+
+	@classmethod
+	def decode_batch(cls, payload:bytes) -> list['LogRecord']:
+		"""\
+		Frame payload -> records
+		"""
+		encoding, data = payload[:1], payload[1:]
+		if encoding == WIRE_MARSHAL:
+			return [cls.unpack(packed) for packed in marshal.loads(data)]
+		return pickle.loads(data)
+
 	def push(self):
 		"""\
-		Push record to the logging server
+		Push record to the logging server.
+		This never blocks: the record is queued and shipped
+		by the background thread of the LogClient.
 		"""
 		self.push = None
-		import socket, pickle, os, time
 
-		for attempt in range(3):
-			try:
-				# connect to the logger and send logging data
-				with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as skt:
-					logging_port = os.environ.get('jag_logging_port')
-					if not logging_port:
-						return
-					skt.connect(
-						( '127.0.0.1', int(logging_port) )
-					)
-					pdata = pickle.dumps(self)
-					skt.sendall(len(pdata).to_bytes(4, 'little'))
-					skt.sendall(pdata)
+		log_client = LogClient.get()
+		if log_client:
+			log_client.push(self)
+
+
+
+class AccessLogSampler:
+	"""\
+	Decides which requests make it into the access log.
+
+	- Errors (4xx/5xx) are always logged (if always_log_errors)
+	- Failed requests (unhandled errors, aborts) are always logged
+	- Requests slower than slow_ms are always logged
+	- Everything else is logged with a probability of:
+	  route_rates[route path] or status_rates['2xx'] or rate
+
+	Route paths are the ones declared in @JagRoute(path=...).
+	Logged records carry the rate they were sampled with,
+	so the log pipeline can weight them back up.
+	"""
+	def __init__(
+		self,
+		rate:float=1.0,
+		route_rates:dict[str, float]|None=None,
+		status_rates:dict[str, float]|None=None,
+		always_log_errors:bool=True,
+		slow_ms:float=0
+	):
+		self.rate:float = rate
+		self.route_rates:dict[str, float] = dict(route_rates or {})
+		self.status_rates:dict[str, float] = {
+			str(k).lower(): v for k, v in (status_rates or {}).items()
+		}
+		self.always_log_errors:bool = always_log_errors
+		self.slow_ms:float = slow_ms
+
+		# Counters
+		self.logged:int = 0
+		self.skipped:int = 0
+
+	@classmethod
+	def from_config(cls, log_cfg:dict) -> 'AccessLogSampler':
+		return cls(
+			log_cfg['access_sample_rate'],
+			log_cfg['access_sample_routes'],
+			log_cfg['access_sample_status'],
+			log_cfg['always_log_errors'],
+			log_cfg['slow_request_ms'],
+		)
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		return {
+			'logged': self.logged,
+			'skipped': self.skipped,
+		}
+
+	def sample(self, route_path:str|None, code:int, duration:float, failed:bool=False) -> float|None:
+		"""\
+		Returns the sampling rate if the request should be logged,
+		None otherwise
+		"""
+		if (
+			failed
+			or (self.always_log_errors and code >= 400)
+			or (self.slow_ms and duration >= self.slow_ms)
+		):
+			self.logged += 1
+			return 1.0
+
+		rate = self.route_rates.get(route_path)
+		if rate is None:
+			rate = self.status_rates.get(f'{code // 100}xx', self.rate)
+
+		if rate >= 1 or (rate > 0 and random.random() < rate):
+			self.logged += 1
+			return rate
+
+		self.skipped += 1
+		return None
+
+
+
+class LogClient:
+	"""\
+	Ships log records of the current process to the log server.
+
+	Records are queued in a bounded buffer and a background thread
+	sends them over a persistent connection in batches.
+	If the log server can't keep up (or is gone) - the buffer fills up
+	and new records are dropped and counted, instead of blocking the requests.
+
+	There's one client per process, see LogClient.get()
+	"""
+	# Max amount of records waiting to be sent
+	buffer_size:int = 8192
+	# Max amount of records in a single frame
+	batch_size:int = 256
+	# Pause before reconnecting to the log server (seconds)
+	reconnect_delay:float = 1.0
+	# Error records (types 2 and 3) per second, 0 = unlimited
+	error_rate:float = 0
+	# How many error records can go through in a burst
+	error_burst:int = 1
+
+	_instance = None
+	_instance_lock = threading.Lock()
+
+	def __init__(self, port:int):
+		self.port:int = port
+		self.pid:int = os.getpid()
+
+		self.records:collections.deque = collections.deque()
+		self.cond = threading.Condition()
+		self.skt:socket.socket|None = None
+
+		# Counters
+		self.pushed:int = 0
+		self.sent:int = 0
+		self.dropped:int = 0
+		self.batches:int = 0
+		self.reconnects:int = 0
+		self.errors_suppressed:int = 0
+
+		# Token bucket of the error records
+		self._error_tokens:float = float(self.error_burst)
+		self._error_refill:float = time.monotonic()
+		# Suppressed since the last error record that went through
+		self._errors_skipped:int = 0
+
+		threading.Thread(target=self._run, daemon=True).start()
+		atexit.register(self.flush)
+
+	@classmethod
+	def configure(cls, log_cfg:dict):
+		"""\
+		Apply the 'logging' config group.
+		Has to be called in the process that is going to log things
+		"""
+		cls.buffer_size = int(log_cfg['client_buffer'])
+		cls.batch_size = int(log_cfg['client_batch'])
+		cls.error_rate = float(log_cfg['error_rate'])
+		cls.error_burst = max(int(log_cfg['error_burst']), 1)
+
+	@classmethod
+	def get(cls) -> 'LogClient|None':
+		"""\
+		The client of the current process.
+		None if logging is disabled.
+		"""
+		log_client = cls._instance
+		# Forked processes inherit the instance, but not the thread
+		if log_client and log_client.pid == os.getpid():
+			return log_client
+
+		port = os.environ.get('jag_logging_port', '')
+		if not port.isdigit():
+			return None
+
+		with cls._instance_lock:
+			if not cls._instance or cls._instance.pid != os.getpid():
+				cls._instance = cls(int(port))
+			return cls._instance
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		return {
+			'queued': len(self.records),
+			'pushed': self.pushed,
+			'sent': self.sent,
+			'dropped': self.dropped,
+			'batches': self.batches,
+			'reconnects': self.reconnects,
+			'errors_suppressed': self.errors_suppressed,
+		}
+
+	def _error_allowed(self) -> bool:
+		"""\
+		Token bucket: a crash loop shouldn't be able to flood the logger
+		"""
+		if not self.error_rate:
+			return True
+
+		now = time.monotonic()
+		self._error_tokens = min(
+			float(self.error_burst),
+			self._error_tokens + (now - self._error_refill) * self.error_rate
+		)
+		self._error_refill = now
+
+		if self._error_tokens < 1:
+			return False
+		self._error_tokens -= 1
+		return True
+
+	def push(self, record:LogRecord):
+		with self.cond:
+			if len(self.records) >= self.buffer_size:
+				self.dropped += 1
 				return
-			except Exception as e:
-				time.sleep(1)
-				continue
+
+			if record.record_type in (2, 3):
+				if not self._error_allowed():
+					self.errors_suppressed += 1
+					self._errors_skipped += 1
+					return
+				if self._errors_skipped and isinstance(record.log_data, str):
+					record.log_data = f'({self._errors_skipped} error records suppressed before this one)\n{record.log_data}'
+					self._errors_skipped = 0
+			self.records.append(record)
+			self.pushed += 1
+			self.cond.notify()
+
+	def flush(self, timeout:float=1.0):
+		"""\
+		Wait (a little) for the queued records to be sent
+		"""
+		deadline = time.monotonic() + timeout
+		while self.records and time.monotonic() < deadline:
+			time.sleep(0.01)
+
+	def _connect(self):
+		self.skt = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+		self.reconnects += 1
+
+	def _disconnect(self):
+		if self.skt:
+			try:
+				self.skt.close()
+			except OSError:
+				pass
+		self.skt = None
+
+	def _frame(self, batch:list[LogRecord]) -> bytes:
+		try:
+			payload = LogRecord.encode_batch(batch)
+		except Exception:
+			# Somebody put something unpicklable into a record.
+			# Only throw away the bad ones
+			good = []
+			for record in batch:
+				try:
+					pickle.dumps(record)
+					good.append(record)
+				except Exception:
+					self.dropped += 1
+			payload = LogRecord.encode_batch(good)
+
+		return len(payload).to_bytes(4, 'little') + payload
+
+	def _run(self):
+		while True:
+			with self.cond:
+				while not self.records:
+					self.cond.wait()
+				batch = [
+					self.records.popleft()
+					for _ in range(min(len(self.records), self.batch_size))
+				]
+
+			frame = self._frame(batch)
+
+			# Keep trying. Meanwhile, the buffer takes the hit
+			while True:
+				try:
+					if not self.skt:
+						self._connect()
+					self.skt.sendall(frame)
+					break
+				except OSError:
+					self._disconnect()
+					time.sleep(self.reconnect_delay)
+
+			self.sent += len(batch)
+			self.batches += 1
 
 
 
@@ -79,18 +419,27 @@ class LogRecordFormatter:
 	Format log record to text according to its type.
 
 	Formats:
-		1 - connection
+		1 - connection (access_format='text')
 			[timestamp], ip:port > response-code
 				method httpver
 				path
 				useragent|-
 				referer|-
+				bytes sent, duration, worker, request number
+
+		1 - connection (access_format='jsonl')
+			{"time": ..., "addr": ..., "method": ..., ...}
+
+		1 - connection (access_format='common' / 'combined')
+			127.0.0.1 - - [18/Oct/2026:13:55:36 +0000] "GET /path HTTP/1.1" 200 2326
+			combined adds: "referer" "user-agent"
 
 		2 - internal error
 			[timestamp]
 			python error traceback
 	"""
-	def __init__(self, log_record:LogRecord):
+	def __init__(self, log_record:LogRecord, access_format:str='text'):
+		self.access_format = access_format
 		self.record_type = log_record.record_type
 		self.data = log_record.log_data
 		self.record_timestamp = log_record.timestamp
@@ -148,7 +497,7 @@ class LogRecordFormatter:
 	def frmt_connection(self):
 		"""
 		Data is a dict where
-			- time:str        > datetime.datetime timestamp of when the request was accepted by the server
+			- time:float      > unix timestamp of when the request was accepted by the server
 			- addr_info:tuple > (ip, port) of the client
 			- method:str      > request method (post, get...)
 			- httpver:str     > http version of the request (HTTP/1.1)
@@ -156,13 +505,25 @@ class LogRecordFormatter:
 			- usragent:str    > User-Agent string
 			- ref:str         > Referer string
 			- rsp_code:int    > Response code
+			- bytes_sent:int  > Bytes written to the socket (headers included)
+			- duration:float  > Milliseconds from receiving the request head till the log record
+			- phases:tuple    > ((phase, milliseconds), ...) internal timings
+			- worker:int      > Index of the worker process
+			- rq_num:int      > Number of the request within the keep-alive connection
 		"""
+		frmt = {
+			'jsonl': self.frmt_connection_jsonl,
+			'common': self.frmt_connection_clf,
+			'combined': self.frmt_connection_clf,
+		}.get(self.access_format)
+		if frmt:
+			return frmt()
 
 		dt = self.data
 		write_line = self.write_line
 
 		write_line(
-			f"""[{dt['time'].isoformat()}], {dt['addr_info'][0]}:{dt['addr_info'][1]} > {dt['rsp_code']}"""
+			f"""[{self.access_time().isoformat()}], {dt['addr_info'][0]}:{dt['addr_info'][1]} > {dt['rsp_code']}"""
 		)
 		# method + http version
 		write_line(f"""{dt['method'].upper()} {dt['httpver']}""", indent=1)
@@ -172,11 +533,66 @@ class LogRecordFormatter:
 		write_line(dt['usragent'] or '-', indent=1)
 		# referer header
 		write_line(dt['ref'] or '-', indent=1)
+		# size and time
+		write_line(
+			f"""{dt.get('bytes_sent') or 0} bytes, {dt.get('duration') or 0}ms, worker {dt.get('worker')}, request {dt.get('rq_num')}""",
+			indent=1
+		)
 		# double break (end)
 		write_line('')
 
 		return self.buf.getvalue()
 
+	def access_time(self) -> datetime.datetime:
+		"""When the request was accepted (local time, with tz)"""
+		rq_time = self.data.get('time') or self.record_timestamp
+		if isinstance(rq_time, (int, float)):
+			return datetime.datetime.fromtimestamp(rq_time).astimezone()
+		return rq_time.astimezone()
+
+	# One JSON object per line
+	def frmt_connection_jsonl(self):
+		dt = self.data
+		addr = dt.get('addr_info') or ('-', 0)
+
+		return json.dumps({
+			'time': self.access_time().isoformat(),
+			'addr': addr[0],
+			'port': addr[1],
+			'method': (dt.get('method') or '').upper(),
+			'path': dt.get('path'),
+			'httpver': dt.get('httpver'),
+			'status': dt.get('rsp_code'),
+			'bytes': dt.get('bytes_sent') or 0,
+			'duration_ms': dt.get('duration'),
+			'phases': dict(dt.get('phases') or ()),
+			'usragent': dt.get('usragent'),
+			'ref': dt.get('ref'),
+			'worker': dt.get('worker'),
+			'rq_num': dt.get('rq_num'),
+			'sample_rate': dt.get('sample_rate'),
+		}, ensure_ascii=False, default=str) + '\n'
+
+	# Common/Combined Log Format
+	def frmt_connection_clf(self):
+		dt = self.data
+		addr = dt.get('addr_info') or ('-', 0)
+
+		def quoted(text) -> str:
+			if not text:
+				return '"-"'
+			return '"' + str(text).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+		line = (
+			f"""{addr[0]} - - [{self.access_time():%d/%b/%Y:%H:%M:%S %z}] """
+			f"""{quoted(f"{(dt.get('method') or '').upper()} {dt.get('path')} {dt.get('httpver')}")} """
+			f"""{dt.get('rsp_code')} {dt.get('bytes_sent') or '-'}"""
+		)
+		if self.access_format == 'combined':
+			line += f""" {quoted(dt.get('ref'))} {quoted(dt.get('usragent'))}"""
+
+		return line + '\n'
+
 	# Format internal error
 	# When something goes wrong inside jag itself
 	def frmt_internal_error(self):
@@ -206,49 +622,285 @@ class LogRecordFormatter:
 
 
 
+# A single log file (one per log type)
+class LogFile:
+	"""\
+	Buffered append-only handle of a log file with rotation.
+
+	The current file is always jag_log.[log_type].log
+	When it grows past rotate_size or the day changes - it's moved to
+		jag_log.[log_type].[date].[seq_num].log
+	and (optionally) compressed to .log.gz in the background.
+	Only the newest archive_count archives are kept (0 = keep everything).
+	"""
+	def __init__(
+		self,
+		log_dir:Path,
+		log_type:str,
+		buffer_size:int=65536,
+		rotate_size:int=0,
+		rotate_daily:bool=True,
+		archive_count:int=0,
+		compress:bool=True
+	):
+		self.log_dir:Path = Path(log_dir)
+		self.log_type:str = log_type
+		self.path:Path = self.log_dir / f'jag_log.{log_type}.log'
+
+		self.buffer_size:int = buffer_size
+		self.rotate_size:int = rotate_size
+		self.rotate_daily:bool = rotate_daily
+		self.archive_count:int = archive_count
+		self.compress:bool = compress
+
+		self.handle = None
+		self.size:int = 0
+		# The date the contents of the current file belong to
+		self.date = None
+
+		self.rotations:int = 0
+
+	def open(self):
+		import datetime
+
+		self.handle = open(str(self.path), 'ab', buffering=self.buffer_size)
+		self.size = self.handle.tell()
+		self.date = (
+			datetime.date.fromtimestamp(self.path.stat().st_mtime)
+			if self.size else
+			datetime.date.today()
+		)
+
+	def write(self, text:str):
+		import datetime
+
+		data = text.encode('utf-8', errors='replace')
+
+		if not self.handle:
+			self.open()
+
+		if (
+			(self.rotate_size and self.size and (self.size + len(data)) > self.rotate_size)
+			or
+			(self.rotate_daily and self.date != datetime.date.today())
+		):
+			self.rotate()
+
+		self.handle.write(data)
+		self.size += len(data)
+
+	def flush(self):
+		if self.handle:
+			self.handle.flush()
+
+	def close(self):
+		if self.handle:
+			self.handle.close()
+			self.handle = None
+
+	def rotate(self):
+		self.close()
+
+		# Sequential number of the archive within the day
+		prefix = f'jag_log.{self.log_type}.{self.date:%Y%m%d}.'
+		seq_num = 1 + max(
+			(
+				int(seq) for seq in (
+					f.name[len(prefix):].split('.')[0]
+					for f in self.log_dir.glob(f'{prefix}*')
+				)
+				if seq.isdigit()
+			),
+			default=0
+		)
+		archive = self.log_dir / f'{prefix}{seq_num}.log'
+
+		os.replace(self.path, archive)
+		self.rotations += 1
+		self.open()
+
+		# Compression of a 64mb file takes a while,
+		# the writer shouldn't wait for it
+		threading.Thread(target=self.archive, args=(archive,), daemon=True).start()
+
+	def archive(self, archive:Path):
+		import gzip, shutil
+
+		try:
+			if self.compress:
+				with open(archive, 'rb') as src, gzip.open(str(archive) + '.gz', 'wb') as dst:
+					shutil.copyfileobj(src, dst, 1024**2)
+				archive.unlink()
+
+			# Cleanup
+			if self.archive_count:
+				archives = sorted(
+					self.log_dir.glob(f'jag_log.{self.log_type}.*.*.log*'),
+					key=lambda f: f.stat().st_mtime
+				)
+				for old in archives[:-self.archive_count]:
+					old.unlink(missing_ok=True)
+		except Exception as err:
+			print_exception(err)
+
+
+
 # The CEO of log server
 class Stasi:
 	"""\
 	Simple logger.
 	Logs are stored in the user defined/default folder.
 	The name scheme of the log files is as follows:
-		jag_log.[log_type].[seq_num].[ext]
+		jag_log.[log_type].log
+		jag_log.[log_type].[date].[seq_num].log(.gz) - archives
+
+	Records received from the clients are put into a queue.
+	A single writer thread formats them and writes them
+	into buffered file handles (see LogFile), which are flushed
+	when the buffer is full or every flush_interval seconds.
+
+	Nothing is thrown away: if the writer falls behind by more than
+	max_backlog records - the receivers stop reading from the sockets
+	until it catches up (the clients then drop & count on their side).
 	"""
 	def __init__(self, sv_resources):
 		self.sv_res = sv_resources
-		self.queue = []
-		self.log_dir = sv_resources.cfg['logging']['logs_dir']
-		self.log_file = self.log_dir / 'test.log'
+		log_cfg = sv_resources.cfg['logging']
+
+		self.queue:collections.deque = collections.deque()
+		self.cond = threading.Condition()
+		self.max_backlog:int = log_cfg['max_backlog']
+		self.flush_interval:float = log_cfg['flush_interval']
+		self.access_format:str = log_cfg['access_format']
+
+		self.log_dir = Path(log_cfg['logs_dir'])
+		self.log_dir.mkdir(parents=True, exist_ok=True)
+
+		# log type: LogFile
+		self.log_files:dict[str, LogFile] = {}
+		self.file_params = {
+			'buffer_size': log_cfg['buffer_size'],
+			'rotate_size': log_cfg['rotate_size'],
+			'rotate_daily': log_cfg['rotate_daily'],
+			'archive_count': log_cfg['archive_count'],
+			'compress': log_cfg['compress_archives'],
+		}
+
+		# Counters
+		self.received:int = 0
+		self.written:int = 0
+		self.failed:int = 0
+
+		# Set by close(), the writer leaves once the queue is empty
+		self.closing:bool = False
+
+		# init the writer
+		self.writer_thread = threading.Thread(target=self.writer, daemon=True)
+		self.writer_thread.start()
+		atexit.register(self.close)
+
+	def log_file(self, log_type:str) -> LogFile:
+		log_file = self.log_files.get(log_type)
+		if not log_file:
+			log_file = LogFile(self.log_dir, log_type, **self.file_params)
+			self.log_files[log_type] = log_file
+		return log_file
+
+	def enqueue(self, records:list[LogRecord]):
+		with self.cond:
+			# Back pressure, instead of throwing things away
+			while self.max_backlog and len(self.queue) >= self.max_backlog:
+				self.cond.wait()
+
+			self.queue.extend(records)
+			self.received += len(records)
+			self.cond.notify_all()
+
+	def writer(self):
+		"""\
+		The processor keeps an eye on the queue and writes down items piled up in it.
+		This runs as a thread from the very beginning of the program
+		and only terminates when the server shuts down (see close())
+		"""
+		next_flush = time.monotonic() + self.flush_interval
 
-		# init the processor
-		threading.Thread(target=log_records_processor, args=(self,), daemon=True).start()
+		while True:
+			with self.cond:
+				if not self.queue:
+					if self.closing:
+						return
+					self.cond.wait(max(next_flush - time.monotonic(), 0.01))
+				batch = list(self.queue)
+				self.queue.clear()
+				# Wake up the receivers waiting for the backlog to shrink
+				self.cond.notify_all()
+
+			for record in batch:
+				try:
+					formatter = LogRecordFormatter(record, self.access_format)
+					self.log_file(formatter.type_suffix).write(formatter.to_text())
+					self.written += 1
+				except Exception as err:
+					self.failed += 1
+					print_exception(err)
+
+			if time.monotonic() >= next_flush:
+				self.flush()
+				next_flush = time.monotonic() + self.flush_interval
+
+	def flush(self):
+		for log_file in list(self.log_files.values()):
+			try:
+				log_file.flush()
+			except Exception as err:
+				print_exception(err)
+
+	def close(self, timeout:float=5):
+		"""\
+		Let the writer write down whatever is still queued
+		(for up to timeout seconds), then flush and close the files.
+		"""
+		with self.cond:
+			self.closing = True
+			self.cond.notify_all()
+		self.writer_thread.join(timeout)
+
+		self.flush()
+		for log_file in list(self.log_files.values()):
+			log_file.close()
 
 	# queue 
 	def accept_log_record(self, cl_con:socket.socket, cl_addr:tuple[str, int]):
-		# first of all collect the payload
+		"""\
+		Receive frames from a LogClient until it disconnects.
+		Every frame is an encoded list of log records, see LogRecord.encode_batch
+		"""
 		try:
-			print('accepting record')
-			# buffer for the payload
-			buf = io.BytesIO()
+			print('accepting records')
 
 			# socket file
-			skt_file = cl_con.makefile('rb', buffering=0)
-
-			# get the length of the payload
-			p_len = int.from_bytes(skt_file.read(4), 'little')
-			print(
-				'Log record payload length:', p_len
-			)
-
-			# receive the remaining payload according to its length
-			buf.write(skt_file.read(p_len))
-
-			print('appended record')
-			# append record to the queue
-			self.queue.append(buf)
-
-			# close the connection
-			cl_con.shutdown(socket.SHUT_RDWR)
+			skt_file = cl_con.makefile('rb')
+
+			while True:
+				# get the length of the payload
+				p_len = skt_file.read(4)
+				if len(p_len) < 4:
+					break
+				p_len = int.from_bytes(p_len, 'little')
+				print(
+					'Log record batch payload length:', p_len
+				)
+
+				# receive the remaining payload according to its length
+				payload = skt_file.read(p_len)
+				if len(payload) < p_len:
+					break
+
+				# append records to the queue
+				self.enqueue(LogRecord.decode_batch(payload))
+
+			skt_file.close()
+			cl_con.close()
 		except ConnectionAbortedError as err:
 			pass
 		except ConnectionResetError as err:
@@ -258,72 +910,18 @@ class Stasi:
 
 
 
-# dump a group of log records to a file
-# this function is being run every n seconds as a subprocess
-def dump_log_record_batch(batch:list[bytes], tgt_dir:Path):
-	# first, evaluate pickled data
-	import pickle
-
-	for recbytes in batch:
-		log_record = LogRecordFormatter(pickle.loads(recbytes))
-
-		tgt_file = tgt_dir / f'jag_log.{log_record.type_suffix}.log'
-
-		# Write formatted data to file
-		with open(str(tgt_file), 'a', encoding='utf-8') as write_tgt:
-			write_tgt.write(
-				log_record.to_text()
-			)
-
-
-# The processor keeps an eye on the queue and processes items piled up in it
-# This function runs as a thread in a loop from the very beginning of the program
-# and only terminates when the server shuts down
-def log_records_processor(log_ctrl):
-	import jag_util
-
-	while True:
-		if len(log_ctrl.queue) >= 4096:
-			# Something went very wrong
-			# Todo: really ?
-			log_ctrl.queue = []
-			return
-
-		# if the queue is empty - wait 1 second and try again
-		if len(log_ctrl.queue) <= 0:
-			time.sleep(1)
-			continue
-
-		# spawning a process for every record is absolutely terrible
-		# collect a number of records and process them in groups
-		log_batch = []
-		for idx in range(jag_util.clamp(len(log_ctrl.queue), 0, 64)):
-			# first 4 bytes are garbage data, skip them
-			log_ctrl.queue[0].seek(4, 0)
-
-			# append good data to the batch
-			log_batch.append(log_ctrl.queue[0].read())
-			# delete the record from the queue
-			del log_ctrl.queue[0]
-
-		# Start the process
-		task = multiprocessing.Process(
-			target=dump_log_record_batch,
-			args=(log_batch, log_ctrl.log_dir,),
-			daemon=True
-		)
-		task.start()
-		task.join()
-
-
 # Bsically the root of the logging server
 # this function creates a Stasi class (log server manager)
 # and listens for incoming connections
 def jag_log_server_process(sv_resources, sock_obj:socket.socket):
-	import os
+	import os, signal, sys
 
 	# start listening the socket
-	sock_obj.listen(0)
+	# (every worker process keeps a connection)
+	sock_obj.listen(64)
+
+	# Write down whatever is buffered when asked to leave
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
 	_print('Logging PID:', os.getpid())
 
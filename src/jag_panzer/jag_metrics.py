@@ -0,0 +1,323 @@
+"""
+Server-wide metrics.
+
+Every worker writes into its own region of a shared memory array
+(multiprocessing.RawArray), created by the process which spawns the workers.
+There are no locks on the write path: a region only has one writer process.
+(Under the thread engines, concurrent increments from threads
+of the same worker may very rarely lose a count, that's the price).
+
+Whichever worker serves the metrics endpoint reads all the regions
+and sums them up, so the numbers are server-wide,
+not "whatever this worker has seen".
+
+Recorded:
+    - Requests, latency histograms, bytes in/out
+      per route (as declared in @JagRoute) and status class
+    - Histograms of the request phases (see ServerTimings)
+    - Per worker: active connections, pool queue depth, busy threads
+
+The output is the Prometheus text exposition format.
+"""
+
+import multiprocessing, ctypes, bisect
+
+
+# Latency histogram buckets (seconds)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+
+# Layout of a (route, status class) cell:
+# non-cumulative bucket counts, then the +Inf bucket (aka the total count)
+_COUNT = len(LATENCY_BUCKETS)
+_SUM = _COUNT + 1
+_BYTES_OUT = _COUNT + 2
+_BYTES_IN = _COUNT + 3
+_CELL = _COUNT + 4
+
+# Fixed internal phases of a request, in order.
+# ServerTimings keeps a preallocated slot for each of them.
+#     - accept  -> connection accepted till the first request head is complete
+#                  (queueing included). First request of a connection only
+#     - head    -> parsing the request head
+#     - route   -> route lookup and the automatic actions
+#     - handler -> the route function, minus the time spent in socket writes
+#     - send    -> socket writes, wherever they happened
+#     - log     -> the access log record
+PHASES = ('accept', 'head', 'route', 'handler', 'send', 'log')
+
+# Phases are way shorter than whole requests
+PHASE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.25, 1.0)
+# Layout of a phase cell: non-cumulative bucket counts, count, sum
+_PHASE_COUNT = len(PHASE_BUCKETS)
+_PHASE_SUM = _PHASE_COUNT + 1
+_PHASE_CELL = _PHASE_COUNT + 2
+
+# Per worker gauges, stored after the phases.
+# name: help
+GAUGES = {
+	'active_connections': 'Open client connections',
+	'queue_depth': 'Tasks waiting for a pool thread, as of the last served request',
+	'busy_threads': 'Busy pool threads, as of the last served request',
+}
+
+# Reserved route slots
+ROUTE_NONE = 0     # no route matched (and no fallback)
+ROUTE_DEFAULT = 1  # the fallback route, @JagRoute()
+ROUTE_OTHER = 2    # the route table is full
+_RESERVED = ('<none>', '<default>', '<other>')
+
+# Max length of a route label (bytes)
+ROUTE_NAME_LEN = 128
+
+
+class MetricsStore:
+	"""\
+	The shared memory itself.
+	Has to be created before the workers are spawned
+	and passed to them (it can't be pickled later).
+	"""
+	def __init__(self, worker_count:int, max_routes:int=128):
+		self.worker_count:int = max(1, worker_count)
+		self.max_routes:int = max(len(_RESERVED) + 1, max_routes)
+
+		self.cells_per_worker:int = self.max_routes * len(STATUS_CLASSES) * _CELL
+		self.phases_offset:int = self.cells_per_worker
+		self.gauges_offset:int = self.phases_offset + len(PHASES) * _PHASE_CELL
+		self.worker_size:int = self.gauges_offset + len(GAUGES)
+
+		self.values = multiprocessing.RawArray(ctypes.c_double, self.worker_count * self.worker_size)
+
+		# Route labels are shared too, so that every worker
+		# puts the same route into the same slot
+		self.route_names = multiprocessing.RawArray(ctypes.c_char, self.max_routes * ROUTE_NAME_LEN)
+		self.route_count = multiprocessing.RawValue(ctypes.c_int, 0)
+		# Only taken when a worker sees a route for the first time
+		self.route_lock = multiprocessing.Lock()
+
+		for slot, name in enumerate(_RESERVED):
+			self._write_name(slot, name)
+		self.route_count.value = len(_RESERVED)
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'MetricsStore|None':
+		if not srv_res.cfg['metrics']['enabled']:
+			return None
+
+		mp_cfg = srv_res.cfg['multiprocessing']
+		return cls(
+			mp_cfg['worker_count'] if mp_cfg['enabled'] else 1,
+			srv_res.cfg['metrics']['max_routes'],
+		)
+
+	def _write_name(self, slot:int, name:str):
+		raw = name.encode()[:ROUTE_NAME_LEN]
+		offset = slot * ROUTE_NAME_LEN
+		self.route_names[offset:offset + ROUTE_NAME_LEN] = raw.ljust(ROUTE_NAME_LEN, b'\0')
+
+	def route_name(self, slot:int) -> str:
+		offset = slot * ROUTE_NAME_LEN
+		return self.route_names[offset:offset + ROUTE_NAME_LEN].rstrip(b'\0').decode(errors='replace')
+
+	def route_slot(self, name:str) -> int:
+		"""Find or claim the slot of a route label"""
+		with self.route_lock:
+			count = self.route_count.value
+			for slot in range(count):
+				if self.route_name(slot) == name:
+					return slot
+
+			if count >= self.max_routes:
+				return ROUTE_OTHER
+
+			self._write_name(slot := count, name)
+			self.route_count.value = count + 1
+			return slot
+
+	def worker(self, worker_idx:int) -> 'WorkerMetrics':
+		return WorkerMetrics(self, worker_idx)
+
+
+	# Reading
+	# =================
+
+	def cell_totals(self, route_slot:int, status_idx:int) -> list[float]:
+		"""A (route, status class) cell summed across the workers"""
+		totals = [0.0] * _CELL
+		base = (route_slot * len(STATUS_CLASSES) + status_idx) * _CELL
+		for worker_idx in range(self.worker_count):
+			offset = worker_idx * self.worker_size + base
+			for idx, val in enumerate(self.values[offset:offset + _CELL]):
+				totals[idx] += val
+		return totals
+
+	def phase_totals(self, phase_idx:int) -> list[float]:
+		"""A phase cell summed across the workers"""
+		totals = [0.0] * _PHASE_CELL
+		base = self.phases_offset + phase_idx * _PHASE_CELL
+		for worker_idx in range(self.worker_count):
+			offset = worker_idx * self.worker_size + base
+			for idx, val in enumerate(self.values[offset:offset + _PHASE_CELL]):
+				totals[idx] += val
+		return totals
+
+	def gauge(self, worker_idx:int, gauge_idx:int) -> float:
+		return self.values[worker_idx * self.worker_size + self.gauges_offset + gauge_idx]
+
+	def render(self) -> str:
+		"""All the metrics in the Prometheus text format"""
+		requests = []
+		histogram = []
+		bytes_out = []
+		bytes_in = []
+
+		for route_slot in range(self.route_count.value):
+			route = _escape(self.route_name(route_slot))
+			for status_idx, status in enumerate(STATUS_CLASSES):
+				cell = self.cell_totals(route_slot, status_idx)
+				if not cell[_COUNT]:
+					continue
+
+				labels = f'route="{route}",status="{status}"'
+				requests.append(f'jag_http_requests_total{{{labels}}} {cell[_COUNT]:.0f}')
+
+				cumulative = 0
+				for bucket, le in zip(cell, LATENCY_BUCKETS):
+					cumulative += bucket
+					histogram.append(f'jag_http_request_duration_seconds_bucket{{{labels},le="{le}"}} {cumulative:.0f}')
+				histogram.append(f'jag_http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {cell[_COUNT]:.0f}')
+				histogram.append(f'jag_http_request_duration_seconds_sum{{{labels}}} {cell[_SUM]:.6f}')
+				histogram.append(f'jag_http_request_duration_seconds_count{{{labels}}} {cell[_COUNT]:.0f}')
+
+				bytes_out.append(f'jag_http_response_bytes_total{{{labels}}} {cell[_BYTES_OUT]:.0f}')
+				bytes_in.append(f'jag_http_request_bytes_total{{{labels}}} {cell[_BYTES_IN]:.0f}')
+
+		lines = [
+			'# HELP jag_http_requests_total Requests served, by route and status class',
+			'# TYPE jag_http_requests_total counter',
+			*requests,
+			'# HELP jag_http_request_duration_seconds Time from receiving the request head till the end of the response',
+			'# TYPE jag_http_request_duration_seconds histogram',
+			*histogram,
+			'# HELP jag_http_response_bytes_total Bytes sent to the clients (headers included)',
+			'# TYPE jag_http_response_bytes_total counter',
+			*bytes_out,
+			'# HELP jag_http_request_bytes_total Bytes received from the clients (head and body)',
+			'# TYPE jag_http_request_bytes_total counter',
+			*bytes_in,
+			'# HELP jag_http_phase_seconds Time spent in the internal phases of the requests',
+			'# TYPE jag_http_phase_seconds histogram',
+		]
+
+		for phase_idx, phase in enumerate(PHASES):
+			cell = self.phase_totals(phase_idx)
+			if not cell[_PHASE_COUNT]:
+				continue
+			cumulative = 0
+			for bucket, le in zip(cell, PHASE_BUCKETS):
+				cumulative += bucket
+				lines.append(f'jag_http_phase_seconds_bucket{{phase="{phase}",le="{le}"}} {cumulative:.0f}')
+			lines.append(f'jag_http_phase_seconds_bucket{{phase="{phase}",le="+Inf"}} {cell[_PHASE_COUNT]:.0f}')
+			lines.append(f'jag_http_phase_seconds_sum{{phase="{phase}"}} {cell[_PHASE_SUM]:.6f}')
+			lines.append(f'jag_http_phase_seconds_count{{phase="{phase}"}} {cell[_PHASE_COUNT]:.0f}')
+
+		for gauge_idx, (gauge, gauge_help) in enumerate(GAUGES.items()):
+			lines.append(f'# HELP jag_{gauge} {gauge_help}')
+			lines.append(f'# TYPE jag_{gauge} gauge')
+			for worker_idx in range(self.worker_count):
+				lines.append(f'jag_{gauge}{{worker="{worker_idx}"}} {self.gauge(worker_idx, gauge_idx):.0f}')
+
+		return '\n'.join(lines) + '\n'
+
+
+class WorkerMetrics:
+	"""\
+	Write access to the region of a single worker
+	"""
+	def __init__(self, store:MetricsStore, worker_idx:int):
+		self.store:MetricsStore = store
+		self.values = store.values
+		self.offset:int = (worker_idx % store.worker_count) * store.worker_size
+		self.phase_offset:int = self.offset + store.phases_offset
+		self.gauge_offset:int = self.offset + store.gauges_offset
+
+		# route label: slot
+		self._route_slots:dict[str, int] = {}
+
+	def route_slot(self, route_path:str|None, matched:bool=True) -> int:
+		if not matched:
+			return ROUTE_NONE
+		if route_path is None:
+			return ROUTE_DEFAULT
+
+		slot = self._route_slots.get(route_path)
+		if slot is None:
+			slot = self.store.route_slot(route_path)
+			self._route_slots[route_path] = slot
+		return slot
+
+	def observe_request(
+		self,
+		route_slot:int,
+		code:int,
+		duration:float,
+		bytes_out:int,
+		bytes_in:int
+	):
+		"""\
+		- duration:float -> seconds
+		"""
+		status_idx = min(max(code // 100 - 1, 0), len(STATUS_CLASSES) - 1)
+		base = self.offset + (route_slot * len(STATUS_CLASSES) + status_idx) * _CELL
+
+		values = self.values
+		bucket = bisect.bisect_left(LATENCY_BUCKETS, duration)
+		# Slower than the last bucket only lands in +Inf
+		if bucket < _COUNT:
+			values[base + bucket] += 1
+		values[base + _COUNT] += 1
+		values[base + _SUM] += duration
+		values[base + _BYTES_OUT] += bytes_out
+		values[base + _BYTES_IN] += bytes_in
+
+	def observe_phases(self, phase_ns:list[int], skip_accept:bool=False):
+		"""\
+		- phase_ns:list[int] -> nanoseconds per phase, in the order of PHASES
+		- skip_accept:bool   -> the accept phase doesn't apply (keep-alive request)
+		"""
+		values = self.values
+		base = self.phase_offset
+		for phase_idx, took_ns in enumerate(phase_ns):
+			if phase_idx == 0 and skip_accept:
+				base += _PHASE_CELL
+				continue
+			took = took_ns / 1_000_000_000
+			bucket = bisect.bisect_left(PHASE_BUCKETS, took)
+			if bucket < _PHASE_COUNT:
+				values[base + bucket] += 1
+			values[base + _PHASE_COUNT] += 1
+			values[base + _PHASE_SUM] += took
+			base += _PHASE_CELL
+
+	def add_gauge(self, gauge_idx:int, delta:float):
+		self.values[self.gauge_offset + gauge_idx] += delta
+
+	def set_gauge(self, gauge_idx:int, value:float):
+		self.values[self.gauge_offset + gauge_idx] = value
+
+	def conn_opened(self):
+		self.add_gauge(0, 1)
+
+	def conn_closed(self):
+		self.add_gauge(0, -1)
+
+	def pool_state(self, queue_depth:int, busy:int):
+		self.set_gauge(1, queue_depth)
+		self.set_gauge(2, busy)
+
+	def render(self) -> str:
+		return self.store.render()
+
+
+def _escape(label:str) -> str:
+	return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
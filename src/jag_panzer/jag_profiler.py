@@ -0,0 +1,373 @@
+"""
+Per-route profiling of the rooms, without restarting the server.
+
+Two modes:
+    - cprofile -> Every picked request runs its route function under cProfile.
+                  The stats are aggregated per route (pstats).
+                  Precise, but slows the picked requests down a lot.
+    - sampler  -> A background thread looks at the stacks of the threads
+                  executing picked requests every sampler_interval
+                  and counts them per route (folded stacks, flamegraph-ready).
+                  Costs next to nothing, but it's statistics.
+
+Which requests are picked: 1 in N requests of a route,
+see the 'profiling' config group.
+
+Profiling could be toggled at runtime with signals,
+sent to the worker processes:
+    - SIGUSR1 -> Toggle profiling. Turning it off dumps the data
+    - SIGUSR2 -> Dump the data, keep profiling
+
+Every worker dumps into the dump_dir:
+    - jag_profile.w[worker].json            -> index: route, requests, handler time, files
+    - jag_profile.[route].w[worker].pstats  -> cprofile mode
+    - jag_profile.[route].w[worker].folded  -> sampler mode
+
+Merge the dumps of all the workers::
+
+    python -m jag_panzer.jag_profiler /var/log/jag/profiles [--top 30]
+"""
+
+import threading, time, sys, os, json, re, collections, signal
+from pathlib import Path
+
+PROFILE_MODES = ('cprofile', 'sampler')
+
+# Control signals (POSIX only)
+SIG_TOGGLE = getattr(signal, 'SIGUSR1', None)
+SIG_DUMP = getattr(signal, 'SIGUSR2', None)
+
+
+def route_key(route) -> str:
+	"""The name a route is profiled under"""
+	return route.path if route.path is not None else '<default>'
+
+
+def _slug(key:str) -> str:
+	return re.sub(r'[^A-Za-z0-9]+', '_', key).strip('_') or 'root'
+
+
+def ignore_control_signals():
+	"""\
+	Make the processes which aren't workers survive
+	the control signals (the default action is to terminate).
+	Children inherit this, workers install their own handlers.
+	"""
+	for signum in (SIG_TOGGLE, SIG_DUMP):
+		if signum is None:
+			continue
+		try:
+			signal.signal(signum, signal.SIG_IGN)
+		except ValueError:
+			# Not the main thread
+			pass
+
+
+class RouteProfiler:
+	"""\
+	Profiler of a single worker. See the module docstring.
+	"""
+	def __init__(
+		self,
+		mode:str='sampler',
+		sample_every:int=0,
+		route_rates:dict[str, int]|None=None,
+		sampler_interval:float=0.005,
+		dump_dir:str|Path|None=None,
+		worker_idx:int=0,
+		active:bool=False
+	):
+		if not mode in PROFILE_MODES:
+			raise ValueError(f'Profiling mode must be one of {PROFILE_MODES}, not {mode}')
+
+		self.mode:str = mode
+		# 1 in N requests of every route, 0 = only the routes in route_rates
+		self.sample_every:int = max(0, int(sample_every))
+		# route path: N
+		self.route_rates:dict[str, int] = {k: max(0, int(v)) for k, v in (route_rates or {}).items()}
+		self.sampler_interval:float = sampler_interval
+		self.dump_dir:Path|None = Path(dump_dir) if dump_dir else None
+		self.worker_idx:int = worker_idx
+
+		# Whether requests are being picked right now
+		self.active:bool = active
+
+		self._lock = threading.Lock()
+		# route key: requests seen while active
+		self._seen:dict[str, int] = collections.defaultdict(int)
+		# route key: [requests profiled, handler nanoseconds]
+		self._totals:dict[str, list[int]] = {}
+
+		# cprofile mode. route key: pstats.Stats
+		self._pstats:dict = {}
+		# Requests skipped, because another profiler was active
+		# (python 3.12+ only allows a single one per process)
+		self.busy_skips:int = 0
+
+		# sampler mode. route key: Counter(folded stack: samples)
+		self._samples:dict[str, collections.Counter] = {}
+		# thread ident: route key, of the threads executing picked requests
+		self._profiled_threads:dict[int, str] = {}
+		self._sampler_thread:threading.Thread|None = None
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'RouteProfiler':
+		prof_cfg = srv_res.cfg['profiling']
+		return cls(
+			prof_cfg['mode'],
+			prof_cfg['sample_every'],
+			prof_cfg['routes'],
+			prof_cfg['sampler_interval'],
+			prof_cfg['dump_dir'] or (srv_res.cfg['logging']['logs_dir'] / 'profiles'),
+			srv_res.worker_idx,
+			prof_cfg['enabled'],
+		)
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		with self._lock:
+			return {
+				'active': self.active,
+				'mode': self.mode,
+				'routes': {key: {'requests': tot[0], 'handler_ms': tot[1] / 1_000_000} for key, tot in self._totals.items()},
+				'busy_skips': self.busy_skips,
+			}
+
+
+	# Request side
+	# =================
+
+	def should_profile(self, key:str) -> bool:
+		"""Whether to profile this request of the route"""
+		every = self.route_rates.get(key, self.sample_every)
+		if not every:
+			return False
+		# No lock: a miscounted request only shifts the sampling a bit
+		self._seen[key] += 1
+		return self._seen[key] % every == 0
+
+	def profile(self, key:str, func, *args):
+		"""Execute the route function under the profiler"""
+		if self.mode == 'cprofile':
+			return self._profile_cprofile(key, func, args)
+		return self._profile_sampled(key, func, args)
+
+	def account(self, key:str, handler_ns:int):
+		"""\
+		Count a profiled request together with the time
+		its handler took (ServerTimings.phase_ns).
+		"""
+		with self._lock:
+			totals = self._totals.setdefault(key, [0, 0])
+			totals[0] += 1
+			totals[1] += handler_ns
+
+	def _profile_cprofile(self, key:str, func, args):
+		import cProfile, pstats
+		prof = cProfile.Profile()
+		try:
+			prof.enable()
+		except ValueError:
+			self.busy_skips += 1
+			return func(*args)
+
+		try:
+			return func(*args)
+		finally:
+			prof.disable()
+			with self._lock:
+				if key in self._pstats:
+					self._pstats[key].add(prof)
+				else:
+					self._pstats[key] = pstats.Stats(prof)
+
+	def _profile_sampled(self, key:str, func, args):
+		self._ensure_sampler()
+		ident = threading.get_ident()
+		self._profiled_threads[ident] = key
+		try:
+			return func(*args)
+		finally:
+			self._profiled_threads.pop(ident, None)
+
+
+	# Sampler
+	# =================
+
+	def _ensure_sampler(self):
+		if self._sampler_thread:
+			return
+		with self._lock:
+			if self._sampler_thread:
+				return
+			self._sampler_thread = threading.Thread(target=self._sample_loop, name='jag_profiler', daemon=True)
+			self._sampler_thread.start()
+
+	def _sample_loop(self):
+		# Frames above this one belong to the server, not the room
+		stop_code = RouteProfiler._profile_sampled.__code__
+		while True:
+			time.sleep(self.sampler_interval)
+			if not self._profiled_threads:
+				continue
+
+			frames = sys._current_frames()
+			for ident, key in list(self._profiled_threads.items()):
+				frame = frames.get(ident)
+				stack = []
+				while frame is not None and frame.f_code is not stop_code:
+					code = frame.f_code
+					stack.append(f'{Path(code.co_filename).name}:{code.co_name}')
+					frame = frame.f_back
+				if not stack:
+					continue
+
+				folded = ';'.join(reversed(stack))
+				with self._lock:
+					self._samples.setdefault(key, collections.Counter())[folded] += 1
+			del frames
+
+
+	# Control
+	# =================
+
+	def toggle(self):
+		self.active = not self.active
+		if not self.active:
+			self.dump()
+
+	def reset(self):
+		with self._lock:
+			self._seen.clear()
+			self._totals.clear()
+			self._pstats.clear()
+			self._samples.clear()
+
+	def dump(self) -> list[Path]:
+		"""\
+		Write down everything collected so far.
+		Returns the written files.
+		"""
+		if not self.dump_dir:
+			return []
+		self.dump_dir.mkdir(parents=True, exist_ok=True)
+
+		written = []
+		index = {'worker': self.worker_idx, 'pid': os.getpid(), 'mode': self.mode, 'routes': {}}
+		with self._lock:
+			for key, (requests, handler_ns) in self._totals.items():
+				entry = {'requests': requests, 'handler_ms': round(handler_ns / 1_000_000, 3), 'file': None}
+				base = f'jag_profile.{_slug(key)}.w{self.worker_idx}'
+
+				if key in self._pstats:
+					path = self.dump_dir / f'{base}.pstats'
+					self._pstats[key].dump_stats(path)
+					entry['file'] = path.name
+					written.append(path)
+
+				if key in self._samples:
+					path = self.dump_dir / f'{base}.folded'
+					path.write_text(''.join(
+						f'{stack} {count}\n' for stack, count in self._samples[key].most_common()
+					))
+					entry['file'] = path.name
+					written.append(path)
+
+				index['routes'][key] = entry
+
+		path = self.dump_dir / f'jag_profile.w{self.worker_idx}.json'
+		path.write_text(json.dumps(index, indent='\t'))
+		written.append(path)
+		return written
+
+	def install_signals(self):
+		"""\
+		SIGUSR1 toggles profiling, SIGUSR2 dumps.
+		Must be called from the main thread of the worker.
+		"""
+		if SIG_TOGGLE is None:
+			return
+		signal.signal(SIG_TOGGLE, lambda signum, frame: self.toggle())
+		signal.signal(SIG_DUMP, lambda signum, frame: self.dump())
+
+
+
+def merge_dumps(dump_dir:str|Path) -> dict[str, dict]:
+	"""\
+	Merge the dumps of all the workers.
+	Returns {route key: {'requests', 'handler_ms', 'workers', 'pstats', 'samples'}}
+	where pstats is a pstats.Stats (cprofile mode)
+	and samples is a Counter of folded stacks (sampler mode).
+	"""
+	import pstats
+	dump_dir = Path(dump_dir)
+	merged = {}
+	for index_path in sorted(dump_dir.glob('jag_profile.w*.json')):
+		index = json.loads(index_path.read_text())
+		for key, entry in index['routes'].items():
+			route = merged.setdefault(key, {
+				'requests': 0,
+				'handler_ms': 0.0,
+				'workers': [],
+				'pstats': None,
+				'samples': collections.Counter(),
+			})
+			route['requests'] += entry['requests']
+			route['handler_ms'] += entry['handler_ms']
+			route['workers'].append(index['worker'])
+
+			if not entry['file'] or not (dump_dir / entry['file']).is_file():
+				continue
+			path = dump_dir / entry['file']
+			if path.suffix == '.pstats':
+				if route['pstats']:
+					route['pstats'].add(str(path))
+				else:
+					route['pstats'] = pstats.Stats(str(path))
+			else:
+				for line in path.read_text().splitlines():
+					stack, _, count = line.rpartition(' ')
+					route['samples'][stack] += int(count)
+	return merged
+
+
+def main(argv:list[str]|None=None) -> int:
+	import argparse
+	parser = argparse.ArgumentParser(prog='python -m jag_panzer.jag_profiler', description='Merge per-route profiles of all the workers')
+	parser.add_argument('dump_dir', help='The profiling dump_dir')
+	parser.add_argument('--top', type=int, default=25, help='Amount of functions/stacks to show per route')
+	parser.add_argument('--out', help='Write the merged profiles into this directory')
+	args = parser.parse_args(argv)
+
+	merged = merge_dumps(args.dump_dir)
+	if not merged:
+		print('No profiles in', args.dump_dir)
+		return 1
+
+	out_dir = Path(args.out) if args.out else None
+	if out_dir:
+		out_dir.mkdir(parents=True, exist_ok=True)
+
+	for key, route in sorted(merged.items(), key=lambda kv: -kv[1]['handler_ms']):
+		avg = route['handler_ms'] / route['requests'] if route['requests'] else 0
+		print(f"""\n=== {key}: {route['requests']} requests, {avg:.3f} ms avg handler, workers {sorted(route['workers'])}""")
+
+		if route['pstats']:
+			route['pstats'].sort_stats('cumulative').print_stats(args.top)
+			if out_dir:
+				route['pstats'].dump_stats(out_dir / f'jag_profile.{_slug(key)}.pstats')
+
+		if route['samples']:
+			total = sum(route['samples'].values())
+			for stack, count in route['samples'].most_common(args.top):
+				print(f'{count / total:>7.1%}  {stack}')
+			if out_dir:
+				(out_dir / f'jag_profile.{_slug(key)}.folded').write_text(''.join(
+					f'{stack} {count}\n' for stack, count in route['samples'].most_common()
+				))
+
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
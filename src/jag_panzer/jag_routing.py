@@ -0,0 +1,278 @@
+"""
+Compiled request router.
+
+Routes are compiled into a tree of path segments once,
+when the worker indexes the room file.
+A lookup then walks the tree (O(path depth), not O(routes))::
+
+    /api               -> api_root
+    /api/user/<int:id> -> user_by_id
+    /static/<path:rel> -> static_files
+
+Matching is prefix based, like it always was
+(a route serves everything below it), but the deepest
+(longest) matching route wins, regardless of declaration order.
+
+Static segments are preferred over parameters,
+parameters are tried in the order of the converters below.
+
+Every node has a dispatch table of {method: route}.
+If the path matches a node, but the method isn't allowed there -
+the lookup says so together with the list of allowed methods (405 + Allow).
+
+Recent path resolutions are memoized in an LRU cache.
+"""
+
+import functools, uuid
+from pathlib import Path
+import sys
+
+if not str(Path(__file__).parent) in sys.path:
+	sys.path.append(str(Path(__file__).parent))
+
+from jag_exceptions import InvalidJagRoute
+
+
+# Path parameter converters.
+# Each one takes a single path segment and either returns
+# the converted value or raises ValueError.
+# <name> is the same as <str:name>
+def _conv_int(segment:str) -> int:
+	# int() is too forgiving (' 1', '+1', '1_000')
+	if not (segment.isascii() and segment.isdigit()):
+		raise ValueError(segment)
+	return int(segment)
+
+def _conv_float(segment:str) -> float:
+	if not segment.isascii() or segment.lower() in ('nan', 'inf', '-inf', 'infinity'):
+		raise ValueError(segment)
+	return float(segment)
+
+def _conv_uuid(segment:str) -> uuid.UUID:
+	return uuid.UUID(segment)
+
+def _conv_str(segment:str) -> str:
+	return segment
+
+# The order matters: the most specific converters go first.
+# <path:name> is special: it eats the rest of the path
+# and is always tried last
+converters = {
+	'int':   _conv_int,
+	'float': _conv_float,
+	'uuid':  _conv_uuid,
+	'str':   _conv_str,
+}
+_conv_order = {name: idx for idx, name in enumerate(converters)}
+
+
+def split_path(path:str) -> list[str]:
+	"""\
+	'/api//user/./1/' -> ['api', 'user', '1']
+	"""
+	segments = path.strip('/').split('/')
+	if '' in segments or '.' in segments:
+		return [seg for seg in segments if seg and seg != '.']
+	return segments
+
+
+class RouteNode:
+	"""\
+	A single path segment in the routing tree.
+	"""
+	def __init__(self):
+		# segment (lowercase): RouteNode
+		self.static:dict[str, RouteNode] = {}
+		# (converter name, param name, converter, RouteNode)
+		self.params:list[tuple] = []
+		# (param name, RouteNode) for <path:name>
+		self.catchall:tuple[str, 'RouteNode']|None = None
+
+		# Dispatch table {method: route}
+		self.methods:dict = {}
+		# The route which accepts any method
+		self.any_method = None
+		# Whether any route ends at this node
+		self.has_routes:bool = False
+
+	@property
+	def allowed(self) -> set[str]:
+		return set(self.methods)
+
+	def param_child(self, conv_name:str, pname:str) -> 'RouteNode':
+		for child_conv, child_pname, _, child in self.params:
+			if (child_conv, child_pname) == (conv_name, pname):
+				return child
+
+		child = RouteNode()
+		self.params.append((conv_name, pname, converters[conv_name], child))
+		self.params.sort(key=lambda p: _conv_order[p[0]])
+		return child
+
+
+class RouteMatch:
+	"""\
+	Result of a route lookup.
+
+	- route   -> The route to execute. None if nothing matched or
+	             if the method isn't allowed.
+	- params  -> {name: value} of the typed path parameters.
+	- allowed -> Methods allowed for the matched path,
+	             only set when the requested method was not one of them.
+	"""
+	def __init__(self, route=None, params:dict|None=None, allowed:set[str]|None=None):
+		self.route = route
+		self.params:dict = params or {}
+		self.allowed:set[str]|None = allowed
+
+	@property
+	def method_not_allowed(self) -> bool:
+		return self.route is None and bool(self.allowed)
+
+	@property
+	def allow_header(self) -> str:
+		return ', '.join(sorted(m.upper() for m in (self.allowed or ())))
+
+
+class RadixRouter:
+	"""\
+	Routes compiled into a segment tree.
+	See the module docstring.
+	"""
+	def __init__(self, cache_size:int=4096):
+		self.root = RouteNode()
+		self.default_route = None
+		self.route_count:int = 0
+
+		# path: (node, params) | None
+		# cache_size=0 disables the cache
+		self._resolve = functools.lru_cache(maxsize=cache_size)(self._walk_path)
+
+	def stats(self) -> dict:
+		"""A snapshot of the counters"""
+		cache = self._resolve.cache_info()
+		return {
+			'routes': self.route_count,
+			'cache_hits': cache.hits,
+			'cache_misses': cache.misses,
+			'cache_entries': cache.currsize,
+		}
+
+	def add(self, route):
+		"""\
+		Compile a route into the tree.
+		route.path is a string like '/api/user/<int:id>',
+		route.methods is a set of lowercase methods or None (any).
+		"""
+		node = self.root
+		segments = split_path(route.path)
+		for idx, seg in enumerate(segments):
+			if not (seg.startswith('<') and seg.endswith('>')):
+				node = node.static.setdefault(seg.lower(), RouteNode())
+				continue
+
+			conv_name, _, pname = seg[1:-1].rpartition(':')
+			conv_name = conv_name or 'str'
+			if not pname.isidentifier():
+				raise InvalidJagRoute(f'Bad JagRoute: invalid parameter {seg} in {route.path}')
+
+			if conv_name == 'path':
+				if idx != len(segments) - 1:
+					raise InvalidJagRoute(f'Bad JagRoute: <path:{pname}> must be the last segment of {route.path}')
+				if not node.catchall:
+					node.catchall = (pname, RouteNode())
+				node = node.catchall[1]
+				continue
+
+			if not conv_name in converters:
+				raise InvalidJagRoute(
+					f'Bad JagRoute: unknown converter {conv_name} in {route.path}, must be one of {tuple(converters) + ("path",)}'
+				)
+			node = node.param_child(conv_name, pname)
+
+		# Fill the dispatch table
+		for method in (route.methods or (None,)):
+			existing = node.methods.get(method) if method else node.any_method
+			if existing is route:
+				continue
+			if existing is not None:
+				raise InvalidJagRoute(
+					f'Bad JagRoute: {route.path} ({method or "any method"}) is already served by {existing.func}'
+				)
+			if method:
+				node.methods[method] = route
+			else:
+				node.any_method = route
+			node.has_routes = True
+
+		self.route_count += 1
+		self._resolve.cache_clear()
+
+	def _walk(self, node:RouteNode, segments:list[str], idx:int, params:tuple):
+		"""\
+		Find the deepest node with routes along the path.
+		Returns (depth, node, params) or None.
+		"""
+		# Static segments only - no need to recurse
+		depth = len(segments)
+		best = (idx, node, params) if node.has_routes else None
+		while idx < depth and not (node.params or node.catchall):
+			node = node.static.get(segments[idx].lower())
+			if node is None:
+				return best
+			idx += 1
+			if node.has_routes:
+				best = (idx, node, params)
+
+		if idx >= depth:
+			return best
+
+		seg = segments[idx]
+
+		child = node.static.get(seg.lower())
+		if child:
+			found = self._walk(child, segments, idx + 1, params)
+			if found and (not best or found[0] > best[0]):
+				best = found
+				# Nothing can be longer than the whole path
+				if best[0] == depth:
+					return best
+
+		for _, pname, conv, child in node.params:
+			try:
+				value = conv(seg)
+			except ValueError:
+				continue
+			found = self._walk(child, segments, idx + 1, params + ((pname, value),))
+			if found and (not best or found[0] > best[0]):
+				best = found
+				if best[0] == depth:
+					return best
+
+		if node.catchall:
+			pname, child = node.catchall
+			if child.has_routes:
+				best = (depth, child, params + ((pname, '/'.join(segments[idx:])),))
+
+		return best
+
+	def _walk_path(self, path:str):
+		found = self._walk(self.root, split_path(path), 0, ())
+		if not found:
+			return None
+		return found[1], found[2]
+
+	def match(self, path:str, method:str) -> RouteMatch:
+		"""\
+		Look up the route for a decoded url path and a lowercase method.
+		"""
+		resolved = self._resolve(path)
+		if not resolved:
+			return RouteMatch(self.default_route)
+
+		node, params = resolved
+		route = node.methods.get(method) or node.any_method
+		if route:
+			return RouteMatch(route, dict(params))
+
+		return RouteMatch(None, dict(params), node.allowed)
@@ -1,17 +1,71 @@
 import os
 
+# Console log level.
+# Read from the environment once (see set_log_level), because
+# conlog() is all over the hot path and must cost (almost) nothing
+# when it's not going to print anything
+_log_level:int = 0
+
+def set_log_level(level:int|None=None) -> int:
+	"""\
+	(Re)read the console log level.
+	None = take it from the '_jag-dev-lvl' environment variable.
+	Has to be called whenever the level changes (server/worker start).
+	"""
+	global _log_level
+	if level is None:
+		try:
+			level = int(os.environ.get('_jag-dev-lvl', 0))
+		except ValueError:
+			level = 0
+	_log_level = int(level)
+	return _log_level
+
+set_log_level()
+
+
+def log_level() -> int:
+	"""The current console log level, see set_log_level"""
+	return _log_level
+
+
+def conlog_enabled(loglvl=1) -> bool:
+	"""\
+	Whether conlog() would print anything at this log level.
+	Check this before formatting expensive debug output.
+	"""
+	return _log_level >= loglvl
+
+
 def conlog(*args, loglvl=1, exact=False):
 	"""\
 	Printing might eat precious milliseconds.
 	This is also useful for separating console logs into groups.
+
+	Don't format the arguments beforehand (f-strings),
+	pass them as is - print() will do the job, if it ever gets called.
+	For expensive stuff see conlog_lazy()
+	"""
+	if _log_level < loglvl:
+		return
+
+	if exact and loglvl != _log_level:
+		return
+
+	print(*args)
+
+
+def conlog_lazy(func, *args, loglvl=1):
+	"""\
+	conlog(func(*args)), except func is only called
+	if the result is going to be printed::
+
+	    conlog_lazy(iterable_to_grouped_text, headers, 'Request headers:')
 	"""
-	env_lvl = int(os.environ.get('_jag-dev-lvl', 0))
-	if exact and loglvl == env_lvl:
-		print(*args)
+	if _log_level < loglvl:
 		return
 
-	if env_lvl >= loglvl:
-		print(*args)
+	print(func(*args))
 
 
 
@@ -53,21 +107,26 @@ class DynamicGroupedText:
 	    | ('Printing another text',)
 	    +--------------------------
 	"""
-	def __init__(self, groupname='', indent=1):
+	def __init__(self, groupname='', indent=1, loglvl=1):
 		self.indent = '\t'*indent
 		self.groupname = groupname
+		# Decided once, nothing is formatted if the group is muted
+		self.enabled:bool = _log_level >= loglvl
 
 	def __enter__(self):
-		conlog(f'\n{self.indent}+--------------------------')
-		conlog(f'{self.indent}|{self.groupname}')
-		conlog(f'{self.indent}+--------------------------')
+		if self.enabled:
+			print(f'\n{self.indent}+--------------------------')
+			print(f'{self.indent}|{self.groupname}')
+			print(f'{self.indent}+--------------------------')
 		return self
 		
 	def __exit__(self, type, value, traceback):
-		conlog(f'{self.indent}+--------------------------\n')
+		if self.enabled:
+			print(f'{self.indent}+--------------------------\n')
 
 	def print(self, *args):
-		conlog(f'{self.indent}| {args}')
+		if self.enabled:
+			print(f'{self.indent}| {args}')
 
 
 def progrssive_hash(buf, hash_function, mb_read:int=100, as_bytes:bool=False, insecure=False) -> str|bytes:
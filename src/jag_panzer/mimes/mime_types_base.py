@@ -89,3 +89,36 @@ base_mimes = {
 
 base_mimes_signed = {('.'+key):value for (key,value) in base_mimes.items()}
 
+
+
+# Mime types worth compressing (see content_encoding.py).
+# Everything text/* is compressible as well.
+# Images, video, audio and archives are already compressed
+compressible_mimes = {
+	'application/json',
+	'application/ld+json',
+	'application/manifest+json',
+	'application/javascript',
+	'application/xml',
+	'application/xhtml+xml',
+	'application/rtf',
+	'application/x-sh',
+	'application/x-csh',
+	'application/x-httpd-php',
+	'application/vnd.mozilla.xul+xml',
+	'application/vnd.ms-fontobject',
+	'application/wasm',
+	'image/svg+xml',
+	'image/bmp',
+	'image/vnd.microsoft.icon',
+	'font/otf',
+	'font/ttf',
+}
+
+
+def is_compressible(mime:str|None) -> bool:
+	"""text/html; charset=utf-8 -> True"""
+	if not mime:
+		return False
+	mime = mime.split(';')[0].strip().lower()
+	return mime.startswith('text/') or mime in compressible_mimes
@@ -0,0 +1,141 @@
+"""
+Prebuilt responses for the error paths.
+
+Scanners and 404 floods never reach a room,
+they only ever get rejected. Which makes reject() and friends
+the hottest code of the server exactly when it matters the most.
+
+So instead of assembling the status line, the headers
+and the HTML body for every single rejection,
+all of it is built once per worker and sent with a single write:
+
+    - head -> status line + Server, Content-Type and Content-Length
+    - connection tail -> Connection (and Keep-Alive) + the empty line.
+                         The only piece which depends on the request
+    - body -> reject.html with the reason filled in
+
+The common codes (COMMON_CODES) are built right away,
+everything else is built on first use.
+
+Rejections with a hint, a Server-Timing header or headers
+which clash with the prebuilt ones take the regular route
+(ClientRequest.reject -> ServerResponse.flush_bytes).
+"""
+
+import threading
+
+SERVER_FIELD = b'Server: Jag\r\n'
+CLOSE_TAIL = b'Connection: close\r\n\r\n'
+
+
+class PrebuiltResponses:
+	"""\
+	Prebuilt rejections and redirects of a single worker.
+	See the module docstring.
+	"""
+	COMMON_CODES = (400, 401, 403, 404, 405, 411, 413, 431, 503)
+
+	def __init__(
+		self,
+		template:bytes,
+		response_codes:dict[int, str],
+		idle_timeout:int=5,
+		max_requests:int=100,
+		retry_after:int=5
+	):
+		self.template:bytes = template
+		self.response_codes:dict[int, str] = response_codes
+		self.max_requests:int = max_requests
+
+		self._ka_tail:bytes = (
+			f"""Connection: keep-alive\r\nKeep-Alive: timeout={idle_timeout}, max=""".encode()
+		)
+
+		# code: (head, body)
+		self._rejects:dict[int, tuple[bytes, bytes]] = {}
+		# code: head
+		self._redirects:dict[int, bytes] = {}
+		self._lock = threading.Lock()
+
+		for code in self.COMMON_CODES:
+			self.reject(code)
+
+		# Complete responses for the connections,
+		# which are dropped right away by the engines
+		self.header_overflow:bytes = self.closing(431)
+
+		head, body = self.reject(503)
+		self.pool_overflow:bytes = b''.join((
+			head,
+			f"""Retry-After: {retry_after}\r\n""".encode(),
+			CLOSE_TAIL,
+			body,
+		))
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'PrebuiltResponses':
+		ka_cfg = srv_res.cfg['keep_alive']
+		return cls(
+			srv_res.reject_precache,
+			srv_res.response_codes,
+			ka_cfg['idle_timeout'],
+			ka_cfg['max_requests'],
+			srv_res.cfg['multiprocessing']['pool_retry_after'],
+		)
+
+	def status_line(self, code:int) -> bytes:
+		return f"""HTTP/1.1 {self.response_codes.get(code, code)}\r\n""".encode()
+
+	def body(self, code:int, hint:str='') -> bytes:
+		"""The rejection page, hint included"""
+		return (
+			self.template
+			.replace(b'$$reason', self.response_codes.get(code, f'{code} ERROR').encode())
+			.replace(b'$$hint', str(hint).encode())
+		)
+
+	def reject(self, code:int) -> tuple[bytes, bytes]:
+		"""(head, body) of a rejection without a hint"""
+		parts = self._rejects.get(code)
+		if parts:
+			return parts
+
+		body = self.body(code)
+		parts = (
+			b''.join((
+				self.status_line(code),
+				SERVER_FIELD,
+				b'Content-Type: text/html\r\n',
+				f"""Content-Length: {len(body)}\r\n""".encode(),
+			)),
+			body,
+		)
+		with self._lock:
+			self._rejects[code] = parts
+		return parts
+
+	def redirect(self, code:int) -> bytes:
+		"""Head of a redirect, without the Location"""
+		head = self._redirects.get(code)
+		if head:
+			return head
+
+		head = b''.join((
+			self.status_line(code),
+			SERVER_FIELD,
+			b'Content-Length: 0\r\n',
+		))
+		with self._lock:
+			self._redirects[code] = head
+		return head
+
+	def connection_tail(self, keep_conn:bool, rq_num:int) -> bytes:
+		"""Connection header(s) and the end of the head"""
+		if not keep_conn:
+			return CLOSE_TAIL
+		return self._ka_tail + b'%d\r\n\r\n' % (self.max_requests - rq_num)
+
+	def closing(self, code:int) -> bytes:
+		"""A complete rejection, followed by closing the connection"""
+		head, body = self.reject(code)
+		return head + CLOSE_TAIL + body
@@ -96,8 +96,33 @@ class JagHTTPServerResources(JagConfigBase):
 		from pathlib import Path
 		import jag_util, io, platform
 
-		# todo: obsolete. Delete this
-		self.devtime = 0
+		# Index of the worker process these resources belong to
+		self.worker_idx:int = 0
+		# Decides which requests get into the access log.
+		# None if logging is disabled. See jag_logging.AccessLogSampler
+		self.log_sampler = None
+		# Shared memory of the metrics, created before the workers are spawned.
+		# None if metrics are disabled. See jag_metrics.MetricsStore
+		self.metrics_store = None
+		# This worker's view of the above. See jag_metrics.WorkerMetrics
+		self.metrics = None
+		# Profiler of the route functions. See jag_profiler.RouteProfiler
+		self.profiler = None
+		# Rejections and redirects of the current worker, built once.
+		# See prebuilt_responses.PrebuiltResponses
+		self.prebuilt = None
+		# Thread pool of the current worker (if any).
+		# See jag_engine.JagThreadPool
+		self.worker_pool = None
+		# Static file cache of the current worker (if any).
+		# See file_cache.StaticFileCache
+		self.file_cache = None
+		# ETags of static files.
+		# See file_cache.ETagStore
+		self.etag_store = None
+		# Response compression of the current worker (if any).
+		# See content_encoding.ContentEncoder
+		self.content_encoding = None
 		# timestamp of the 
 		self.tstamp = None
 
@@ -125,10 +150,24 @@ class JagHTTPServerResources(JagConfigBase):
 				# Port to run the server on
 				'port': 0,
 
+				# Address to bind the server to.
+				# Empty string = all interfaces ('::' when ipv6 is enabled)
+				'bind_addr': '',
+
+				# Use IPv6 socket.
+				# Automatically enabled if bind_addr is an IPv6 address
+				'ipv6': False,
+
+				# Whether the IPv6 socket should also accept IPv4 connections
+				# (they appear as ::ffff:1.2.3.4)
+				'dual_stack': True,
+
 				# Document root (where index.html is)
 				'doc_root': None,
 
-				# This path should point to a python file with "main()" function inside
+				# Python file(s) with the @JagRoute() functions (and/or JagBlueprints).
+				# Can also be a package directory, an importable module name
+				# or a list of any of these.
 				# If nothing is specified, then default room is created
 				'room_file': None,
 
@@ -177,6 +216,36 @@ class JagHTTPServerResources(JagConfigBase):
 		)
 
 
+		# ------------------
+		# Persistent connections
+		# ------------------
+
+		# HTTP/1.1 keep-alive.
+		# Serve multiple requests over the same connection
+		# instead of doing a new TCP handshake for every single asset.
+		# Pipelined requests are served in the order they were received.
+		self.reg_cfg_group(
+			'keep_alive',
+			{
+				# enable the feature
+				'enabled': True,
+
+				# Close the connection if the client didn't send
+				# a new request within n seconds
+				'idle_timeout': 5,
+
+				# Max amount of requests served over a single connection
+				'max_requests': 100,
+
+				# Max amount of unread request body bytes the server
+				# is willing to discard to keep the connection alive.
+				# Connection is closed if the room left more unread body than this.
+				# Default to 64kb
+				'max_drain': 1024*64,
+			}
+		)
+
+
 		# ------------------
 		# Buffer sizes
 		# ------------------
@@ -198,6 +267,171 @@ class JagHTTPServerResources(JagConfigBase):
 				# Max size of a single chunk when reading streams.
 				# Should not be changed unless you know what you're doing
 				'stream_receive': 4096,
+
+				# In-memory cache of hot static files (every worker has its own).
+				# Cached files are served without touching the disk,
+				# together with precomputed Last-Modified and ETag headers.
+				'file_cache_enabled': True,
+
+				# Max total size of the cached files
+				# Default to 64mb
+				'file_cache_max_bytes': (1024**2)*64,
+
+				# Max amount of cached files
+				'file_cache_max_entries': 4096,
+
+				# Files bigger than this are never cached (they're sent with sendfile)
+				# Default to 1mb
+				'file_cache_max_file': 1024**2,
+
+				# Trust a cached file for n seconds before checking
+				# whether it has changed on disk (one stat() call).
+				# 0 = check on every request
+				'file_cache_revalidate': 1.0,
+
+				# How ETags of static files are calculated:
+				#   'stat' - from inode, size and modification time. Free
+				#   'hash' - sha1 of the contents. Every version of a file is hashed once
+				'etag_mode': 'stat',
+
+				# sqlite database where the content hashes ('hash' mode) are remembered.
+				# Shared between the workers and restarts. None = memory only
+				'etag_store': None,
+
+				# How the TCP stack treats small writes of the responses:
+				#   'nodelay' - TCP_NODELAY, Nagle's algorithm is disabled.
+				#               Every write goes out right away
+				#               (responses are assembled into as few writes as possible)
+				#   'cork'    - TCP_NODELAY + TCP_CORK (Linux only) while the response
+				#               is being sent: head and sendfile body are coalesced
+				#               into full packets, flushed when the response is complete
+				#   'default' - leave OS defaults alone (Nagle enabled)
+				'tcp_policy': 'nodelay',
+			}
+		)
+
+
+		# ------------------
+		# Compression
+		# ------------------
+
+		# Content-Encoding of responses, according to Accept-Encoding.
+		# See content_encoding.py
+		self.reg_cfg_group(
+			'compression',
+			{
+				# enable the feature
+				'enabled': True,
+
+				# Encodings in the order of preference.
+				# br and zstd are only used for on-the-fly compression
+				# if the brotli/zstandard python packages are installed
+				'encodings': ('br', 'zstd', 'gzip'),
+
+				# Don't bother compressing anything smaller than this
+				'min_size': 1024,
+
+				# Static files bigger than this are never compressed on the fly
+				# Default to 4mb
+				'max_file': (1024**2)*4,
+
+				# Serve "file.js.br", "file.js.zst" or "file.js.gz"
+				# instead of "file.js", if present
+				'precompressed': True,
+
+				# Whether a precompressed sibling exists (or not) is remembered
+				# till the file changes, but re-checked every n seconds anyway,
+				# in case siblings are built/removed next to an unchanged file
+				'precompressed_recheck': 5,
+
+				# Compressed variants of static files are remembered
+				# (every worker has its own cache)
+				# Default to 32mb
+				'cache_max_bytes': (1024**2)*32,
+
+				'gzip_level': 6,
+				'br_quality': 5,
+				'zstd_level': 3,
+			}
+		)
+
+
+		# ------------------
+		# Routing
+		# ------------------
+
+		# Routes from the room file are compiled into a tree,
+		# see jag_routing.py
+		self.reg_cfg_group(
+			'routing',
+			{
+				# The amount of recent path lookups to remember
+				# (every worker has its own cache)
+				'cache_size': 4096,
+
+				# Re-import the room modules when they change on disk,
+				# without restarting the workers
+				'hot_reload': False,
+
+				# How often to check the room modules for changes (seconds)
+				'reload_interval': 1.0,
+			}
+		)
+
+
+		# ------------------
+		# metrics
+		# ------------------
+
+		# Request counters and latency histograms, aggregated across all
+		# the workers and exposed in the Prometheus text format.
+		self.reg_cfg_group(
+			'metrics',
+			{
+				'enabled': False,
+
+				# Where to serve the metrics. Takes precedence over the routes.
+				# None = collect, but don't serve
+				'path': '/metrics',
+
+				# Max amount of distinct routes to keep separate counters for.
+				# Everything past this limit is counted as route="<other>"
+				'max_routes': 128,
+			}
+		)
+
+
+		# ------------------
+		# profiling
+		# ------------------
+
+		# Profile the route functions of picked requests.
+		# Could be toggled at runtime by sending SIGUSR1 to the workers,
+		# SIGUSR2 dumps the collected data. See jag_profiler
+		self.reg_cfg_group(
+			'profiling',
+			{
+				# Whether to profile right from the start
+				'enabled': False,
+
+				# 'cprofile' - precise, but slow
+				# 'sampler' - looks at the stacks every sampler_interval, cheap
+				'mode': 'sampler',
+
+				# Profile 1 in N requests of every route.
+				# 0 = only profile the routes listed below
+				'sample_every': 0,
+
+				# {route path: N}, like {'/api/user/<int:id>': 10}
+				# The fallback route is '<default>'
+				'routes': {},
+
+				# Seconds between the stack samples
+				'sampler_interval': 0.005,
+
+				# Where the workers dump the data.
+				# None = logs_dir/profiles
+				'dump_dir': None,
 			}
 		)
 
@@ -222,6 +456,49 @@ class JagHTTPServerResources(JagConfigBase):
 				# the amount of workerks listening for requests
 				# default to the amount of CPU cores, capped to a range 2-16
 				'worker_count': jag_util.clamp(os.cpu_count() or 2, 2, 16),
+
+				# The way every worker handles connections:
+				# 'threads'   - a new thread for every accepted connection.
+				#               No cap, no reuse.
+				# 'pool'      - a fixed amount of pre-spawned reusable threads.
+				#               Accepted connections wait in a bounded queue
+				#               for a free thread.
+				#               Keep in mind that a keep-alive connection
+				#               occupies a thread till it's closed.
+				# 'selectors' - a non-blocking event loop reads request heads
+				#               and only hands fully received requests to
+				#               the pool of threads.
+				#               Thousands of slow/idle clients cost nothing but a socket.
+				'engine': 'threads',
+
+				# The amount of threads serving requests in every worker
+				# ('pool' and 'selectors' engines)
+				'pool_size': 32,
+
+				# Max amount of connections/requests waiting for a free thread
+				'pool_queue_len': 256,
+
+				# What to do when the queue is full:
+				# '503'  - Respond with 503 Service Unavailable + Retry-After
+				# 'drop' - Simply close the connection
+				'pool_overflow': '503',
+
+				# Retry-After value (seconds) for the '503' overflow policy
+				'pool_retry_after': 5,
+
+				# Max amount of seconds a single read/write may block
+				# once the request head is received (body, response).
+				# Otherwise a few clients, which send the head and stall,
+				# would pin every thread of the pool.
+				# 0 = no limit
+				'read_timeout': 30,
+
+				# Every worker opens its own listening socket on the same port
+				# with SO_REUSEPORT and the kernel distributes connections
+				# among them, instead of all workers fighting over accept()
+				# on a shared socket (thundering herd).
+				# Linux/BSD only, ignored where SO_REUSEPORT doesn't exist
+				'reuse_port': False,
 			}
 		)
 
@@ -251,13 +528,67 @@ class JagHTTPServerResources(JagConfigBase):
 				# The RPC port of the logger
 				# DO NOT TOUCH !
 				'port': None,
+
+				# Access log sampling.
+				# Share of the requests to log (0..1)
+				'access_sample_rate': 1.0,
+				# Per route: {'/api/health': 0.01}
+				# (route paths as declared in @JagRoute)
+				'access_sample_routes': {},
+				# Per status class: {'2xx': 0.1, '3xx': 0.1}
+				'access_sample_status': {},
+				# 4xx and 5xx responses are always logged
+				'always_log_errors': True,
+				# Requests slower than this are always logged (milliseconds), 0 = off
+				'slow_request_ms': 1000,
+
+				# Max amount of error records a worker can send per second, 0 = unlimited.
+				# Protects the logger from crash loops
+				'error_rate': 20,
+				# The amount of error records allowed to go through at once
+				'error_burst': 50,
+
+				# Max amount of log records a worker keeps in memory
+				# while waiting for the logger.
+				# Records past this are dropped (and counted)
+				'client_buffer': 8192,
+
+				# Format of the access (connection) log:
+				#     - text     - human readable multiline blocks
+				#     - jsonl    - one JSON object per line
+				#     - common   - Common Log Format
+				#     - combined - Combined Log Format (common + referer and user agent)
+				'access_format': 'text',
+
+				# Max amount of records sent to the logger in one go
+				'client_batch': 256,
+
+				# The logger keeps the log files open and buffered,
+				# the buffers are written to disk when full or this often (seconds)
+				'flush_interval': 1.0,
+				'buffer_size': 1024*64,
+
+				# Move the log file into an archive when it gets bigger
+				# than this. 0 = never. Default to 64mb
+				'rotate_size': (1024**2)*64,
+				# And/or when the day changes
+				'rotate_daily': True,
+				# gzip the archives
+				'compress_archives': True,
+				# The amount of archives to keep per log type. 0 = all
+				'archive_count': 30,
+
+				# Max amount of records waiting to be written.
+				# Past this, the logger stops receiving until it catches up
+				'max_backlog': 65536,
 			}
 		)
 
 		# ensure the default folder exists
 		if self.cfg['logging']['logs_dir'] is None:
 			self.cfg['logging']['logs_dir'] = logdir_selector[platform.system().lower()]
-			self.cfg['logging']['logs_dir'].mkdir(parents=True, exist_ok=True)
+		self.cfg['logging']['logs_dir'] = Path(self.cfg['logging']['logs_dir'])
+		self.cfg['logging']['logs_dir'].mkdir(parents=True, exist_ok=True)
 
 	def reload_libs(self):
 		# preload python libraries
@@ -267,33 +598,95 @@ class JagHTTPServerResources(JagConfigBase):
 
 def server_worker(skt, sv_resources, worker_idx):
 	sv_resources.reload_libs()
+	sv_resources.worker_idx = worker_idx
+	jag_util.set_log_level()
+
+	from file_cache import StaticFileCache, ETagStore
+	sv_resources.etag_store = ETagStore.from_config(sv_resources)
+	from content_encoding import ContentEncoder
+	sv_resources.content_encoding = ContentEncoder.from_config(sv_resources)
+	sv_resources.file_cache = StaticFileCache.from_config(sv_resources)
+	from prebuilt_responses import PrebuiltResponses
+	sv_resources.prebuilt = PrebuiltResponses.from_config(sv_resources)
+
+	# Log records of this worker are shipped by a background thread
+	from jag_logging import LogClient, AccessLogSampler
+	LogClient.configure(sv_resources.cfg['logging'])
+	if sv_resources.cfg['logging']['enabled']:
+		sv_resources.log_sampler = AccessLogSampler.from_config(sv_resources.cfg['logging'])
+
+	if sv_resources.metrics_store:
+		sv_resources.metrics = sv_resources.metrics_store.worker(worker_idx)
+
+	from jag_profiler import RouteProfiler
+	sv_resources.profiler = RouteProfiler.from_config(sv_resources)
+	try:
+		sv_resources.profiler.install_signals()
+	except ValueError:
+		# Not the main thread (threaded JagServer)
+		pass
+
+	# SO_REUSEPORT mode: every worker has its own listening socket
+	if skt is None:
+		skt = create_listener(sv_resources, reuse_port=True)
 
+	route_index = None
 	if sv_resources.cfg['room_file']:
-		route_index = JagRoutingIndex(sv_resources.cfg['room_file'])
+		route_index = JagRoutingIndex.from_config(sv_resources)
 		route_index.index_routes()
 
 	print(f"""Worker {worker_idx+1}/{sv_resources.cfg['multiprocessing']['worker_count']} initialized""")
+
+	mp_cfg = sv_resources.cfg['multiprocessing']
+
+	if mp_cfg['engine'] == 'selectors':
+		from jag_engine import SelectorsEngine
+		SelectorsEngine(skt, sv_resources, route_index).run()
+		return
+
+	if mp_cfg['engine'] == 'pool':
+		from jag_engine import JagThreadPool, reject_overflow
+		pool = JagThreadPool(mp_cfg['pool_size'], mp_cfg['pool_queue_len'])
+		# Make the counters reachable from the rooms
+		sv_resources.worker_pool = pool
+		while True:
+			conn, address = skt.accept()
+			if not pool.submit(htsession, conn, address, sv_resources, route_index, time.perf_counter_ns()):
+				reject_overflow(conn, sv_resources)
+
 	while True:
 		conn, address = skt.accept()
 		# print('Worker', worker_idx, 'accepted connection')
-		sv_resources.devtime = time.time()
-		threading.Thread(target=htsession, args=(conn, address, sv_resources, route_index), daemon=True).start()
+		threading.Thread(
+			target=htsession,
+			args=(conn, address, sv_resources, route_index, time.perf_counter_ns()),
+			daemon=True
+		).start()
 
 
 
-_server_proc = '[Server Process]'
-def sock_server(sv_resources):
-	print('SKT Server PID:', os.getpid())
-	print(_server_proc, 'Binding server to a port... (5/7)')
-	# Port to run the server on
-	# port = 56817
-	port = sv_resources.cfg['port']
-	# Create the Server object
-	skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def create_listener(sv_resources, reuse_port:bool=False, listen:bool=True) -> socket.socket:
+	"""\
+	Create the server socket according to the config:
+	    - bind_addr, port
+	    - IPv4 or IPv6 (optionally dual-stack)
+	    - SO_REUSEPORT
+	"""
+	cfg = sv_resources.cfg
+	bind_addr = cfg['bind_addr'] or ''
+
+	if cfg['ipv6'] or ':' in bind_addr:
+		skt = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+		skt.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, int(not cfg['dual_stack']))
+		bind_addr = bind_addr or '::'
+	else:
+		skt = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+	if reuse_port:
+		skt.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
-	# Bind on all interfaces
 	skt.bind(
-		('', port)
+		(bind_addr, cfg['port'])
 	)
 
 	# Basically launch the server
@@ -301,21 +694,52 @@ def sock_server(sv_resources):
 	# If the amount of connections exceeds this limit -
 	# connections become rejected till other ones are resolved (aka closed)
 	# 0 = infinite
-	skt.listen(sv_resources.cfg['max_connections'])
+	if listen:
+		skt.listen(cfg['max_connections'])
+
+	return skt
+
+
+_server_proc = '[Server Process]'
+def sock_server(sv_resources):
+	print('SKT Server PID:', os.getpid())
+	print(_server_proc, 'Binding server to a port... (5/7)')
 
-	print(_server_proc, 'Server listening on port (6/7)', skt.getsockname()[1])
+	mp_cfg = sv_resources.cfg['multiprocessing']
+	reuse_port = (
+		mp_cfg['enabled']
+		and
+		mp_cfg['reuse_port']
+		and
+		hasattr(socket, 'SO_REUSEPORT')
+	)
 
-	if sv_resources.cfg['multiprocessing']['enabled']:
-		for proc in range(sv_resources.cfg['multiprocessing']['worker_count']):
-			multiprocessing.Process(target=server_worker, args=(skt, sv_resources, proc)).start()
+	if reuse_port:
+		# Only reserve the port (and resolve port 0 into an actual port).
+		# This socket never listens, so the kernel
+		# never hands it any connections
+		skt = create_listener(sv_resources, reuse_port=True, listen=False)
+		sv_resources.cfg['port'] = skt.getsockname()[1]
+		print(_server_proc, 'Reserved port for SO_REUSEPORT workers (6/7)', sv_resources.cfg['port'])
+	else:
+		skt = create_listener(sv_resources)
+		print(_server_proc, 'Server listening on port (6/7)', skt.getsockname()[1])
+
+	# Has to exist before the workers do
+	from jag_metrics import MetricsStore
+	sv_resources.metrics_store = MetricsStore.from_config(sv_resources)
+
+	if mp_cfg['enabled']:
+		for proc in range(mp_cfg['worker_count']):
+			multiprocessing.Process(
+				target=server_worker,
+				args=(None if reuse_port else skt, sv_resources, proc)
+			).start()
 		print(_server_proc, 'Accepting connections... (7/7)')
 	else:
-		sv_resources.reload_libs()
 		print(_server_proc, 'Accepting connections... (7/7)')
-		while True:
-			conn, address = skt.accept()
-			sv_resources.devtime = time.time()
-			threading.Thread(target=htsession, args=(conn, address, sv_resources), daemon=True).start()
+		# Same thing, but right in this process
+		server_worker(skt, sv_resources, 0)
 
 
 
@@ -337,6 +761,13 @@ def server_process(sv_resources, stfu=False):
 		os.environ['_jag-dev-lvl'] = str(int(sv_resources.cfg['console_echo_level']))
 	except Exception as e:
 		pass
+	# conlog() only looks at the environment once
+	jag_util.set_log_level()
+
+	# Profiling control signals are meant for the workers,
+	# everything else ignores them (children inherit this)
+	import jag_profiler
+	jag_profiler.ignore_control_signals()
 
 	# Preload resources n stuff
 	print(_main_init, 'Initializing resources... (1/7)')
@@ -389,7 +820,8 @@ class JagRoute:
 			(cache_ctrl, jag_http_ents.HTTPClientCacheControl),
 		]
 		for prm, ptype in typecheck:
-			if type(prm) not in (ptype, None,):
+			# None means "use the default"
+			if prm is not None and not isinstance(prm, ptype):
 				from jag_exceptions import InvalidJagRoute
 				raise InvalidJagRoute(
 					f'Bad JagRoute: {prm} must be one of {(ptype, None,)}, but not {type(prm)}'
@@ -417,6 +849,70 @@ class JagRoute:
 		return self
 		
 
+class JagBlueprint:
+	"""\
+	A collection of routes under a common url prefix::
+
+	    admin = JagBlueprint('/admin')
+
+	    # Serves /admin/users
+	    @admin.route(path='/users', methods=['GET'])
+	    def users(request, response, services):
+	        pass
+
+	    # Serves /admin itself (and everything below it, not served by other routes)
+	    @admin.route()
+	    def admin_root(request, response, services):
+	        pass
+
+	Blueprints are picked up from the room modules, just like routes.
+	A blueprint can include routes and other blueprints,
+	they're copied under its prefix::
+
+	    api = JagBlueprint('/api/v2', [admin])
+	"""
+	def __init__(self, prefix:str='', routes:list['JagRoute|JagBlueprint']|None=None):
+		prefix = str(prefix).strip('/')
+		self.prefix:str = f'/{prefix}' if prefix else ''
+		self.routes:list[JagRoute] = []
+
+		for route_obj in (routes or []):
+			self.add(route_obj)
+
+	def join(self, path:str|None) -> str|None:
+		"""\
+		Url path relative to the blueprint prefix.
+		None = the prefix itself (or the fallback route, if there's no prefix)
+		"""
+		if not path or path.strip('/') == '':
+			return self.prefix or None
+		return f'{self.prefix}/{path.lstrip("/")}'
+
+	def route(self, path:str=None, **kwargs) -> JagRoute:
+		"""\
+		Same as @JagRoute(), but the path is relative to the prefix.
+		"""
+		route_obj = JagRoute(path=self.join(path), **kwargs)
+		self.routes.append(route_obj)
+		return route_obj
+
+	def add(self, route_obj:'JagRoute|JagBlueprint'):
+		"""\
+		Add a copy of an existing route or all the routes
+		of another blueprint under this prefix.
+		"""
+		import copy
+
+		if isinstance(route_obj, JagBlueprint):
+			for nested in route_obj.routes:
+				self.add(nested)
+			return
+
+		route_copy = copy.copy(route_obj)
+		route_copy.path = self.join(route_obj.path)
+		self.routes.append(route_copy)
+
+
 class JagRoutingIndex:
 	"""\
 
@@ -427,6 +923,11 @@ class JagRoutingIndex:
 	    def a(request, response, services):
 	        pass
 
+	    # Longer routes win, typed params end up in request.path_params
+	    @JagRoute(path='/sex/<int:id>', methods=['GET'])
+	    def c(request, response, services):
+	        request.path_params['id']
+
 	    # This would serve all the other paths, not present in the index
 	    @JagRoute(path=None)
 	    def b(request, response, services):
@@ -445,15 +946,68 @@ class JagRoutingIndex:
 	(whenever any module/file is imported - everything inside gets executed)
 
 	The worker then loops through every attribute of the imported file
-	and checks if it's an instance of JagRoute class. 
+	and checks if it's an instance of JagRoute (or JagBlueprint) class.
 	Each route gets written down for later use in HTTP sessions created
 	by the same worker.
 
-	This means, that your gateway should be contain within a single python file.
-	Aka all the functions decorated with @JagRoute() should be located in a single python file.
+	Routes may come from several room modules: room_file can be a list of
+	python files, package directories or importable module names.
+	Only the attributes of the module itself are inspected, so a package
+	has to import its routes/blueprints in __init__.py.
+
+	Hot reload:
+	With hot_reload enabled every worker checks the room modules
+	for changes (at most once per reload_interval seconds, between requests).
+	Changed modules are executed again and a new routing index is built.
+	The new index replaces the old one in one go, requests in flight
+	keep running with the routes they started with.
+	If the new code fails to load - the old routes stay.
+	Note that only the room modules themselves (and packages, as a whole) are reloaded,
+	not the random helper modules they import.
 	"""
-	def __init__(self, room_file):
-		import importlib, sys
+	def __init__(
+		self,
+		room_file:str|Path|list[str|Path],
+		cache_size:int=4096,
+		hot_reload:bool=False,
+		reload_interval:float=1.0
+	):
+		if isinstance(room_file, (str, Path)):
+			room_file = [room_file]
+		self.room_files:list[str|Path] = list(room_file)
+
+		self.modules:list = []
+		self.custom_module = None
+		self.routes = []
+		self.default_route = None
+
+		# Compiled by index_routes()
+		self.router = None
+		self.cache_size:int = cache_size
+
+		# Hot reload
+		self.hot_reload:bool = hot_reload
+		self.reload_interval:float = reload_interval
+		self.reloads:int = 0
+		# {file path: mtime} of the room modules
+		self._file_sig:dict[str, int|None] = {}
+		self._next_check:float = 0.0
+		self._reload_lock = threading.Lock()
+
+		self.load_modules()
+
+	@classmethod
+	def from_config(cls, srv_res) -> 'JagRoutingIndex':
+		routing_cfg = srv_res.cfg['routing']
+		return cls(
+			srv_res.cfg['room_file'],
+			routing_cfg['cache_size'],
+			routing_cfg['hot_reload'],
+			routing_cfg['reload_interval'],
+		)
+
+	def _load_module(self, room_file:str|Path, module_name:str):
+		import importlib
 		from importlib import util as iutil
 
 		# important todo: what the fuck?
@@ -469,74 +1023,178 @@ class JagRoutingIndex:
 		# It works both on Linux and Windows
 		# (MacOS - 0 fucks given)
 
-		module_file_path = room_file
-		module_name = 'jag_custom_action'
+		module_file_path = Path(room_file)
+
+		# Not a file - a regular importable module/package name
+		if not module_file_path.exists() and not str(room_file).endswith('.py'):
+			module_name = str(room_file)
+			self._forget_module(module_name)
+			return importlib.import_module(module_name)
+
+		if module_file_path.is_dir():
+			# A package
+			spec = iutil.spec_from_file_location(
+				module_name,
+				str(module_file_path / '__init__.py'),
+				submodule_search_locations=[str(module_file_path)]
+			)
+		else:
+			spec = iutil.spec_from_file_location(module_name, str(module_file_path))
 
 		# Execute the custom python file to perform attribute lookup on
-		spec = iutil.spec_from_file_location(module_name, str(module_file_path))
+		self._forget_module(module_name)
 		module = iutil.module_from_spec(spec)
 		sys.modules[module_name] = module
 		spec.loader.exec_module(module)
 
-		self.custom_module = module
-		self.routes = []
-		self.default_route = None
+		return module
+
+	@staticmethod
+	def _forget_module(module_name:str):
+		"""\
+		Remove the module and its submodules from sys.modules,
+		so that the next import executes them again
+		"""
+		for name in [n for n in sys.modules if n == module_name or n.startswith(f'{module_name}.')]:
+			del sys.modules[name]
+
+	@staticmethod
+	def _module_files(module) -> list[Path]:
+		"""\
+		Files a module consists of. Packages are watched as a whole
+		"""
+		if not getattr(module, '__file__', None):
+			return []
+
+		search_locations = getattr(module.__spec__, 'submodule_search_locations', None)
+		if not search_locations:
+			return [Path(module.__file__)]
+
+		files = []
+		for location in search_locations:
+			files.extend(Path(location).rglob('*.py'))
+		return files
+
+	def _file_signature(self, files) -> dict[str, int|None]:
+		signature = {}
+		for file in files:
+			try:
+				signature[str(file)] = os.stat(file).st_mtime_ns
+			except OSError:
+				signature[str(file)] = None
+		return signature
+
+	def load_modules(self):
+		"""\
+		(Re)execute all the room modules.
+		Nothing is replaced unless every module loads successfully.
+		"""
+		modules = []
+		for idx, room_file in enumerate(self.room_files):
+			# The first module keeps its traditional name
+			module_name = 'jag_custom_action' if idx == 0 else f'jag_custom_action_{idx}'
+			modules.append(self._load_module(room_file, module_name))
+
+		self.modules = modules
+		self.custom_module = modules[0] if modules else None
+		self._file_sig = self._file_signature(
+			[file for module in modules for file in self._module_files(module)]
+		)
 
 	def index_routes(self):
+		from jag_routing import RadixRouter
+
+		router = RadixRouter(self.cache_size)
+		routes = []
+		seen = set()
 		with DynamicGroupedText('Indexing Routes') as grouplog:
-			for attr in dir(self.custom_module):
-				route_obj = getattr(self.custom_module, attr)
-				if isinstance(route_obj, JagRoute):
-					# if path is not declared - that's a fallback route
-					if not route_obj.path:
-						grouplog.print('Registering default fallback route:', route_obj)
-						self.default_route = route_obj
+			for module in self.modules:
+				for attr in dir(module):
+					attr_obj = getattr(module, attr)
+
+					if isinstance(attr_obj, JagBlueprint):
+						grouplog.print('Registering blueprint:', attr, attr_obj.prefix)
+						module_routes = attr_obj.routes
+					elif isinstance(attr_obj, JagRoute):
+						module_routes = [attr_obj]
 					else:
-						# otherwise - get route info and write it down
-
-						# convert methods to lowercase
-						route_obj.methods = set([str(m).lower() for m in (route_obj.methods or [])]) or None
-						route_obj.path = route_obj.path.lower()
-
-						grouplog.print('Registering route:', route_obj)
-						self.routes.append(route_obj)
-
-	def match_route(self, requested_route, requested_method):
-		requested_method = str(requested_method).lower()
-		# Traverse through every declared route
-		with DynamicGroupedText('Route lookup') as grouplog:
-			# for allowed_path, allowed_methods, fnc in self.routes:
-			for route_info in self.routes:
-				# Check if requested path matches any of the declared paths
-				grouplog.print('Validating route', 'Need:', requested_route, 'Allow:', route_info.path)
-				if requested_route.startswith(route_info.path):
-					# Check if requested method matches the declared method of the route
-					# If route doesn't has a declared method - any method is allowed
-
-					# Logic: If there are declared methods and requested method doesn't
-					# match any of them - deny.
-					grouplog.print('Validating methods:', 'Need:', requested_method, 'Allow:', route_info.methods)
-					if route_info.methods and not requested_method in route_info.methods:
-						grouplog.print('Method validation failed:', 'Need:', requested_method, 'Allow:', route_info.methods)
-						# important todo: something that makes a little more sense than returning a string
-						# maybe raising a custom Error ?
-						return 'invalid_method'
-
-					# Logic: If there are no declared methods - allow any method
-					if not route_info.methods:
-						grouplog.print('Route', route_info.path, 'doesnt restrict methods, allowing')
-						return route_info
-
-					# Logic: If allowed method matches requested method - proceed with execution
-					if requested_method in route_info.methods:
-						grouplog.print('Request method', requested_method, 'matches allowed methods', route_info.methods)
-						return route_info
-
-			# If no route was found - execute default function
-			# Aka the function which was declared strictly like
-			# @JagRoute()
-			grouplog.print('Couldnt find a suitable route.', 'Requested route:', requested_route)
-			return self.default_route
+						continue
+
+					for route_obj in module_routes:
+						# The same route may be exposed under multiple names
+						if id(route_obj) in seen:
+							continue
+						seen.add(id(route_obj))
+
+						# if path is not declared - that's a fallback route
+						if not route_obj.path:
+							grouplog.print('Registering default fallback route:', route_obj)
+							router.default_route = route_obj
+						else:
+							# otherwise - get route info and write it down
+
+							# convert methods to lowercase
+							route_obj.methods = set([str(m).lower() for m in (route_obj.methods or [])]) or None
+
+							grouplog.print('Registering route:', route_obj.path, route_obj.methods)
+							router.add(route_obj)
+
+						routes.append(route_obj)
+
+		# Lookups only ever touch self.router,
+		# so replacing it is the atomic switch to the new index
+		self.routes = routes
+		self.default_route = router.default_route
+		self.router = router
+
+	def reload_if_changed(self) -> bool:
+		"""\
+		Rebuild the index if any of the room modules changed on disk.
+		Cheap enough to be called before every request.
+		Returns True if the routes were reloaded.
+		"""
+		if not self.hot_reload:
+			return False
+
+		now = time.monotonic()
+		if now < self._next_check:
+			return False
+		self._next_check = now + self.reload_interval
+
+		# Somebody else is already on it
+		if not self._reload_lock.acquire(blocking=False):
+			return False
+
+		try:
+			current_sig = self._file_signature(self._file_sig)
+			if current_sig == self._file_sig:
+				return False
+
+			try:
+				self.load_modules()
+				self.index_routes()
+			except Exception as e:
+				# Keep serving the old routes,
+				# and don't try again until the files change once more
+				self._file_sig = current_sig
+				print('Failed to reload the routes, keeping the old ones:')
+				print(jag_util.traceback_to_text(e))
+				return False
+
+			self.reloads += 1
+			print(f'Routes reloaded ({len(self.routes)} routes)')
+			return True
+		finally:
+			self._reload_lock.release()
+
+	def match_route(self, requested_route:str, requested_method:str) -> 'jag_routing.RouteMatch':
+		"""\
+		Find the route serving the given (decoded) url path.
+		The longest matching route wins, see jag_routing.
+		If nothing matches - the default route is returned
+		(the function which was declared strictly like @JagRoute()).
+		"""
+		return self.router.match(requested_route, str(requested_method).lower())
 
 
 